@@ -0,0 +1,239 @@
+""" Delta statistics for the moderators, from the bot's own decisions.
+
+Moderators ask for deltas per day, the top awarders, how long after a
+comment the delta for it tends to come, and which rules deltas are turned
+down for. The scoreboard pages only list the deltas awarded, so none of that
+could be answered without reading the threads again. Now every delta the bot
+answers, with a confirmation or with the rule it broke, is appended to
+history_filename as a line of JSON: when the delta was written, by whom and
+to whom, the message key it was answered with and how many seconds after
+the comment it answers it came.
+
+To report, the history is loaded into columns: NumPy arrays of int64
+timestamps and waits, the awarders as ids into a list of interned user names,
+and rule codes (indexes into RULES). Each report is a group-by over the
+columns, a bincount or unique over a masked array, rather than a loop over
+the records, so a year of history takes a fraction of a second. The reports
+are rendered as the stats_page wiki page when a moderator sends the stats
+command, or printed by running this file with runstats.sh.
+
+NumPy is only needed to report, so it is only imported then, not with the
+bot. Without it the history is still kept, and the stats command answers
+that it isn't installed.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import datetime
+import threading
+
+import config
+
+
+# The messages a delta can be answered with; a rule code is an index here
+RULES = ('confirmation', 'already_awarded', 'too_little_text', 'broken_rule')
+AWARDED = 0
+DAY = 86400
+
+
+class History(object):
+    """ Appended to config.history_filename; nothing is kept if that is not
+    set """
+
+    def __init__(self, config):
+        self.config = config
+        self.filename = config.history_filename
+        self.file = open(self.filename, 'a') if self.filename else None
+        self.lock = threading.Lock()
+
+    def record(self, comment, parent, message):
+        """ Note that the delta in comment, to the author of parent, was
+        answered with message """
+        if self.file is None:
+            return
+        key, args = self.config.templates.match(message)
+        if key not in RULES:
+            return
+        created = int(comment.created)
+        parent_created = getattr(parent, 'created', None)
+        record = {'t': created, 'by': str(comment.author),
+                  'to': str(parent.author), 'rule': key,
+                  'wait': (None if parent_created is None
+                           else created - int(parent_created))}
+        # Not synced: the history is for reports, and losing the last few
+        # decisions to a crash only makes them a little short
+        with self.lock:
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def has_numpy():
+    """ Returns True if NumPy can be imported to report """
+    try:
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+class Columns(object):
+    """ A history as NumPy arrays, one element per decision """
+
+    def __init__(self, records):
+        import numpy
+        codes = dict((rule, code) for code, rule in enumerate(RULES))
+        self.times = numpy.array([record['t'] for record in records],
+                                 dtype=numpy.int64)
+        # Interned: users holds each name once, sorted, and awarders the
+        # index of each decision's awarder in it
+        users, awarders = numpy.unique(
+            numpy.array([record['by'] for record in records], dtype=str),
+            return_inverse=True)
+        self.users = users.tolist()
+        self.awarders = awarders.astype(numpy.int32).ravel()
+        self.rules = numpy.array([codes[record['rule']] for record in records],
+                                 dtype=numpy.int8)
+        # -1 where the time of the comment answered isn't known
+        self.waits = numpy.array([-1 if record['wait'] is None
+                                  else record['wait'] for record in records],
+                                 dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.times)
+
+
+def load(filename):
+    """ Read a history file into Columns. Broken lines are skipped. """
+    if not os.path.exists(filename):
+        return Columns([])
+    with open(filename) as history_file:
+        lines = [line for line in history_file if line.strip()]
+    try:
+        # Much faster than a call per line
+        records = json.loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.warning("Skipping a broken history line")
+    return Columns(records)
+
+
+def report(columns, since=None, top=10):
+    """ The statistics of the decisions made since (a timestamp; all of
+    them if None), in plain lists and numbers """
+    import numpy
+    selected = (numpy.ones(len(columns), dtype=bool) if since is None
+                else columns.times >= since)
+    awarded = selected & (columns.rules == AWARDED)
+    rejected = selected & (columns.rules != AWARDED)
+
+    days, per_day = numpy.unique(columns.times[awarded] // DAY,
+                                 return_counts=True)
+    awards_by = numpy.bincount(columns.awarders[awarded],
+                               minlength=len(columns.users))
+    # Most deltas first, then by name
+    order = numpy.argsort(-awards_by, kind='mergesort')[:top]
+    waits = columns.waits[awarded]
+    waits = waits[waits >= 0]
+    by_rule = numpy.bincount(columns.rules[rejected], minlength=len(RULES))
+    turned_down = max(1, int(rejected.sum()))
+
+    return {
+        'since': since,
+        'deltas': int(awarded.sum()),
+        'rejected': int(rejected.sum()),
+        'per_day': [(datetime.datetime.utcfromtimestamp(day * DAY)
+                     .strftime('%Y-%m-%d'), int(count))
+                    for day, count in zip(days.tolist(), per_day.tolist())],
+        'top_awarders': [(columns.users[user], int(awards_by[user]))
+                         for user in order.tolist() if awards_by[user]],
+        'median_wait': float(numpy.median(waits)) if len(waits) else None,
+        # Most common first
+        'rejections': sorted(((RULES[code], int(by_rule[code]),
+                               float(by_rule[code]) / turned_down)
+                              for code in range(1, len(RULES))),
+                             key=lambda rejection: -rejection[1]),
+    }
+
+
+def format_wait(seconds):
+    if seconds is None:
+        return "unknown"
+    if seconds < 3600:
+        return "%d minutes" % (seconds // 60)
+    return "%.1f hours" % (seconds / 3600.0)
+
+
+def render(stats):
+    """ The statistics from report() as a wiki page """
+    if stats['since'] is None:
+        period = "all the deltas the bot has answered"
+    else:
+        period = "the deltas answered since %s" % (
+            datetime.datetime.utcfromtimestamp(stats['since'])
+            .strftime('%Y-%m-%d'))
+    text = "# Delta statistics\n\nFor %s: %s awarded, %s turned down.\n" % (
+        period, stats['deltas'], stats['rejected'])
+    text += "\nMedian time from a comment to its delta: %s\n" % (
+        format_wait(stats['median_wait']))
+
+    text += "\n## Deltas per day\n\n| Day | Deltas |\n| ------ | :------: |"
+    for day, count in stats['per_day']:
+        text += "\n| %s | %s |" % (day, count)
+
+    text += ("\n\n## Top awarders\n\n| Rank | Username | Deltas given |"
+             "\n| :------: | ------ | :------: |")
+    for rank, (user, count) in enumerate(stats['top_awarders'], 1):
+        text += "\n| %s | /u/%s | %s |" % (rank, user, count)
+
+    text += ("\n\n## Deltas turned down\n\n| Rule | Deltas | Share |"
+             "\n| ------ | :------: | :------: |")
+    for rule, count, share in stats['rejections']:
+        text += "\n| %s | %s | %.1f%% |" % (rule, count, share * 100)
+    return text + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('history', nargs='?',
+                        help="a history file, as JSON lines (default: "
+                             "history_filename from the config)")
+    parser.add_argument('--days', type=int, default=None,
+                        help="only report the last this many days "
+                             "(default: all of the history)")
+    parser.add_argument('--top', type=int, default=10,
+                        help="how many awarders to list")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if not has_numpy():
+        sys.exit("The statistics need NumPy")
+    filename = args.history or config.Config(
+        os.getcwd() + '/config/config.json').history_filename
+    if not filename:
+        parser.error("no history file given, and none in the config")
+    since = time.time() - args.days * DAY if args.days else None
+    start = time.time()
+    columns = load(filename)
+    stats = report(columns, since, args.top)
+    print(render(stats))
+    print("%s decisions reported in %.3fs" % (len(columns),
+                                              time.time() - start),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
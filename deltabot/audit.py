@@ -0,0 +1,355 @@
+""" Offline audit and backfill of everyone's delta counts.
+
+Reads a dump of historical comments, one JSON object per line, either in the
+format replay.py captures things in or a Pushshift style export (id, author,
+body, parent_id, link_id, created_utc; submissions can be mixed in to give
+each thread its OP). The bot's own rules (Messages.scan_comment) are run over
+every submission in the order its comments were written, and the deltas that
+pass make up a ledger, which is then compared to the users' current flair and
+wiki pages.
+
+The dump is split into byte ranges that are parsed in parallel and sharded by
+submission into temporary files, then each shard is audited on its own by a
+multiprocessing pool, so only one shard's threads are ever in memory in a
+worker. Comment bodies are only kept when they contain a token. Run with
+runaudit.sh from the repository root.
+"""
+from __future__ import print_function
+
+import os
+import zlib
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import collections
+import multiprocessing
+
+import config
+import reddit
+import patterns
+from messages import Messages
+from praw_mocks import Reddit, Submission, Comment, Author
+from replay import ReplayReddit
+
+
+# Byte ranges and shards per process, so a slow one doesn't hold up the pool
+TASKS_PER_PROCESS = 4
+
+
+def load_record(record):
+    """ Returns (link_id, name, parent_id, author, created, body, link_author)
+    for a comment or submission record from a dump, or None for anything
+    else. name is a fullname; parent_id is None for a submission. """
+    name = record.get('name') or record.get('id')
+    if not name:
+        return None
+    if '_' not in name:
+        name = ('t3_' if 'title' in record else 't1_') + name
+    author = record.get('author')
+    created = record.get('created', record.get('created_utc')) or 0
+    if name.startswith('t3_'):
+        return name, name, None, author, float(created), '', author
+    if not name.startswith('t1_'):
+        return None
+    link_id = record['link_id']
+    if not link_id.startswith('t3_'):
+        link_id = 't3_' + link_id
+    return (link_id, name, record['parent_id'], author, float(created),
+            record.get('body') or '', record.get('link_author'))
+
+
+def chunk_offsets(filename, count):
+    """ Split filename into count byte ranges, as (start, end) pairs """
+    size = os.path.getsize(filename)
+    step = max(1, size // count + 1)
+    return [(start, min(start + step, size)) for start in range(0, size, step)]
+
+
+def shard_of(link_id, shards):
+    # crc32 rather than hash(), which can differ between processes
+    return zlib.crc32(link_id.encode('utf-8')) % shards
+
+
+def split_chunk(task):
+    """ Parse the lines starting in one byte range of the dump and append
+    them to the shard files of their submissions. Returns how many comments
+    were read. """
+    attrs, filename, start, end, workdir, shards, index = task
+    token_pattern = config.Config(attrs).token_pattern
+    files = {}
+    comments = 0
+    try:
+        with open(filename, 'rb') as dump:
+            if start:
+                # Skip the line that started in the range before
+                dump.seek(start - 1)
+                dump.readline()
+            while dump.tell() < end:
+                line = dump.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                row = load_record(json.loads(line.decode('utf-8')))
+                if row is None:
+                    continue
+                if row[2] is not None:
+                    comments += 1
+                    if not token_pattern.search(row[5]):
+                        # Only the comments that could award a delta need
+                        # their bodies
+                        row = row[:5] + ('',) + row[6:]
+                shard = shard_of(row[0], shards)
+                if shard not in files:
+                    files[shard] = open(os.path.join(
+                        workdir, '%s.%s.jsonl' % (shard, index)), 'w')
+                files[shard].write(json.dumps(row, separators=(',', ':')) +
+                                   '\n')
+    finally:
+        for shard_file in files.values():
+            shard_file.close()
+    return comments
+
+
+def audit_submission(messages, link_id, link_author, rows):
+    """ Run the bot's rules over one submission's comments, in the order
+    they were written. Returns the deltas awarded, as
+    [awardee, comment name, link_id, created] lists, and a Counter of the
+    reasons the other delta comments were turned down. """
+    bot_name = messages.config.bot_name
+    parents = dict((row[1], row[2]) for row in rows)
+
+    # Only the comment trees with a delta in them are ever looked at
+    roots = {}
+
+    def root_of(name):
+        path = []
+        while name not in roots:
+            path.append(name)
+            if parents[name] not in parents:
+                roots[name] = name
+                break
+            name = parents[name]
+        for seen in path:
+            roots[seen] = roots[name]
+        return roots[name]
+
+    delta_roots = set(root_of(row[1]) for row in rows if row[5])
+    rows = sorted((row for row in rows if root_of(row[1]) in delta_roots),
+                  key=lambda row: (row[4], row[1]))
+
+    session = Reddit(username=messages.config.account['username'])
+    messages.reddit = session
+    submission = Submission(author=Author(name=link_author or ''),
+                            reddit_session=session, replies=[])
+    submission.id = link_id[3:]
+    submission.is_root = True
+    session.set_info(link_id, submission)
+    awards = []
+    rejected = collections.Counter()
+    for name, parent_id, author, created, body in (row[1:6] for row in rows):
+        if (author or '').lower() == bot_name:
+            # The bot's own replies stay in the tree, but only the
+            # confirmations posted during this audit count
+            body = ''
+        comment = Comment(author=Author(name=author or '[deleted]'),
+                          body=body, reddit_session=session, replies=[])
+        comment.id = name[3:]
+        comment.parent_id = parent_id
+        comment.submission = submission
+        comment.created = created
+        parent = session.info.get(parent_id)
+        # A comment whose parent isn't in the dump is treated as the top of
+        # its thread
+        comment.is_root = parent is None or parent is submission
+        if parent is not None:
+            parent.replies.append(comment)
+        session.set_info(name, comment)
+
+        if not body:
+            continue
+        if parent is None:
+            rejected["No points awarded, parent is not in the dump"] += 1
+            continue
+        if str(parent.author) == '[deleted]':
+            rejected["No points awarded, parent is deleted"] += 1
+            continue
+        log, message, awardee = messages.scan_comment(
+            comment, parent, messages.already_replied,
+            messages.is_parent_commenter_author,
+            messages.points_already_awarded_to_ancestor)
+        if awardee:
+            # Later checks in the thread look for the bot's confirmation
+            messages.reply(comment, message)
+            awards.append([awardee, name, link_id, created])
+        else:
+            rejected[log] += 1
+    return awards, rejected
+
+
+def audit_shard(task):
+    """ Audit every submission in one shard. Returns the awards and
+    rejections of all of them. """
+    attrs, paths = task
+    messages = Messages(config.Config(attrs))
+    threads = collections.defaultdict(list)
+    link_authors = {}
+    for path in paths:
+        with open(path) as shard_file:
+            for line in shard_file:
+                row = json.loads(line)
+                if row[6]:
+                    link_authors[row[0]] = row[6]
+                if row[2] is not None:
+                    threads[row[0]].append(row)
+
+    awards = []
+    rejected = collections.Counter()
+    for link_id, rows in threads.items():
+        if not any(row[5] for row in rows):
+            continue
+        more_awards, more_rejected = audit_submission(
+            messages, link_id, link_authors.get(link_id), rows)
+        awards += more_awards
+        rejected.update(more_rejected)
+    return awards, rejected
+
+
+def audit(filename, base_config, processes=None):
+    """ Audit a dump of comments. Returns the ledger, a dict of each
+    awardee's awards (sorted by time), and a dict of totals. """
+    processes = processes or multiprocessing.cpu_count()
+    tasks = processes * TASKS_PER_PROCESS
+    # Workers keep their reply index in memory
+    attrs = dict(base_config.attrs, reply_index_filename=None)
+    workdir = tempfile.mkdtemp(prefix='deltabot-audit-')
+    pool = multiprocessing.Pool(processes)
+    try:
+        chunks = chunk_offsets(filename, tasks)
+        comments = sum(pool.imap_unordered(split_chunk, [
+            (attrs, filename, start, end, workdir, tasks, index)
+            for index, (start, end) in enumerate(chunks)]))
+        shard_paths = collections.defaultdict(list)
+        for name in os.listdir(workdir):
+            shard_paths[int(name.split('.')[0])].append(
+                os.path.join(workdir, name))
+        ledger = collections.defaultdict(list)
+        rejected = collections.Counter()
+        for awards, more_rejected in pool.imap_unordered(
+                audit_shard, [(attrs, paths)
+                              for paths in shard_paths.values()]):
+            for award in awards:
+                ledger[award[0]].append(award[1:])
+            rejected.update(more_rejected)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        shutil.rmtree(workdir)
+
+    for awards in ledger.values():
+        awards.sort(key=lambda award: (award[2], award[0]))
+    totals = {'comments': comments,
+              'deltas': sum(len(awards) for awards in ledger.values()),
+              'rejected': rejected}
+    return dict(ledger), totals
+
+
+def state_from_capture(filename):
+    """ Current flair and wiki counts ({user: count} each) as recorded in a
+    capture file (see replay.py) """
+    session = ReplayReddit(filename, speed=0)
+    flair = dict((user, patterns.parse_flair_count(text))
+                 for user, (text, css_class) in session.subreddit.flair.items())
+    wiki = dict((page[len('user/'):], patterns.parse_wiki_delta_count(content))
+                for page, content in session.wiki.items()
+                if page.startswith('user/'))
+    return flair, wiki
+
+
+def state_from_reddit(base_config, users):
+    """ Current flair counts of everyone with flair, and the wiki counts of
+    users (one API call each) """
+    session = reddit.Reddit(base_config)
+    flair = dict((item['user'], patterns.parse_flair_count(item['flair_text']))
+                 for item in session.subreddit.get_flair_list(limit=None))
+    wiki = {}
+    for user in sorted(set(users) | set(flair)):
+        try:
+            page = session.get_wiki_page(base_config.subreddit, 'user/' + user)
+            wiki[user] = patterns.parse_wiki_delta_count(page.content_md)
+        except Exception:
+            # No wiki page (or no access to it)
+            wiki[user] = None
+    return flair, wiki
+
+
+def diff(ledger, flair, wiki):
+    """ Returns a dict for every user whose flair or wiki count is not what
+    the ledger says, with all three counts. Users without flair count as 0;
+    users missing from wiki are left out of the wiki comparison. """
+    rows = []
+    for user in sorted(set(ledger) | set(flair)):
+        expected = len(ledger.get(user, ()))
+        row = {'user': user, 'ledger': expected,
+               'flair': flair.get(user, 0), 'wiki': wiki.get(user)}
+        if row['flair'] != expected or (row['wiki'] is not None and
+                                        row['wiki'] != expected):
+            rows.append(row)
+    return rows
+
+
+def write_jsonl(filename, rows):
+    with open(filename, 'w') as out:
+        for row in rows:
+            out.write(json.dumps(row, sort_keys=True) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('dump', help="comments to audit, as JSON lines")
+    state = parser.add_mutually_exclusive_group()
+    state.add_argument('--state', metavar='FILE',
+                       help="compare against the flair and wiki pages in a "
+                            "capture file")
+    state.add_argument('--live', action='store_true',
+                       help="compare against the subreddit's current flair "
+                            "and wiki pages (one API call per user)")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--ledger', default='audit_ledger.jsonl',
+                        help="where to write the ledger")
+    parser.add_argument('--diff', default='audit_diff.jsonl',
+                        help="where to write the differences")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    base_config = config.Config(os.getcwd() + '/config/config.json')
+    start = time.time()
+    ledger, totals = audit(args.dump, base_config, args.processes)
+    print("%s comments, %s deltas to %s users in %.1fs" % (
+        totals['comments'], totals['deltas'], len(ledger),
+        time.time() - start))
+    for log, count in totals['rejected'].most_common():
+        print("%8d %s" % (count, log))
+    write_jsonl(args.ledger, ({'user': user, 'deltas': len(awards),
+                               'awards': awards}
+                              for user, awards in sorted(ledger.items())))
+
+    if args.state or args.live:
+        if args.state:
+            flair, wiki = state_from_capture(args.state)
+        else:
+            flair, wiki = state_from_reddit(base_config, ledger)
+        rows = diff(ledger, flair, wiki)
+        write_jsonl(args.diff, rows)
+        print("%s users differ, see %s" % (len(rows), args.diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,500 @@
+""" Offline benchmarks for DeltaBot.
+
+Runs the bot against praw_mocks with synthetic traffic, or against traffic
+captured from a live run (see replay.py), and reports throughput, API calls
+per delta and how long deltas wait for their confirmation (and inbox items
+for their handling). With --http it instead measures the bytes an
+iteration's wiki reads take from a local stand-in for reddit, with and
+without conditional GETs (see transport.py). With --soak it runs a long
+stream of comments through the bot and reports how its memory use grows
+(see memory.py). With --stats it times the moderators' statistics over a
+synthetic year of history (see analytics.py). Run with runbench.sh from the
+repository root.
+"""
+from __future__ import print_function
+
+import io
+import re
+import os
+import gzip
+import json
+import time
+import timeit
+import hashlib
+import logging
+import argparse
+import calendar
+import tempfile
+import threading
+from random import choice, Random
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError: # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import requests
+
+import config
+import utils
+import memory
+import deltabot
+import analytics
+import metrics
+import patterns
+import transport
+from praw_mocks import Reddit, SyntheticSubreddit
+from replay import ReplayReddit
+
+
+# Settings every scenario starts from
+DEFAULTS = {
+    'iterations': 20,       # passes of the main loop
+    'per_iteration': 50,    # comments published before each pass
+    'backlog': 0,           # comments published before the first pass
+    'backlog_seconds': 0,   # how long the backlog took to accumulate
+    'inbox_backlog': 0,     # unread replies to the bot before the first pass
+    'submissions': 20,
+    'thread_depth': 8,
+    'delta_rate': 0.02,
+    'reply_to_latest': False,
+    'start': None,
+}
+
+SCENARIOS = {
+    'steady_state': {},
+    # The last half hour of a month, when everyone tidies up their deltas.
+    # The burst straddles the boundary so two monthly scoreboards are written
+    'month_end_burst': {
+        'iterations': 10,
+        'per_iteration': 250,
+        'delta_rate': 0.05,
+        'start': calendar.timegm((2014, 1, 31, 23, 30, 0)),
+    },
+    # Six hours of downtime at one comment every six seconds
+    'catch_up': {
+        'iterations': 5,
+        'backlog': 3600,
+        'backlog_seconds': 6 * 60 * 60,
+    },
+    # Replies asking the bot to rescan, piled up during an outage
+    'inbox_backlog': {
+        'iterations': 2,
+        'per_iteration': 0,
+        'inbox_backlog': 500,
+    },
+    # One long back-and-forth, so ancestor checks walk hundreds of levels
+    'deep_thread': {
+        'iterations': 10,
+        'per_iteration': 30,
+        'submissions': 1,
+        'thread_depth': 1000,
+        'delta_rate': 0.1,
+        'reply_to_latest': True,
+    },
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def make_config(base_config):
+    """ A copy of base_config that keeps the bot's files out of the way """
+    workdir = tempfile.mkdtemp(prefix='deltabot-bench-')
+    return config.Config(dict(base_config.attrs,
+        last_comment_filename=os.path.join(workdir, 'prev_id.txt'),
+        journal_filename=os.path.join(workdir, 'awards.journal'),
+        snapshot_filename=os.path.join(workdir, 'snapshot.json'),
+        reply_index_filename=os.path.join(workdir, 'replies.jsonl'),
+        leaderboard_filename=os.path.join(workdir, 'leaderboard.json'),
+        mod_mail_filename=os.path.join(workdir, 'mod_mail.json'),
+        history_filename=os.path.join(workdir, 'history.jsonl'),
+        lease_filename=None, capture_filename=None, metrics_filename=None,
+        metrics_port=None))
+
+
+def results(name, published, tokens, calls, elapsed):
+    deltas = [c for c in published
+              if any(token in c.body for token in tokens)]
+    latencies = [c._replied_at - c._visible_at for c in deltas
+                 if c._replied_at is not None]
+    latencies += [c._read_at - c._visible_at for c in published
+                  if getattr(c, '_read_at', None) is not None]
+    return {
+        'scenario': name,
+        'comments': len(published),
+        'deltas': len(deltas),
+        'seconds': elapsed,
+        'throughput': len(published) / elapsed if elapsed else 0.0,
+        'calls': calls,
+        'calls_per_delta': calls / float(len(deltas)) if deltas else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def runbench(scenario, base_config, latency=0.0, seed=0):
+    """ Run one scenario and return a dict of its results """
+    settings = dict(DEFAULTS, **SCENARIOS[scenario])
+    bench_config = make_config(base_config)
+
+    session = Reddit(username=bench_config.account['username'],
+                     latency=latency)
+    session.wiki['delta_tracker'] = ''
+    bot = deltabot.DeltaBot(bench_config, test=True, test_reddit=session)
+    traffic = SyntheticSubreddit(session, bench_config.tokens,
+                                 bot.minimum_comment_length,
+                                 submissions=settings['submissions'],
+                                 thread_depth=settings['thread_depth'],
+                                 delta_rate=settings['delta_rate'],
+                                 reply_to_latest=settings['reply_to_latest'],
+                                 seed=seed, start=settings['start'])
+
+    published = []
+    if settings['backlog']:
+        published += traffic.publish(settings['backlog'],
+                                     interval=(settings['backlog_seconds'] /
+                                               float(settings['backlog'])))
+    too_short = (bench_config.messages['too_little_text'][0] +
+                 bench_config.messages['append_to_all_messages'])
+    for x in range(settings['inbox_backlog']):
+        published.append(traffic.inbox_reply(too_short, edited=x % 2 == 0))
+    session.calls.clear()
+
+    start = time.time()
+    for x in range(settings['iterations']):
+        published += traffic.publish(settings['per_iteration'])
+        bot.iterate()
+    elapsed = time.time() - start
+    bot.close()
+
+    return results(scenario, published, bench_config.tokens,
+                   sum(session.calls.values()), elapsed)
+
+
+def runreplay(filename, base_config, speed=0.0):
+    """ Run the bot over a capture file until it is used up """
+    bench_config = make_config(base_config)
+    session = ReplayReddit(filename, speed,
+                           username=bench_config.account['username'])
+    bot = deltabot.DeltaBot(bench_config, test=True, test_reddit=session)
+    session.calls.clear()
+
+    start = time.time()
+    while not session.finished:
+        bot.iterate()
+    elapsed = time.time() - start
+    bot.close()
+
+    published = [thing for thing in session.info.values()
+                 if hasattr(thing, '_visible_at')]
+    return results('replay', published, bench_config.tokens,
+                   sum(session.calls.values()), elapsed)
+
+
+def runsoak(base_config, comments=1000000, per_iteration=2000,
+            thread_size=500, reports=10, seed=0):
+    """ Run comments synthetic comments through the bot, per_iteration to a
+    pass, with quiet threads dropped from the mock session as it goes so
+    only the bot's own memory can grow. Yields (comments so far, resident
+    bytes, bytes in the bot's caches, bytes evicted so far) reports times
+    along the way. """
+    settings = dict(DEFAULTS, **SCENARIOS['steady_state'])
+    bench_config = make_config(base_config)
+    session = Reddit(username=bench_config.account['username'])
+    session.wiki['delta_tracker'] = ''
+    bot = deltabot.DeltaBot(bench_config, test=True, test_reddit=session)
+    traffic = SyntheticSubreddit(session, bench_config.tokens,
+                                 bot.minimum_comment_length,
+                                 submissions=settings['submissions'],
+                                 thread_depth=settings['thread_depth'],
+                                 delta_rate=settings['delta_rate'],
+                                 seed=seed, thread_size=thread_size)
+    iterations = max(1, comments // per_iteration)
+    every = max(1, iterations // reports)
+    try:
+        for x in range(1, iterations + 1):
+            traffic.publish(per_iteration)
+            bot.iterate()
+            traffic.forget()
+            if x % every == 0 or x == iterations:
+                yield (x * per_iteration, memory.resident_size(),
+                       sum(bot.budget.sizes().values()),
+                       metrics.registry.counters['memory.evicted_bytes'])
+    finally:
+        bot.close()
+
+
+def runstats(days=365, per_day=300, users=20000, seed=0):
+    """ Write a history of days days of per_day decisions each and time
+    loading it, reporting on it and rendering the report. Returns
+    (decisions, load seconds, report seconds, render seconds). """
+    random = Random(seed)
+    workdir = tempfile.mkdtemp(prefix='deltabot-bench-')
+    filename = os.path.join(workdir, 'history.jsonl')
+    start = int(time.time()) - days * analytics.DAY
+    # Mostly confirmations, like the real thing
+    codes = [0] * 6 + [1, 2, 2, 3]
+    with open(filename, 'w') as history_file:
+        for n in range(days * per_day):
+            history_file.write(json.dumps({
+                't': start + n * analytics.DAY // per_day,
+                'by': 'user_%s' % int(random.paretovariate(1.2) % users),
+                'to': 'user_%s' % random.randrange(users),
+                'rule': analytics.RULES[random.choice(codes)],
+                'wait': int(random.expovariate(1 / 7200.0))}) + '\n')
+    try:
+        started = time.time()
+        columns = analytics.load(filename)
+        loaded = time.time()
+        stats = analytics.report(columns)
+        reported = time.time()
+        analytics.render(stats)
+        rendered = time.time()
+    finally:
+        os.remove(filename)
+        os.rmdir(workdir)
+    return (len(columns), loaded - started, reported - loaded,
+            rendered - reported)
+
+
+def micro(base_config, number=100000):
+    """ Time each patterns parser and template operation against the inline
+    code it replaced. Returns a list of (name, old seconds per call, new
+    seconds per call). """
+    subreddit = 'changemyview'
+    old_comment_id = ('(?:http://)?(?:www\\.)?reddit\\.com/r(?:eddit)?/' +
+                      subreddit + '/comments/[\\d\\w]+(?:/[^/]+)/?([\\d\\w]+)')
+    body = "\n".join("http://www.reddit.com/r/%s/comments/1abc/x/c%s"
+                     % (subreddit, n) for n in range(5))
+    title, url = 'CMV: a view', 'http://www.reddit.com/r/cmv/comments/1abc/x/'
+    cases = [
+        ('parse_flair_count',
+         lambda: int(re.search('(\\d+)', '12 deltas').group()),
+         lambda: patterns.parse_flair_count('12 deltas')),
+        ('is_skippable_line',
+         lambda: re.search('(^    |^ *&gt;)', 'a line of text') != None,
+         lambda: patterns.is_skippable_line('a line of text')),
+        ('extract_comment_ids',
+         lambda: utils.unique(re.findall(old_comment_id, body)),
+         lambda: patterns.extract_comment_ids(body, subreddit)),
+        ('wiki_link_pattern',
+         lambda: re.compile("\\* \\[%s\\]\\(%s\\) \\(\\d+\\)" % (
+             re.escape(title), re.escape(url))),
+         lambda: patterns.wiki_link_pattern(title, url)),
+    ]
+
+    messages, templates = base_config.messages, base_config.templates
+    suffix = messages['append_to_all_messages']
+    bot_comment = templates.render('too_little_text', 'someone')
+
+    def old_matches(string, message_key, *args):
+        for message in messages[message_key]:
+            if string == (message % args) + suffix:
+                return True
+        return False
+    cases += [
+        ('render_message',
+         lambda: (choice(messages['confirmation']) + suffix) % ('a', 'b', 'a'),
+         lambda: templates.render('confirmation', 'a', 'b', 'a')),
+        ('string_matches',
+         lambda: old_matches(bot_comment, 'too_little_text', 'someone'),
+         lambda: templates.matches(bot_comment, 'too_little_text', 'someone')),
+        ('string_matches (miss)',
+         lambda: old_matches(bot_comment, 'confirmation', 'a', 'b', 'a'),
+         lambda: templates.matches(bot_comment, 'confirmation', 'a', 'b', 'a')),
+    ]
+
+    results = []
+    for name, old, new in cases:
+        results.append((name,
+                        timeit.Timer(old).timeit(number) / number,
+                        timeit.Timer(new).timeit(number) / number))
+    return results
+
+
+class WikiServer(ThreadingMixIn, HTTPServer):
+    """ Stands in for reddit's wiki pages: serves pages[name] at
+    /r/sub/wiki/<name>.json, gzipped, with an ETag, and answers 304 when the
+    ETag sent is still current. Counts the bytes it sends and the
+    connections it accepts. """
+    daemon_threads = True
+
+    def __init__(self):
+        self.pages = {}
+        self.sent = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with server.lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                name = self.path.rsplit('/', 1)[-1][:-len('.json')]
+                body = server.pages[name].encode('utf-8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    buffer = io.BytesIO()
+                    with gzip.GzipFile(fileobj=buffer, mode='wb') as out:
+                        out.write(body)
+                    body = buffer.getvalue()
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                # Counted before the client can have it
+                with server.lock:
+                    server.sent += len(body)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+
+
+def runhttp(base_config, iterations=20, users=50, awards=3, seed=0):
+    """ Fetch the pages an iteration reads (this month's scoreboard, the
+    delta_tracker and a few user pages) from a WikiServer, with the plain
+    requests Session PRAW uses and with transport.tune's adapter mounted on
+    it, while a few awards change some of them between iterations. Returns
+    (name, bytes per iteration, connections) for each. """
+    results = []
+    for name, tuned in (('plain', False), ('conditional', True)):
+        random = Random(seed)
+        server = WikiServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        names = ['user_%s' % n for n in range(users)]
+        server.pages['delta_tracker'] = "\n".join(
+            "* /u/%s -- [Delta List](/r/sub/wiki/user/%s)" % (user, user)
+            for user in names)
+        award = ("* [CMV: a view %s](http://www.reddit.com/r/sub/comments/"
+                 "%s/x/) (1)\n    1. [Awarded by /u/someone](http://www."
+                 "reddit.com/r/sub/comments/%s/x/%s?context=2) on 1/1/2015\n")
+        server.pages['scoreboard'] = ''
+        for user in names:
+            server.pages[user] = "/u/%s has received some deltas:\n\n" % user
+            for n in range(random.randint(1, 30)):
+                server.pages[user] += award % ((random.random(),) * 4)
+        session = requests.Session()
+        if tuned:
+            adapter = transport.ConditionalAdapter(
+                transport.pool_size(base_config))
+            session.mount('http://', adapter)
+        base = 'http://127.0.0.1:%s/r/sub/wiki/' % server.server_port
+        try:
+            for iteration in range(iterations):
+                awardees = [random.choice(names) for n in range(awards)]
+                for user in awardees:
+                    server.pages[user] += award % ((random.random(),) * 4)
+                    server.pages['scoreboard'] += "## %s 1\n* %s" % (
+                        user, award.split('\n')[0])
+                for page in ['scoreboard', 'delta_tracker'] + [
+                        random.choice(names) for n in range(awards * 2)]:
+                    session.get(base + page + '.json').content
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+        results.append((name, server.sent / float(iterations),
+                        server.connections))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('scenarios', nargs='*', default=sorted(SCENARIOS),
+                        metavar='scenario', help="one of %s (default: all)" %
+                             ", ".join(sorted(SCENARIOS)))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to every mock API call")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--micro', action='store_true',
+                        help="time the regex parsers and templates instead")
+    parser.add_argument('--http', action='store_true',
+                        help="measure bytes per iteration fetching wiki "
+                             "pages from a local server instead")
+    parser.add_argument('--soak', type=int, metavar='COMMENTS',
+                        help="run this many comments through the bot and "
+                             "report its memory use instead")
+    parser.add_argument('--stats', action='store_true',
+                        help="time the statistics over a year of history "
+                             "instead")
+    parser.add_argument('--replay', metavar='FILE',
+                        help="run a capture file instead of the scenarios")
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help="replay at this multiple of real time "
+                             "(default: as fast as possible)")
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario %s" % scenario)
+
+    logging.basicConfig(level=logging.WARNING)
+    base_config = config.Config(os.getcwd() + '/config/config.json')
+    if args.micro:
+        print("%-20s %12s %12s" % ("parser", "inline (ns)", "patterns (ns)"))
+        for name, old, new in micro(base_config):
+            print("%-20s %12.0f %12.0f" % (name, old * 1e9, new * 1e9))
+        return
+    if args.soak:
+        print("%10s %10s %12s %12s" % ("comments", "RSS (MB)", "caches (KB)",
+                                       "evicted (KB)"))
+        for done, rss, caches, evicted in runsoak(base_config, args.soak,
+                                                  seed=args.seed):
+            print("%10d %10.1f %12.1f %12.1f" % (
+                done, (rss or 0) / 2.0 ** 20, caches / 1024.0,
+                evicted / 1024.0))
+        return
+    if args.stats:
+        if not analytics.has_numpy():
+            parser.error("--stats needs NumPy")
+        print("%10s %10s %10s %10s" % ("decisions", "load (s)", "report (s)",
+                                       "render (s)"))
+        print("%10d %10.3f %10.3f %10.3f" % runstats(seed=args.seed))
+        return
+    if args.http:
+        print("%-12s %14s %12s" % ("session", "bytes/iter", "connections"))
+        for name, sent, connections in runhttp(base_config, seed=args.seed):
+            print("%-12s %14.0f %12d" % (name, sent, connections))
+        return
+
+    print("%-16s %8s %6s %8s %10s %9s %9s %9s" % (
+        "scenario", "comments", "deltas", "seconds", "comments/s",
+        "calls/dlt", "p50 (s)", "p99 (s)"))
+    if args.replay:
+        runs = [lambda: runreplay(args.replay, base_config, args.speed)]
+    else:
+        runs = [lambda scenario=scenario: runbench(scenario, base_config,
+                                                   args.latency, args.seed)
+                for scenario in args.scenarios]
+    for run in runs:
+        result = run()
+        print("%(scenario)-16s %(comments)8d %(deltas)6d %(seconds)8.2f "
+              "%(throughput)10.1f %(calls_per_delta)9.1f %(p50)9.4f "
+              "%(p99)9.4f" % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+""" Capture of the traffic DeltaBot reads from reddit.
+
+With capture_filename set in the config, every read the bot makes (new
+comments, the inbox, info lookups, wiki pages, flair, moderators and the
+sidebar) is appended to that file as one JSON record per line, for
+replay.py to feed back through the bot offline.
+"""
+import json
+import time
+import threading
+
+import patterns
+
+
+# Calls whose results are recorded. Everything else passes straight through.
+RECORDED_CALLS = frozenset(['get_comments', 'get_unread', 'get_info',
+                            'get_wiki_page', 'get_flair', 'get_flair_list',
+                            'get_moderators', 'get_settings'])
+
+
+def link_id(comment):
+    """ The fullname of comment's submission. Comment replies in the inbox
+    have no link_id, only a context link into the submission. """
+    name = getattr(comment, 'link_id', None)
+    if name is None:
+        submission = patterns.context_submission_id(
+                         getattr(comment, 'context', None) or '')
+        name = submission and 't3_' + submission
+    return name
+
+
+def dump_thing(thing):
+    """ Returns a JSON-able dict for a PRAW object, without triggering any
+    lazy loads (and so any extra API calls) on it """
+    if thing is None:
+        return None
+    if isinstance(thing, (list, tuple)):
+        return [dump_thing(t) for t in thing]
+    if isinstance(thing, dict):
+        return dict((k, str(v) if k == 'user' else v)
+                    for k, v in thing.items())
+    if hasattr(thing, 'content_md'):
+        return {'page': thing.page, 'content_md': thing.content_md}
+    name = getattr(thing, 'name', '')
+    if not (name[:1] == 't' and name[2:3] == '_'):
+        # Redditors (e.g. moderators) only need their name
+        return str(name or thing)
+    author = getattr(thing, 'author', None)
+    record = {'name': name, 'author': str(author) if author else None}
+    if name.startswith('t1_'):
+        record.update(body=thing.body,
+                      parent_id=thing.parent_id,
+                      link_id=link_id(thing),
+                      link_title=getattr(thing, 'link_title', ''),
+                      link_author=getattr(thing, 'link_author', None),
+                      created=thing.created_utc,
+                      was_comment=getattr(thing, 'was_comment', False))
+    elif name.startswith('t3_'):
+        record.update(title=thing.title, permalink=thing.permalink)
+    elif name.startswith('t4_'):
+        record.update(subject=thing.subject, body=thing.body)
+    return record
+
+
+class Recorder(object):
+    """ Wraps a PRAW session and appends the result of every read to a
+    capture file. Listings are read in full before they are returned, so the
+    whole batch ends up in one record. The inbox and command threads read
+    at once, so the file is written under a lock, shared with the
+    subreddit's recorder. """
+
+    def __init__(self, wrapped, capture_file, started=None, lock=None):
+        self._wrapped = wrapped
+        self._file = capture_file
+        self._started = started if started is not None else time.time()
+        self._lock = lock or threading.Lock()
+
+    def _record(self, call, key, result):
+        line = json.dumps({'t': round(time.time() - self._started, 3),
+                           'call': call, 'key': key,
+                           'result': dump_thing(result)},
+                          separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def get_subreddit(self, *args, **kwargs):
+        return Recorder(self._wrapped.get_subreddit(*args, **kwargs),
+                        self._file, self._started, self._lock)
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name not in RECORDED_CALLS:
+            return attr
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if name in ('get_comments', 'get_unread', 'get_flair_list',
+                        'get_moderators'):
+                result = list(result)
+            key = kwargs.get('thing_id') or kwargs.get('page')
+            if key is None and args:
+                key = str(args[-1])
+            self._record(name, key, result)
+            return result
+        return call
+
+
+def open_capture(filename):
+    """ Open filename for appending captured traffic to """
+    return open(filename, 'a')
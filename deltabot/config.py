@@ -1,20 +1,154 @@
+import re
 import json
 import os
+import logging
+
+import templates
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# Keys every config needs, and the type their value must have
+REQUIRED = {
+    'subreddit': str,
+    'account': dict,
+    'sleep_time': (int, float),
+    'messages': dict,
+    'tokens': list,
+    'flair': dict,
+    'last_comment_filename': str,
+    'minimum_comment_length': int,
+    'scoreboard': dict,
+}
+REQUIRED_MESSAGES = ('append_to_all_messages', 'confirmation',
+                     'already_awarded', 'too_little_text', 'broken_rule')
+
+try:
+    string_types = (str, unicode)
+except NameError: # Python 3
+    string_types = (str,)
+
+
+class derived(object):
+    """ A value worked out from the config the first time it is needed and
+    then kept as a plain attribute, until the config is reloaded """
+
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = function.__doc__
+
+    def __get__(self, config, owner):
+        if config is None:
+            return self
+        value = config.__dict__[self.function.__name__] = self.function(config)
+        return value
+
 
 # This object holds the configuration options for the bot,
 # except that the first layer of keys are attributes, not dict keys
 class Config(object):
 
     def __init__(self, configFile):
+        self.filename = None
+        self.mtime = None
         if isinstance(configFile, dict):
-            self.attrs = configFile
+            attrs = configFile
         elif os.path.isfile(configFile):
-            self.attrs = json.load(open(configFile))
+            self.filename = configFile
+            self.mtime = os.path.getmtime(configFile)
+            with open(configFile) as config_file:
+                attrs = json.load(config_file)
         else:
-            self.attrs = json.loads(configFile)
+            attrs = json.loads(configFile)
+        self.load(attrs)
+
+    def load(self, attrs):
+        """ Validate attrs and make them the current settings """
+        validate(attrs)
+        for name in list(self.__dict__):
+            if name not in ('filename', 'mtime'):
+                del self.__dict__[name]
+        self.__dict__.update(attrs)
+        self.attrs = attrs
+
+    def reload(self):
+        """ Reread the config file if it has changed since it was loaded.
+        Returns True if the new settings were taken up. A file that fails to
+        parse or validate is logged and the current settings are kept. """
+        if not self.filename:
+            return False
+        try:
+            mtime = os.path.getmtime(self.filename)
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            with open(self.filename) as config_file:
+                self.load(json.load(config_file))
+        except (IOError, OSError, ValueError) as e:
+            logging.error("Not reloading %s: %s" % (self.filename, e))
+            return False
+        logging.info("Reloaded %s" % self.filename)
+        return True
 
     def __getattr__(self, name):
-        return self.attrs.get(name)
+        # Only reached for keys that are not in the config
+        return None
 
     def __getitem__(self, name):
         return self.attrs.get(name)
+
+    @derived
+    def bot_name(self):
+        """ The bot's username, lowercased for comparisons """
+        return self.account['username'].lower()
+
+    @derived
+    def token_pattern(self):
+        """ Matches any of the tokens """
+        return re.compile('|'.join(re.escape(token) for token in
+                                   sorted(self.tokens, key=len, reverse=True)))
+
+    @derived
+    def minimum_length(self):
+        """ How long a comment has to be to award a delta: the longest token
+        plus minimum_comment_length """
+        return (max(len(token) for token in self.tokens) +
+                self.minimum_comment_length)
+
+    @derived
+    def rendered_messages(self):
+        """ Every message template with append_to_all_messages already on the
+        end, by message key """
+        suffix = self.messages['append_to_all_messages']
+        return dict((key, [message + suffix for message in messages])
+                    for key, messages in self.messages.items()
+                    if key != 'append_to_all_messages')
+
+    @derived
+    def templates(self):
+        """ The messages split up for rendering and matching, see
+        templates.py """
+        return templates.Templates(self.messages)
+
+
+def validate(attrs):
+    """ Raise ConfigError if attrs is missing anything the bot needs """
+    for key, types in REQUIRED.items():
+        if key not in attrs:
+            raise ConfigError("%s is missing" % key)
+        if types is str:
+            types = string_types
+        if not isinstance(attrs[key], types):
+            raise ConfigError("%s has the wrong type" % key)
+    if 'username' not in attrs['account']:
+        raise ConfigError("account.username is missing")
+    if not attrs['tokens']:
+        raise ConfigError("tokens is empty")
+    for key in REQUIRED_MESSAGES:
+        if key not in attrs['messages']:
+            raise ConfigError("messages.%s is missing" % key)
+    for key in ('point_text', 'css_class'):
+        if key not in attrs['flair']:
+            raise ConfigError("flair.%s is missing" % key)
@@ -26,38 +26,93 @@ from __future__ import print_function
 
 import re
 import os
-import sys
 import time
-import praw
 import logging
 import calendar
 import datetime
-import traceback
 import collections
-from random import choice
 
-
-try:
-    from HTMLParser import HTMLParser
-except ImportError: # Python 3
-    from html.parser import HTMLParser
+import edits
+import lease
+import query
+import analytics
+import utils
+import memory
+import reddit
+import metrics
+import patterns
+import messages
+import reconcile
+import replies
+import retry
 
 
 logging.getLogger('requests').setLevel(logging.WARNING)
 
 
+def thread_pool(size):
+    # multiprocessing is only loaded once a pass has work to spread out
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(size)
+
+
 class DeltaBot(object):
     def __init__(self, config, test=False, test_reddit=None,
                 test_recent=None):
         self.config = config
         self.reddit = reddit.Reddit(config, test, test_reddit, test_recent)
-        self.messages = messages.Messages(config)
+        self.messages = messages.Messages(config, self.reddit)
+        self.reconciler = reconcile.Reconciler(self.reddit, config)
+        self.edits = edits.EditWatch(config)
+        self.history = analytics.History(config)
+        # Without a lease this bot is the only one, and always leads
+        self.lease = None
+        if self.config.lease_filename:
+            self.lease = lease.Lease(self.config.lease_filename,
+                                     self.config.lease_holder,
+                                     self.config.lease_duration or 30)
+            self.reddit.fence = self.lease.fence
+        self.leader = self.lease is None
+        # A standby's leaderboard is empty until it takes over
+        self.query = query.Query(
+                         lambda: self.reddit.leaderboard if self.leader else None)
+        # Everything the bot remembers between passes shares the budget
+        self.budget = memory.Budget()
+        self.budget.register('replies', self.messages.replies)
+        self.budget.register('edits', self.edits)
+        self.budget.register('reconcile', self.reconciler)
+        self.budget.register('query', self.query)
+        if self.reddit.adapter is not None:
+            self.budget.register('http', self.reddit.adapter)
+        self.watchdog = memory.Watchdog(config, self.budget)
+        self.inbox_pool = None
+        self.command_pool = None
+        # Inbox item fullname -> how many times handling it has failed
+        self.inbox_attempts = {}
         if self.reddit.most_recent_comment_id:
-            self.messages.scanned_comments.append(most_recent_comment_id)
+            self.messages.scanned_comments.append(
+                self.reddit.most_recent_comment_id)
         logging.info("Logged in as %s" % self.config.account['username'])
+        if self.config.metrics_port:
+            metrics.registry.serve(self.config.metrics_port)
+        if self.config.query_port:
+            self.query.serve(self.config.query_port)
+
+    def __getattr__(self, name):
+        # The comment rules live in Messages; expose them on the bot too
+        if name == 'messages':
+            raise AttributeError(name)
+        return getattr(self.messages, name)
 
     # Wrapper function to keep side effects out of scan_comments
-    def scan_comment_wrapper(self, comment, strict=True):
+    @metrics.timed('scan_comment')
+    def scan_comment_wrapper(self, comment, strict=True, last_scanned=None):
+        if strict:
+            log = self.messages.prefilter(comment, last_scanned)
+            if log:
+                logging.debug("%s: %s" % (comment.name, log))
+                return
+
         parent = self.reddit.get_info(thing_id=comment.parent_id)
 
         log, message, awardee = self.messages.scan_comment(comment, parent,
@@ -67,60 +122,217 @@ class DeltaBot(object):
                                                   strict)
         logging.info(log)
 
-        if message:
-            comment.reply(message).distinguish()
-
         if awardee:
-            self.reddit.award_points(awardee, comment)
+            self.award(awardee, comment, self.respond, comment, parent, log,
+                       message)
+        elif message:
+            self.respond(comment, parent, log, message)
+
+
+    def respond(self, comment, parent, log, message):
+        """ Answer the delta in comment, a reply to parent, with message,
+        and note the decision in the history """
+        self.reddit.fence()
+        reply = self.messages.reply(comment, message)
+        reply.distinguish()
+        if log == messages.TOO_SHORT:
+            self.edits.watch(comment, reply)
+        self.history.record(comment, parent, message)
+
+
+    def close(self):
+        """ Shut down the worker threads, close the award journal, reply
+        index and history, and give up the lease """
+        for pool in (self.inbox_pool, self.command_pool):
+            if pool is not None:
+                pool.terminate()
+        self.inbox_pool = self.command_pool = None
+        self.reddit.journal.close()
+        self.messages.replies.close()
+        self.history.close()
+        if self.lease is not None:
+            self.lease.release()
+            self.lease.close()
+
+
+    def command_map(self, function, items):
+        """ map() over the command pool """
+        if len(items) < 2 or (self.config.command_threads or 1) < 2:
+            return [function(item) for item in items]
+        if self.command_pool is None:
+            self.command_pool = thread_pool(self.config.command_threads)
+        return self.command_pool.map(function, items)
+
+
+    def confirm(self, begun, answer, *args):
+        """ Call answer(*args) to confirm the awards begun (see
+        Reddit.begin_awards). If it fails before the confirmation is posted
+        they are dropped, so they aren't paid unconfirmed and then again
+        when the command is retried. """
+        try:
+            answer(*args)
+        except Exception:
+            self.reddit.withdraw_awards(
+                [award for award in begun if
+                 not self.messages.replies.confirmed(award.comment_name)])
+            raise
+
+
+    def award(self, awardee, comment, answer, *args):
+        """ Award the delta in comment to awardee, confirmed by
+        answer(*args). It is journaled before it is confirmed, so a crash
+        after the confirmation can't leave it unpaid. """
+        begun = self.reddit.begin_awards([(awardee, comment)])
+        self.confirm(begun, answer, *args)
+        self.reddit.finish_awards(begun)
 
 
     def command_add(self, message_body, strict):
-        ids = re.findall(self.messages.comment_id_regex, message_body)
-        for id in ids:
-            comment = self.reddit.get_info(thing_id='t1_%s' % id)
-            if type(comment) is praw.objects.Comment:
-                self.messages.scan_comment_wrapper(comment, strict=strict)
+        """ Scan every comment linked in message_body and award the deltas
+        that pass. All comments and parents are looked up in batches, the
+        rules are checked in parallel and the awards are applied in one
+        flush, even if answering one of the links fails. Returns a report
+        with a line per link. """
+        ids = patterns.extract_comment_ids(message_body, self.config.subreddit)
+        comments = self.reddit.get_info_batch(['t1_%s' % id for id in ids])
+        parents = self.reddit.get_info_batch(
+                      utils.unique(c.parent_id for c in comments.values()))
+
+        def check(comment):
+            start = time.time()
+            if comment.parent_id not in parents:
+                return ("No points awarded, parent is deleted", None, None,
+                        time.time() - start)
+            log, message, awardee = self.messages.scan_comment(
+                comment, parents[comment.parent_id],
+                self.messages.already_replied,
+                self.messages.is_parent_commenter_author,
+                self.messages.points_already_awarded_to_ancestor,
+                strict)
+            return log, message, awardee, time.time() - start
+
+        found = [comments['t1_%s' % id] for id in ids if 't1_%s' % id in comments]
+        results = dict(zip([c.name for c in found],
+                           self.command_map(check, found)))
+
+        report = []
+        awards = []
+        awarded = set()
+        try:
+            for id in ids:
+                comment = comments.get('t1_%s' % id)
+                if comment is None:
+                    report.append("* %s: comment not found" % id)
+                    continue
+                log, message, awardee, seconds = results[comment.name]
+                # The checks ran side by side, so they could not see each
+                # other's confirmations. Recheck a second delta to the same
+                # user in the same submission now that the first one has
+                # been replied to.
+                key = (getattr(comment, 'link_id', None), awardee)
+                if awardee and strict and key in awarded:
+                    log, message, awardee, more = check(comment)
+                    seconds += more
+                begun = []
+                if awardee:
+                    # Journaled before it is confirmed, so a reply that
+                    # fails further on can't leave it confirmed but unpaid
+                    awarded.add(key)
+                    begun = self.reddit.begin_awards([(awardee, comment)])
+                if message:
+                    self.confirm(begun, self.respond, comment,
+                                 parents[comment.parent_id], log, message)
+                awards += begun
+                if awardee:
+                    log = "Delta awarded to %s" % awardee
+                logging.info("add %s: %s (%.3fs)" % (id, log, seconds))
+                report.append("* %s: %s" % (comment.permalink, log))
+        finally:
+            self.reddit.finish_awards(awards)
+        return report
 
 
     def scan_message(self, message):
+        """ Run the command in message if a moderator sent it, unless it has
+        already been run, from the inbox or from mod mail """
         logging.info("Scanning message %s from %s" % (message.name,
                                                       message.author))
-        if self.messages.is_moderator(message.author.name):
-            command = message.subject.lower()
-            if command == "force add":
-                self.reddit.send_message("/r/" + self.config.subreddit,
-                                         "Force Add Detected",
-                                         "The Force Add command has been used "
-                                         "on the following link(s):\n\n" + \
-                                         message.body)
-            if command == "add" or command == "force add":
-                strict = (command != "force add")
-                self.command_add(message.body, strict)
-                self.reddit.send_message(message.author,
-                                         "Add complete",
-                                         "The add command has been "
-                                         "completed on: " + message.body)
-
-            elif command == "remove":
-                # Todo
-                pass
-
-            elif command == "rescan":
-                self.rescan_comments(message.body)
-
-            elif command == "reset":
-                self.messages.scanned_comments.clear()
-
-            elif command == "stop":
-                self.reddit.send_message("/r/" + self.config.subreddit,
-                                         "Stop Message Confirmed",
-                                         "NOTICE: The stop message has been "
-                                         "issued and I have stopped running.")
-                logging.warning("The stop command has been issued. If this was "
-                                "not sent by you, please check as to why before"
-                                " restarting.")
-                message.mark_as_read()
-                os._exit(1)
+        if not self.messages.is_moderator(message.author.name):
+            return
+        if not self.reddit.mod_mail.claim(message.name):
+            logging.info("%s has already been handled" % message.name)
+            return
+        try:
+            self.run_command(message)
+        except Exception:
+            self.reddit.mod_mail.release(message.name)
+            raise
+
+
+    def run_command(self, message):
+        command = message.subject.lower()
+        if command == "force add":
+            self.reddit.send_message("/r/" + self.config.subreddit,
+                                     "Force Add Detected",
+                                     "The Force Add command has been used "
+                                     "on the following link(s):\n\n" + \
+                                     message.body)
+        if command == "add" or command == "force add":
+            strict = (command != "force add")
+            report = self.command_add(message.body, strict)
+            self.reddit.send_message(message.author,
+                                     "Add complete",
+                                     "The add command has been "
+                                     "completed:\n\n" + "\n".join(report))
+
+        elif command == "remove":
+            # Todo
+            pass
+
+        elif command == "rescan":
+            report = self.rescan_comments(message.body)
+            self.reddit.send_message(message.author,
+                                     "Rescan complete",
+                                     "The rescan command has been "
+                                     "completed:\n\n" + "\n".join(report))
+
+        elif command == "reset":
+            self.messages.scanned_comments.clear()
+
+        elif command == "stats":
+            self.reddit.send_message(message.author, "Stats complete",
+                                     self.command_stats())
+
+        elif command == "stop":
+            self.reddit.send_message("/r/" + self.config.subreddit,
+                                     "Stop Message Confirmed",
+                                     "NOTICE: The stop message has been "
+                                     "issued and I have stopped running.")
+            logging.warning("The stop command has been issued. If this was "
+                            "not sent by you, please check as to why before"
+                            " restarting.")
+            message.mark_as_read()
+            os._exit(1)
+
+
+    def command_stats(self):
+        """ Write the statistics of the last stats_days days to the
+        stats_page wiki page (see analytics.py). Returns what to tell the
+        moderator who asked. """
+        if not analytics.has_numpy():
+            return "The statistics need NumPy, which isn't installed."
+        if not self.config.history_filename:
+            return "No history is kept, so there are no statistics."
+        since = (time.time() - self.config.stats_days * analytics.DAY
+                 if self.config.stats_days else None)
+        stats = analytics.report(analytics.load(self.config.history_filename),
+                                 since)
+        self.reddit.edit_wiki_page(self.config.subreddit,
+                                   self.config.stats_page,
+                                   analytics.render(stats),
+                                   "Updating delta statistics")
+        return "The statistics are on /r/%s/wiki/%s" % (
+                   self.config.subreddit, self.config.stats_page)
 
 
     def get_most_recent_comment(self):
@@ -128,7 +340,7 @@ class DeltaBot(object):
         so we know where to begin the next scan"""
         most_recent_comment_id = None
         while self.messages.scanned_comments:
-            comment = self.reddit.reddit.get_info(thing_id=self.scanned_comments[-1])
+            comment = self.reddit.get_info(thing_id=self.messages.scanned_comments[-1])
             if comment.body == '[deleted]':
                 self.messages.scanned_comments.pop()
             else:
@@ -138,8 +350,9 @@ class DeltaBot(object):
         return most_recent_comment_id
 
 
-    def rescan_comment(self, bots_comment, orig_comment, awardees_comment):
-        """Rescan comments that were too short"""
+    def rescan_check(self, bots_comment, orig_comment, awardees_comment):
+        """ Returns who to award if a comment that was too short now passes,
+        otherwise None """
         awardee = awardees_comment.author.name
 
         if (self.messages.string_matches_message(bots_comment.body, 'too_little_text',
@@ -147,11 +360,27 @@ class DeltaBot(object):
                 and not self.messages.is_comment_too_short(orig_comment)
                 and not self.messages.is_parent_commenter_author(orig_comment, awardees_comment)
                 and not self.messages.points_already_awarded_to_ancestor(orig_comment, awardees_comment)):
-            self.reddit.award_points(awardee, orig_comment)
-            message = self.messages.get_message('confirmation') % (
-                          awardee, self.config.subreddit, awardee
-                          )
-            bots_comment.edit(message).distinguish()
+            return awardee
+        return None
+
+    def confirm_rescan(self, bots_comment, awardee, orig_comment,
+                       awardees_comment):
+        message = self.messages.render_message('confirmation', awardee,
+                                               self.config.subreddit, awardee)
+        self.reddit.fence()
+        edited = bots_comment.edit(message)
+        self.messages.replies.add(bots_comment.parent_id, bots_comment.name,
+                                  'confirmation')
+        edited.distinguish()
+        self.edits.forget(bots_comment.parent_id)
+        self.history.record(orig_comment, awardees_comment, message)
+
+    def rescan_comment(self, bots_comment, orig_comment, awardees_comment):
+        """Rescan comments that were too short"""
+        awardee = self.rescan_check(bots_comment, orig_comment, awardees_comment)
+        if awardee:
+            self.award(awardee, orig_comment, self.confirm_rescan,
+                       bots_comment, awardee, orig_comment, awardees_comment)
 
     # Keeps side effects out of rescan_comment to make testing easier
     def rescan_comment_wrapper(self, bots_comment):
@@ -161,11 +390,109 @@ class DeltaBot(object):
         self.rescan_comment(bots_comment, orig_comment, awardees_comment)
 
     def rescan_comments(self, message_body):
-        ids = re.findall(self.messages.comment_id_regex, message_body)
-        for id in ids:
-            comment = self.reddit.get_info(thing_id='t1_%s' % id)
-            if type(comment) is praw.objects.Comment:
-                self.rescan_comment_wrapper(comment)
+        """ Rescan every one of the bot's comments linked in message_body,
+        looking them and their ancestors up in batches, checking them in
+        parallel and applying the awards in one flush. Returns a report with a
+        line per link. """
+        ids = patterns.extract_comment_ids(message_body, self.config.subreddit)
+        bots_comments = self.reddit.get_info_batch(['t1_%s' % id for id in ids])
+        origs = self.reddit.get_info_batch(
+                    utils.unique(c.parent_id for c in bots_comments.values()))
+        awardees = self.reddit.get_info_batch(
+                       utils.unique(c.parent_id for c in origs.values()))
+
+        def check(bots_comment):
+            start = time.time()
+            orig_comment = origs.get(bots_comment.parent_id)
+            awardees_comment = orig_comment and awardees.get(orig_comment.parent_id)
+            if awardees_comment is None:
+                return None, time.time() - start
+            return (self.rescan_check(bots_comment, orig_comment, awardees_comment),
+                    time.time() - start)
+
+        found = [bots_comments['t1_%s' % id] for id in ids
+                 if 't1_%s' % id in bots_comments]
+        results = dict(zip([c.name for c in found],
+                           self.command_map(check, found)))
+
+        report = []
+        awards = []
+        try:
+            for id in ids:
+                bots_comment = bots_comments.get('t1_%s' % id)
+                if bots_comment is None:
+                    report.append("* %s: comment not found" % id)
+                    continue
+                awardee, seconds = results[bots_comment.name]
+                if awardee:
+                    orig_comment = origs[bots_comment.parent_id]
+                    # Journaled before it is confirmed, as in command_add
+                    begun = self.reddit.begin_awards([(awardee,
+                                                       orig_comment)])
+                    self.confirm(begun, self.confirm_rescan, bots_comment,
+                                 awardee, orig_comment,
+                                 awardees[orig_comment.parent_id])
+                    awards += begun
+                    log = "Delta awarded to %s" % awardee
+                else:
+                    log = "Nothing to award"
+                logging.info("rescan %s: %s (%.3fs)" % (id, log, seconds))
+                report.append("* %s: %s" % (bots_comment.permalink, log))
+        finally:
+            self.reddit.finish_awards(awards)
+        return report
+
+
+    @metrics.timed('rescan_edits')
+    def rescan_edits(self):
+        """ Look up the comments watched for edits (see edits.py) in batches
+        and rescan the ones whose body has changed, applying the awards in
+        one flush """
+        names = self.edits.due()
+        if not names:
+            return
+        comments = self.reddit.get_info_batch(names)
+        for name in names:
+            if name not in comments or comments[name].body == '[deleted]':
+                self.edits.forget(name)
+        edited = self.edits.edited(comments.values())
+        metrics.count('rescan_edits.edited', len(edited))
+        if not edited:
+            return
+
+        # The bot's replies and the comments the deltas were for
+        others = self.reddit.get_info_batch(
+                     [self.edits.reply_to(c.name) for c in edited] +
+                     utils.unique(c.parent_id for c in edited))
+        awards = []
+        try:
+            for orig_comment in edited:
+                bots_comment = others.get(self.edits.reply_to(orig_comment.name))
+                awardees_comment = others.get(orig_comment.parent_id)
+                if (bots_comment is None or awardees_comment is None or
+                        not self.messages.string_matches_message(
+                            bots_comment.body, 'too_little_text',
+                            awardees_comment.author.name)):
+                    # Deleted, or already dealt with some other way
+                    self.edits.forget(orig_comment.name)
+                    continue
+                awardee = self.rescan_check(bots_comment, orig_comment,
+                                            awardees_comment)
+                if awardee:
+                    logging.info("Edited delta %s awarded to %s" % (
+                                     orig_comment.name, awardee))
+                    # Journaled before it is confirmed, as in command_add
+                    begun = self.reddit.begin_awards([(awardee,
+                                                       orig_comment)])
+                    try:
+                        self.confirm(begun, self.confirm_rescan, bots_comment,
+                                     awardee, orig_comment, awardees_comment)
+                    except Exception:
+                        self.edits.recheck(orig_comment.name)
+                        raise
+                    awards += begun
+        finally:
+            self.reddit.finish_awards(awards)
 
 
     def scan_comment_reply(self, comment):
@@ -182,24 +509,231 @@ class DeltaBot(object):
             self.rescan_comment_wrapper(bots_comment)
 
 
+    @metrics.timed('scan_inbox')
     def scan_inbox(self):
-        """ Scan a given list of messages for commands. If no list arg,
-        then get newest comments from the inbox. """
+        """ Scan unread comment replies and messages in the inbox. Items are
+        grouped by the thread they belong to; threads are handled in parallel
+        but the items of one thread stay in order. Everything handled is
+        marked read in one call at the end. """
         logging.info("Scanning inbox")
 
-        messages = self.reddit.get_unread(unset_has_mail=True)
-
-        for message in messages:
-            if type(message) == praw.objects.Comment:
-                self.messages.scan_comment_reply(message)
-            elif type(message) == praw.objects.Message:
+        threads = collections.OrderedDict()
+        for item in self.reddit.get_unread(unset_has_mail=True, limit=None):
+            threads.setdefault(utils.thread_key(item), []).append(item)
+
+        if len(threads) > 1 and (self.config.inbox_threads or 1) > 1:
+            if self.inbox_pool is None:
+                self.inbox_pool = thread_pool(self.config.inbox_threads)
+            handled = self.inbox_pool.map(self.scan_inbox_thread,
+                                          threads.values())
+        else:
+            handled = [self.scan_inbox_thread(items)
+                       for items in threads.values()]
+
+        self.reddit.mark_as_read([item for items in handled for item in items])
+
+
+    def scan_inbox_thread(self, items):
+        """ Handle the inbox items of one thread in order and return the ones
+        that were handled. If one fails for a passing reason the rest of the
+        thread is left unread so it is retried, in order, on the next pass.
+        One that fails for good (a 403, a deleted parent), or that has failed
+        inbox_attempts times, is given up on and marked read, so it doesn't
+        hold up its thread for ever. """
+        handled = []
+        for item in items:
+            try:
+                if item.was_comment:
+                    self.scan_comment_reply(item)
+                else:
+                    self.scan_message(item)
+            except Exception as e:
+                attempts = self.inbox_attempts.get(item.name, 0) + 1
+                if (attempts < (self.config.inbox_attempts or 5) and
+                        (retry.is_transient(e) or
+                         isinstance(e, (retry.CircuitOpen, lease.LeaseLost)))):
+                    self.inbox_attempts[item.name] = attempts
+                    logging.exception("Failed to handle %s, leaving the rest "
+                                      "of its thread for the next pass" %
+                                      item.name)
+                    break
+                self.inbox_attempts.pop(item.name, None)
+                metrics.count('scan_inbox.given_up')
+                logging.exception("Giving up on %s after %s attempts" % (
+                                      item.name, attempts))
+            else:
+                self.inbox_attempts.pop(item.name, None)
+            handled.append(item)
+        return handled
+
+
+    @metrics.timed('scan_comments')
+    def scan_comments(self):
+        """ Scan new comments in the subreddit for tokens. If a token is
+        found, award points. """
+        logging.info("Scanning new comments")
+        # Comments up to here were scanned in an earlier pass, even if
+        # get_most_recent_comment() has to go further back
+        last_scanned = (self.messages.scanned_comments[-1]
+                        if self.messages.scanned_comments else None)
+
+        fresh_comments = self.reddit.subreddit.get_comments(
+                             params={'before': self.get_most_recent_comment()},
+                             limit=None)
+
+        # A long backlog doesn't hold up moderators' commands
+        interval = self.config.command_poll_interval
+        poll_at = time.time() + (interval or 0)
+        for comment in fresh_comments:
+            self.scan_comment_wrapper(comment, last_scanned=last_scanned)
+            if (not self.messages.scanned_comments
+                    or replies.id_key(comment.name) >
+                       replies.id_key(self.messages.scanned_comments[-1])):
+                self.messages.scanned_comments.append(comment.name)
+            if interval and time.time() >= poll_at:
+                self.poll_commands()
+                poll_at = time.time() + interval
+        logging.info("Prefilter: %s" % metrics.registry.pass_rates(
+                         'prefilter', messages.PREFILTER_STAGES))
+
+
+    @metrics.timed('scan_mod_mail')
+    def scan_mod_mail(self):
+        """ Run the commands sent to the subreddit's mod mail since the last
+        pass, oldest first. The cursor moves past each message once it is
+        handled, so one that fails is tried again on the next pass, along
+        with the ones after it. """
+        if not self.config.mod_mail_limit:
+            return
+        mod_mail = self.reddit.mod_mail
+        for message in mod_mail.new_messages(self.reddit.get_mod_mail()):
+            if (message.author is not None and
+                    message.author.name != self.config.account['username']):
                 self.scan_message(message)
+            mod_mail.advance(message.name)
+
+
+    def poll_commands(self):
+        """ Run new mod mail commands in the middle of a comment scan. A
+        failure is left for the next pass rather than ending the scan. """
+        try:
+            self.scan_mod_mail()
+        except lease.LeaseLost:
+            raise
+        except Exception:
+            logging.exception("Couldn't read mod mail during the scan")
+
+
+    def update_scoreboard(self):
+        if self.reddit.changes_made:
+            self.reddit.update_scoreboard()
+
+
+    def reconcile(self):
+        if self.config.reconcile_budget:
+            self.reconciler.run(self.config.reconcile_budget)
+
+
+    def refresh_replies(self):
+        """ Index the bot's comments posted since the last pass """
+        self.messages.replies.refresh(self.reddit.get_bot_comments())
+
+
+    def hold_lease(self):
+        """ Take or renew the lease, taking over or stepping down if that
+        changes which bot leads. Returns True if this one does. """
+        try:
+            token = self.lease.acquire()
+        except Exception:
+            # Unless the lease can be renewed, another bot may be leading
+            logging.exception("Couldn't renew the lease")
+            token = None
+        if token is not None and not self.leader:
+            self.take_over()
+        elif token is None and self.leader:
+            self.step_down()
+        return self.leader
+
+
+    def take_over(self):
+        """ Start leading from where the last leader stopped: its journal,
+        leaderboard and last scanned comment """
+        logging.warning("Taking over as the leader")
+        self.reddit.open_shared_state()
+        self.messages.scanned_comments.clear()
+        saved_id = utils.read_saved_id(self.config.last_comment_filename)
+        if saved_id:
+            self.messages.scanned_comments.append(saved_id)
+        self.leader = True
+
+
+    def step_down(self):
+        logging.warning("Lost the lease, standing by")
+        self.leader = False
+        self.reddit.close_shared_state()
+
+
+    def standby_stages(self):
+        """ What a standby does each pass: read what the leader writes, so
+        its caches are warm when it takes over """
+        return (self.refresh_replies, self.reddit.get_moderator_names)
+
+
+    def iteration_stages(self):
+        # Commands come before the comments, which can take a while
+        return (self.reddit.resume_awards, self.refresh_replies,
+                self.scan_mod_mail, self.scan_inbox,
+                self.scan_comments, self.rescan_edits,
+                self.reddit.roll_over_months, self.update_scoreboard,
+                self.reconcile)
+
+
+    def iterate(self):
+        """ Run one pass over the inbox, mod mail and new comments, then save
+        the most recently scanned comment. Returns False if any part of the
+        pass failed. """
+        old_comment_id = self.messages.scanned_comments[-1] if self.messages.scanned_comments else None
+        logging.info("Starting iteration at %s" % old_comment_id or "None")
+        self.config.reload()
+
+        if self.lease is not None and not self.hold_lease():
+            stages = self.standby_stages()
+        else:
+            stages = self.iteration_stages()
+
+        # Each stage keeps what it got done if a later one fails
+        failed = False
+        for stage in stages:
+            try:
+                if self.leader:
+                    self.reddit.fence()
+                stage()
+            except lease.LeaseLost:
+                logging.exception("Taken over during %s" % stage.__name__)
+                self.step_down()
+                failed = True
+                break
+            except Exception:
+                logging.exception("%s failed, going on with the rest of the "
+                                  "iteration" % stage.__name__)
+                failed = True
 
-            message.mark_as_read()
-
+        if (self.leader and self.messages.scanned_comments and
+                old_comment_id is not self.messages.scanned_comments[-1]):
+            try:
+                self.reddit.fence()
+                utils.write_saved_id(self.config.last_comment_filename,
+                               self.messages.scanned_comments[-1])
+            except lease.LeaseLost:
+                self.step_down()
 
-    def scan_mod_mail(self):
-        pass
+        logging.info("Iteration complete at %s" % (self.messages.scanned_comments[-1] if
+                                                   self.messages.scanned_comments else "None"))
+        self.watchdog.check()
+        logging.info(metrics.registry.end_iteration())
+        if self.config.metrics_filename:
+            metrics.registry.write_prometheus(self.config.metrics_filename)
+        return not failed
 
 
     def go(self):
@@ -207,32 +741,34 @@ class DeltaBot(object):
         self.running = True
         reset_counter = 0
         while self.running:
-            old_comment_id = self.messages.scanned_comments[-1] if self.messages.scanned_comments else None
-            logging.info("Starting iteration at %s" % old_comment_id or "None")
-
-            try:
-                self.scan_inbox()
-                self.scan_mod_mail()
-                self.messages.scan_comments()
-                if reddit.changes_made:
-                    self.reddit.update_scoreboard()
-            except:
-                print ("Exception in user code:")
-                print ('-'*60)
-                traceback.print_exc(file=sys.stdout)
-                print ('-'*60)
-
-            if self.messages.scanned_comments and old_comment_id is not self.messages.scanned_comments[-1]:
-                utils.write_saved_id(self.config.last_comment_filename,
-                               self.messages.scanned_comments[-1])
-
-            logging.info("Iteration complete at %s" % (self.messages.scanned_comments[-1] if
-                                                       self.messages.scanned_comments else "None"))
+            succeeded = self.iterate()
             reset_counter = reset_counter + 1
             print ("Reset Counter at %s." % reset_counter)
             print ("When this reaches 10, the script will clear its history.")
             if reset_counter == 10:
               self.messages.scanned_comments.clear()
               reset_counter = 0
-            logging.info("Sleeping for %s seconds" % self.config.sleep_time)
-            time.sleep(self.config.sleep_time)
+            sleep_time = self.config.sleep_time
+            if not succeeded:
+                # Pick up what failed as soon as reddit is likely to be back
+                sleep_time = min(sleep_time,
+                                 self.reddit.retry_policy.max_delay)
+            logging.info("Sleeping for %s seconds" % sleep_time)
+            self.sleep(sleep_time)
+
+
+    def sleep(self, seconds):
+        """ Sleep between passes. With a lease, wake every third of
+        lease_duration: a leader renews it, and a standby takes over as soon
+        as it has expired. """
+        if self.lease is None:
+            time.sleep(seconds)
+            return
+        interval = (self.config.lease_duration or 30) / 3.0
+        end = time.time() + seconds
+        while time.time() < end:
+            time.sleep(max(0, min(interval, end - time.time())))
+            was_leader = self.leader
+            if self.hold_lease() and not was_leader:
+                # Start leading now rather than at the end of the sleep
+                return
@@ -0,0 +1,97 @@
+""" Comments turned down as too short, watched for edits.
+
+A delta that was too short to award used to be looked at again only when
+its author replied to the bot. Now each one is remembered with a hash of
+its body, and every edit_rescan_interval seconds they are all looked up
+again, a hundred to an info call. The ones whose body has changed are run
+through the rules again. Comments stop being watched once they are awarded,
+deleted, or older than edit_watch_window seconds, or when the memory budget
+(see memory.py) runs short.
+"""
+import time
+import hashlib
+import threading
+import collections
+
+import memory
+
+
+def body_digest(body):
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+class EditWatch(object):
+    def __init__(self, config, clock=time.time):
+        self.config = config
+        self.clock = clock
+        # comment fullname -> [body digest, bot's reply fullname, since],
+        # oldest first
+        self.watched = collections.OrderedDict()
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def watch(self, comment, reply):
+        """ Watch comment, which the bot turned down with reply """
+        if not self.config.edit_watch_window:
+            return
+        with self.lock:
+            self.watched[comment.name] = [body_digest(comment.body),
+                                          reply.name, self.clock()]
+
+    def forget(self, name):
+        with self.lock:
+            self.watched.pop(name, None)
+
+    def recheck(self, name):
+        """ Rescan a watched comment next time even if it isn't edited
+        again, after answering its edit failed """
+        with self.lock:
+            entry = self.watched.get(name)
+            if entry is not None:
+                entry[0] = None
+
+    def reply_to(self, name):
+        """ The fullname of the bot's reply to a watched comment """
+        return self.watched[name][1]
+
+    def due(self):
+        """ The watched comments, if edit_rescan_interval has passed since
+        they were last checked. Comments watched for longer than
+        edit_watch_window are dropped. """
+        now = self.clock()
+        with self.lock:
+            if (self.checked_at is not None and now - self.checked_at <
+                    (self.config.edit_rescan_interval or 0)):
+                return []
+            self.checked_at = now
+            window = self.config.edit_watch_window or 0
+            while self.watched:
+                name, (digest, reply, since) = next(iter(self.watched.items()))
+                if now - since <= window:
+                    break
+                del self.watched[name]
+            return list(self.watched)
+
+    def memory_size(self):
+        with self.lock:
+            return memory.estimate(self.watched)
+
+    def evict(self, size):
+        """ Stop watching the comments watched longest """
+        with self.lock:
+            return memory.evict_first(self.watched, size)
+
+    def edited(self, comments):
+        """ Of comments, looked up again, the ones whose body has changed
+        since it was last seen """
+        edited = []
+        with self.lock:
+            for comment in comments:
+                entry = self.watched.get(comment.name)
+                if entry is None:
+                    continue
+                digest = body_digest(comment.body)
+                if digest != entry[0]:
+                    entry[0] = digest
+                    edited.append(comment)
+        return edited
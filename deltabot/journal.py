@@ -0,0 +1,149 @@
+""" Write-ahead journal of awards, so a half-applied award gets finished.
+
+An award is three writes to reddit: the awardee's flair, the month's
+scoreboard and their wiki page. Each award is journaled before the first of
+them, and each step is marked done as it completes, one JSON record per line,
+flushed and synced to disk. Awards still in the journal are finished at the
+start of the next iteration, by this process or, after a crash, the next one.
+
+Resuming a step must not apply it twice. The scoreboard and wiki steps check
+whether the comment is already listed. Flair only holds a number, so the
+flair read before it is set is journaled first: if the flair already reads
+that plus the awards, the write went through before the step was marked.
+"""
+import os
+import json
+import logging
+import collections
+
+
+STEPS = ('flair', 'scoreboard', 'wiki')
+
+
+class Award(object):
+    def __init__(self, id, awardee, comment_name, comment=None):
+        self.id = id
+        self.awardee = awardee
+        self.comment_name = comment_name
+        # Only known in the process that made the award; looked up again
+        # when resuming after a restart
+        self.comment = comment
+        self.done = set()
+        # What the awardee's flair read before it was set for this award
+        self.flair_start = None
+
+
+class Journal(object):
+    """ The awards not yet fully applied. With no filename nothing is
+    written to disk, but failed awards are still retried. """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.pending = collections.OrderedDict()
+        self.next_id = 1
+        self.file = None
+        if filename:
+            self.load()
+
+    def load(self):
+        """ Read back the awards a previous run left unfinished, and start
+        the file over with just those """
+        if os.path.exists(self.filename):
+            with open(self.filename) as journal_file:
+                for line in journal_file:
+                    try:
+                        self.replay(json.loads(line))
+                    except ValueError:
+                        # The last record of a crash can be half written
+                        logging.warning("Skipping a broken journal record")
+        if self.pending:
+            logging.warning("%s unfinished awards in %s" % (
+                                len(self.pending), self.filename))
+
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as journal_file:
+            for award in self.pending.values():
+                for record in self.records(award):
+                    journal_file.write(json.dumps(record) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.rename(temp_filename, self.filename)
+        self.file = open(self.filename, 'a')
+
+    def replay(self, record):
+        if 'begin' in record:
+            award = Award(record['begin'], record['awardee'], record['comment'])
+            self.pending[award.id] = award
+            self.next_id = max(self.next_id, award.id + 1)
+            return
+        for id in record['ids']:
+            award = self.pending.get(id)
+            if award is None:
+                continue
+            if 'flair_start' in record:
+                award.flair_start = record['flair_start']
+            if 'done' in record:
+                award.done.add(record['done'])
+                if award.done.issuperset(STEPS):
+                    del self.pending[id]
+
+    def records(self, award):
+        """ The records that bring a fresh journal up to award's state """
+        yield {'begin': award.id, 'awardee': award.awardee,
+               'comment': award.comment_name}
+        if award.flair_start is not None:
+            yield {'ids': [award.id], 'flair_start': award.flair_start}
+        for step in sorted(award.done):
+            yield {'ids': [award.id], 'done': step}
+
+    def write(self, *records):
+        """ Append records and sync them to disk """
+        if self.file is None:
+            return
+        for record in records:
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def begin(self, awards):
+        """ Journal (awardee, comment) awards. Returns them as Awards. """
+        begun = []
+        for awardee, comment in awards:
+            award = Award(self.next_id, str(awardee), comment.name, comment)
+            self.next_id += 1
+            self.pending[award.id] = award
+            begun.append(award)
+        self.write(*[{'begin': award.id, 'awardee': award.awardee,
+                      'comment': award.comment_name} for award in begun])
+        return begun
+
+    def start_flair(self, awards, points):
+        """ Record that the awardee's flair read points just before it is
+        set for awards """
+        for award in awards:
+            award.flair_start = points
+        self.write({'ids': [award.id for award in awards],
+                    'flair_start': points})
+
+    def done(self, awards, step):
+        """ Mark step done for awards, forgetting the ones that are
+        complete. The file is emptied whenever nothing is pending. """
+        self.write({'ids': [award.id for award in awards], 'done': step})
+        for award in awards:
+            award.done.add(step)
+            if award.done.issuperset(STEPS):
+                self.pending.pop(award.id, None)
+        if not self.pending and self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def abandon(self, award):
+        """ Give up on an award that can't be finished """
+        for step in STEPS:
+            if step not in award.done:
+                self.done([award], step)
@@ -0,0 +1,245 @@
+""" Running delta totals by month, by year and of all time.
+
+The only record of who earned what used to be the scoreboard_YEAR_MONTH
+wiki pages, so anything longer than a month meant reading and parsing all of
+them. The Leaderboard keeps the totals instead, added to as each award goes
+onto its month's scoreboard, and kept in a small JSON file.
+
+A month is open until it is rolled over: its awards are listed (by the same
+link as on its scoreboard page) so one that is added again after an
+interruption isn't counted twice. A month the Leaderboard hasn't seen before
+is started from its scoreboard page, and the months before the first one are
+read from theirs once, from config.leaderboard_start on. Rolling a month over freezes it: its
+list of awards is dropped and it only lives on in its year's and the
+all-time totals, which were kept up to date along with it.
+
+Each user's points by month and the awards in each submission (by the
+submission id in the award's link) are kept too, and outlive the rollover,
+so a user's history or a thread's deltas can be answered without reading a
+wiki page (see query.py). So is the delta count each user's flair was last
+set to, which unlike the totals goes back before leaderboard_start.
+
+The ranked lists are sorted once after a change, so reading a leaderboard
+between awards is a lookup.
+"""
+import os
+import json
+import logging
+import threading
+
+import patterns
+
+
+# The period of the all-time totals
+ALL_TIME = 'all'
+
+
+def month_key(year, month):
+    """ As in the scoreboard page titles """
+    return "%s_%s" % (year, month)
+
+
+def parse_month(key):
+    year, month = key.split('_')
+    return int(year), int(month)
+
+
+class Leaderboard(object):
+    """ Kept in filename, or only in memory if there is none """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # month key -> {'scores': {user: points}, 'links': set([...])}
+        self.open = {}
+        # Month keys rolled over, oldest first
+        self.closed = []
+        # year -> {user: points}, with the open months in them
+        self.years = {}
+        self.all_time = {}
+        # user -> {month key: points}, closed months included
+        self.history = {}
+        # submission id -> {user: points}
+        self.submissions = {}
+        # user -> delta count their flair was last set to, or read as
+        self.flair = {}
+        # Set once the months before the Leaderboard was started have been
+        # read from their scoreboard pages
+        self.backfilled = False
+        # period -> [(user, points)], highest first, and period -> {user:
+        # place}; dropped on change
+        self.ranked = {}
+        self.ranks = {}
+        # Counts changes, so copies of what was read can tell they are stale
+        self.version = 0
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename) as leaderboard_file:
+                    state = json.load(leaderboard_file)
+                self.open = state['open']
+                for entry in self.open.values():
+                    entry['links'] = set(entry['links'])
+                self.closed = state['closed']
+                self.years = state['years']
+                self.all_time = state['all_time']
+                self.backfilled = state.get('backfilled', False)
+                self.flair = state.get('flair', {})
+                if 'history' in state:
+                    self.history = state['history']
+                    self.submissions = state['submissions']
+                else:
+                    # Saved before they were kept: the history starts with
+                    # the open months, and submissions with the next award
+                    for month, entry in self.open.items():
+                        for user, points in entry['scores'].items():
+                            self.history.setdefault(user, {})[month] = points
+            except (ValueError, KeyError) as e:
+                logging.warning("Ignoring %s: %s" % (filename, e))
+
+    def save(self):
+        if not self.filename:
+            return
+        with self.lock:
+            state = {'open': dict((month, {'scores': entry['scores'],
+                                           'links': sorted(entry['links'])})
+                                  for month, entry in self.open.items()),
+                     'closed': self.closed,
+                     'years': self.years, 'all_time': self.all_time,
+                     'history': self.history,
+                     'submissions': self.submissions,
+                     'flair': self.flair,
+                     'backfilled': self.backfilled}
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as leaderboard_file:
+                json.dump(state, leaderboard_file)
+            os.rename(temp_filename, self.filename)
+
+    def knows(self, month):
+        return month in self.open or month in self.closed
+
+    def changed(self, month, user, points):
+        """ Add points to user's year, all-time and monthly totals """
+        year = str(parse_month(month)[0])
+        totals = self.years.setdefault(year, {})
+        totals[user] = totals.get(user, 0) + points
+        self.all_time[user] = self.all_time.get(user, 0) + points
+        months = self.history.setdefault(user, {})
+        months[month] = months.get(month, 0) + points
+        for period in (month, year, ALL_TIME):
+            self.ranked.pop(period, None)
+            self.ranks.pop(period, None)
+        self.version += 1
+
+    def count_submission(self, link, user, points=1):
+        """ Add points to user's awards in the submission link is in """
+        submission = patterns.submission_id(link)
+        if submission is not None:
+            awards = self.submissions.setdefault(submission, {})
+            awards[user] = awards.get(user, 0) + points
+
+    def set_flair(self, user, points):
+        """ Note that user's flair says points deltas """
+        with self.lock:
+            if self.flair.get(user) != points:
+                self.flair[user] = points
+                self.version += 1
+
+    def flair_count(self, user):
+        """ The delta count user's flair was last seen with, or None """
+        with self.lock:
+            return self.flair.get(user)
+
+    def start_month(self, month, scoreboard):
+        """ Open month with what its scoreboard page (as read by
+        markdown_to_scoreboard) already lists """
+        with self.lock:
+            if month in self.open or month in self.closed:
+                return
+            entry = self.open[month] = {'scores': {}, 'links': set()}
+            for user, value in scoreboard.items():
+                entry['scores'][user] = value['score']
+                entry['links'].update(value['links'])
+                self.changed(month, user, value['score'])
+                for link in value['links']:
+                    self.count_submission(link, user)
+
+    def add(self, month, user, link, points=1):
+        """ Count an award listed on month's scoreboard as link. Returns
+        False if it was counted before. """
+        with self.lock:
+            entry = self.open.get(month)
+            if entry is None:
+                # A late award for a month already rolled over can't be
+                # told from one counted before; it goes into the totals
+                logging.info("Award to %s for %s, which is closed" % (
+                                    user, month))
+            elif link in entry['links']:
+                return False
+            else:
+                entry['links'].add(link)
+                entry['scores'][user] = entry['scores'].get(user, 0) + points
+            self.changed(month, user, points)
+            self.count_submission(link, user, points)
+            return True
+
+    def scores(self, period):
+        """ {user: points} for a month key, a year or ALL_TIME. A closed
+        month's totals are gone. """
+        period = str(period)
+        if period == ALL_TIME:
+            return self.all_time
+        if period in self.open:
+            return self.open[period]['scores']
+        return self.years.get(period, {})
+
+    def ranking(self, period):
+        """ Every [(user, points)] of period, highest first. Called with the
+        lock held. """
+        if period not in self.ranked:
+            self.ranked[period] = sorted(self.scores(period).items(),
+                                         key=lambda item: (-item[1], item[0]))
+        return self.ranked[period]
+
+    def top(self, period, n=10):
+        """ The n highest [(user, points)] of period """
+        with self.lock:
+            return self.ranking(str(period))[:n]
+
+    def rank(self, user, period=ALL_TIME):
+        """ user's place in period, from 1, or None if they have no points
+        in it """
+        period = str(period)
+        with self.lock:
+            if period not in self.ranks:
+                self.ranks[period] = dict(
+                    (name, place) for place, (name, points) in
+                    enumerate(self.ranking(period), 1))
+            return self.ranks[period].get(user)
+
+    def months(self, user):
+        """ user's [(month key, points)], oldest first """
+        with self.lock:
+            return sorted(self.history.get(user, {}).items(),
+                          key=lambda item: parse_month(item[0]))
+
+    def awards_in(self, submission):
+        """ [(user, points)] awarded in the submission with id submission,
+        most first """
+        with self.lock:
+            return sorted(self.submissions.get(submission, {}).items(),
+                          key=lambda item: (-item[1], item[0]))
+
+    def due(self, year, month):
+        """ The open months before year, month, oldest first """
+        return sorted((key for key in self.open
+                       if parse_month(key) < (year, month)), key=parse_month)
+
+    def close_month(self, month):
+        """ Freeze month; its points stay in the year and all-time totals """
+        with self.lock:
+            if self.open.pop(month, None) is not None:
+                self.closed.append(month)
+                self.ranked.pop(month, None)
+                self.ranks.pop(month, None)
+                self.version += 1
+        self.save()
@@ -0,0 +1,127 @@
+""" A lease on being the bot that acts, for running a standby.
+
+Two bots can share a lease_filename, an SQLite database on storage both can
+reach. Whichever holds the lease is the leader: it scans, replies and awards.
+The other is a standby and only reads, to keep its caches warm, until the
+lease runs out.
+
+The leader renews the lease before every stage of an iteration, before every
+award, before every write to reddit (a reply, an edit, a message, flair, a
+wiki page) and while it sleeps, each time for lease_duration seconds. A standby
+takes the lease over once it has expired, and every takeover hands out a
+higher fencing token. fence() renews the lease only if it still has the token
+it was given, so a leader that stalled past its lease (and was taken over), say
+in a long scan, finds out before it writes anything else, rather than
+replying and awarding alongside the new leader.
+
+The award journal, the leaderboard, the mod mail cursor and the last scanned
+comment are kept on the shared storage too, and opened by whichever bot takes over, so it picks
+up where the last leader stopped. The reply index and snapshot are caches, and
+each bot keeps its own.
+"""
+import os
+import time
+import socket
+import logging
+import threading
+
+import metrics
+
+
+# The one row of the lease table
+NAME = 'deltabot'
+
+
+class LeaseLost(Exception):
+    """ Raised by fence() once another bot has taken the lease over """
+
+
+def default_holder():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class Lease(object):
+    def __init__(self, filename, holder=None, duration=30, clock=time.time):
+        self.filename = filename
+        self.holder = holder or default_holder()
+        self.duration = duration
+        self.clock = clock
+        # The fencing token of the lease this bot holds, if it does
+        self.token = None
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            # Only a bot with a standby needs sqlite3 loaded
+            import sqlite3
+            # Autocommit, so the transactions below are the only ones
+            self.connection = sqlite3.connect(self.filename, timeout=10,
+                                              isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, "
+                "holder TEXT, token INTEGER, expires REAL)")
+        return self.connection
+
+    def acquire(self):
+        """ Take or renew the lease. Returns the fencing token it is held
+        with, or None if another bot holds it. """
+        with self.lock:
+            connection = self.connect()
+            now = self.clock()
+            # Locks the database until the commit, so two bots can't both
+            # see the lease expired and take it
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                          "SELECT holder, token, expires FROM lease "
+                          "WHERE name = ?", (NAME,)).fetchone()
+                if row is None:
+                    token = 1
+                elif (row[0] == self.holder and row[1] == self.token and
+                        row[2] > now):
+                    token = self.token
+                elif row[2] <= now:
+                    token = row[1] + 1
+                else:
+                    connection.execute("ROLLBACK")
+                    self.token = None
+                    return None
+                connection.execute(
+                    "INSERT OR REPLACE INTO lease (name, holder, token, "
+                    "expires) VALUES (?, ?, ?, ?)",
+                    (NAME, self.holder, token, now + self.duration))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            if token != self.token:
+                logging.warning("%s took the lease over with token %s" % (
+                                    self.holder, token))
+                metrics.count('lease.takeovers')
+            self.token = token
+            return token
+
+    def fence(self):
+        """ Renew the lease held now, or raise LeaseLost """
+        token = self.token
+        if token is None or self.acquire() != token:
+            metrics.count('lease.lost')
+            raise LeaseLost("%s no longer holds the lease with token %s" % (
+                                self.holder, token))
+
+    def release(self):
+        """ Let the lease expire now, so a standby needn't wait it out """
+        with self.lock:
+            if self.token is None:
+                return
+            self.connect().execute(
+                "UPDATE lease SET expires = 0 WHERE name = ? AND holder = ? "
+                "AND token = ?", (NAME, self.holder, self.token))
+            self.token = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
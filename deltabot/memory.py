@@ -0,0 +1,178 @@
+""" A memory budget for the bot's caches, and a watchdog for the main loop.
+
+go() runs for weeks in one process, so anything the bot remembers between
+passes has to stop growing somewhere. Every cache registers with the bot's
+Budget. It reports its approximate size in bytes, and when all of them
+together come to more than memory_budget megabytes, the largest are asked
+to evict their least useful entries until the total is back under it.
+
+The Watchdog runs at the end of every iteration. It enforces the budget and
+exports the process's resident size and each cache's size as gauges. With
+memory_trace_frames set, it also takes a tracemalloc snapshot and logs the
+memory_top_sites allocation sites that grew most since the last pass.
+tracemalloc slows every allocation down, so tracing is off by default.
+"""
+import os
+import sys
+import logging
+import itertools
+import threading
+import collections
+
+import metrics
+
+
+# Entries sampled to estimate the size of a cache's entries
+SAMPLES = 16
+# Bytes a dict or list spends on each entry, on top of the entry itself
+SLOT_SIZE = 100
+
+
+def deep_size(thing):
+    """ The size of thing and, if it is a tuple or list, its items """
+    size = sys.getsizeof(thing)
+    if isinstance(thing, (tuple, list)):
+        size += sum(deep_size(item) for item in thing)
+    return size
+
+
+def entry_size(entries):
+    """ The average size of a key and value of the mapping entries, from
+    the first few of them """
+    sample = list(itertools.islice(entries.items(), SAMPLES))
+    if not sample:
+        return 0
+    return SLOT_SIZE + sum(deep_size(key) + deep_size(value)
+                           for key, value in sample) // len(sample)
+
+
+def estimate(entries):
+    """ Roughly how many bytes the mapping entries takes up """
+    return sys.getsizeof(entries) + len(entries) * entry_size(entries)
+
+
+def evict_first(entries, size):
+    """ Drop the first entries of the mapping entries, the oldest if it is
+    ordered, until about size bytes are freed. Returns the bytes freed. """
+    per_entry = entry_size(entries)
+    if not per_entry:
+        return 0
+    count = min(len(entries), -(-size // per_entry))
+    for key in list(itertools.islice(entries, count)):
+        del entries[key]
+    return count * per_entry
+
+
+def resident_size():
+    """ The process's resident set size in bytes, or None if it can't be
+    read here """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # The peak rather than the current size; in bytes on macOS, KB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Budget(object):
+    """ Caches register with register(name, cache). A cache has a
+    memory_size() method returning its size in bytes and an evict(size)
+    method that frees about size bytes of it and returns how many it
+    freed. """
+
+    def __init__(self, limit=None):
+        # In bytes; no limit if None
+        self.limit = limit
+        self.caches = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def register(self, name, cache):
+        with self.lock:
+            self.caches[name] = cache
+
+    def sizes(self):
+        with self.lock:
+            caches = list(self.caches.items())
+        return collections.OrderedDict((name, cache.memory_size())
+                                       for name, cache in caches)
+
+    def enforce(self):
+        """ Evict from the largest caches until they fit the limit. Returns
+        the bytes freed. """
+        if not self.limit:
+            return 0
+        sizes = self.sizes()
+        over = sum(sizes.values()) - self.limit
+        freed = 0
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            if over <= 0 or not size:
+                break
+            evicted = self.caches[name].evict(min(over, size))
+            logging.info("Evicted %s bytes from %s" % (evicted, name))
+            metrics.count('memory.evicted_bytes', evicted)
+            freed += evicted
+            over -= evicted
+        if over > 0:
+            logging.warning("Caches are still %s bytes over the memory "
+                            "budget" % over)
+        return freed
+
+
+class Watchdog(object):
+    def __init__(self, config, budget):
+        self.config = config
+        self.budget = budget
+        self.snapshot = None
+        self.tracemalloc = None
+        if config.memory_trace_frames:
+            try:
+                import tracemalloc
+            except ImportError:
+                logging.warning("memory_trace_frames needs tracemalloc "
+                                "(Python 3.4 or later)")
+            else:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(config.memory_trace_frames)
+                self.tracemalloc = tracemalloc
+
+    def check(self):
+        """ Enforce the budget and report memory use, at the end of an
+        iteration """
+        # Read every time, so a config reload can change it
+        self.budget.limit = int((self.config.memory_budget or 0) * 2 ** 20)
+        self.budget.enforce()
+        rss = resident_size()
+        if rss is not None:
+            metrics.registry.gauge('memory.rss_bytes', rss)
+        for name, size in self.budget.sizes().items():
+            metrics.registry.gauge('memory.cache_bytes.%s' % name, size)
+        if self.tracemalloc is not None:
+            self.trace()
+
+    def growth(self):
+        """ Take a snapshot and return the allocation sites that grew most
+        since the last one, as tracemalloc StatisticDiffs """
+        snapshot = self.tracemalloc.take_snapshot().filter_traces((
+            self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+            self.tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        previous, self.snapshot = self.snapshot, snapshot
+        if previous is None:
+            return []
+        stats = snapshot.compare_to(previous, 'lineno')
+        return [stat for stat in stats
+                if stat.size_diff > 0][:self.config.memory_top_sites or 10]
+
+    def trace(self):
+        current, peak = self.tracemalloc.get_traced_memory()
+        metrics.registry.gauge('memory.traced_bytes', current)
+        for stat in self.growth():
+            logging.info("Memory grew %+d bytes (%+d blocks) at %s" % (
+                             stat.size_diff, stat.count_diff,
+                             stat.traceback[0]))
@@ -1,6 +1,18 @@
-from itertools import izip, islice
+import logging
 import collections
-from . import utils
+from random import choice
+
+import metrics
+import replies
+import patterns
+
+
+# The checks scan_comments runs on every new comment before looking anything
+# up, cheapest first. Only the comments that pass them all cost an API call.
+PREFILTER_STAGES = ('processed', 'author', 'token')
+
+# Why a delta was turned down for being too short, see edits.py
+TOO_SHORT = "No points awarded, too short"
 
 
 def str_contains_token(text, tokens):
@@ -13,7 +25,7 @@ def str_contains_token(text, tokens):
             in_quote = False
         if in_quote:
             continue
-        if not skippable_line(line):
+        if not patterns.is_skippable_line(line):
             for token in tokens:
                 if token in line:
                     return True
@@ -22,34 +34,56 @@ def str_contains_token(text, tokens):
     return False
 
 class Messages(object):
-    def __init__(self, config):
+    def __init__(self, config, reddit=None):
         self.config = config
+        self.reddit = reddit
         self.scanned_comments = collections.deque([], 10)
-        self.comment_id_regex = '(?:http://)?(?:www\.)?reddit\.com/r(?:eddit)?/' + \
-                                self.config.subreddit + '/comments/[\d\w]+(?:/[^/]+)/?([\d\w]+)'
-        longest = 0
-        for token in self.config.tokens:
-            if len(token) > longest:
-                longest = len(token)
-        self.minimum_comment_length = longest + \
-                                      self.config.minimum_comment_length
+        self.replies = replies.ReplyIndex(config)
+
+    @property
+    def minimum_comment_length(self):
+        return self.config.minimum_length
 
 
     def get_message(self, message_key):
         """ Given a type of message select one of the messages from the
         configuration at random. """
-        messages = self.config.messages[message_key]
-        return choice(messages) + self.config.messages['append_to_all_messages']
+        return choice(self.config.rendered_messages[message_key])
+
+
+    def render_message(self, message_key, *args):
+        """ Like get_message, with the message filled in with args """
+        return self.config.templates.render(message_key, *args)
 
 
     def string_matches_message(self, string, message_key, *args):
-        messages = self.config.messages[message_key]
-        for message in messages:
-            appendation = self.config.messages['append_to_all_messages']
-            full_message = (message % args) + appendation
-            if string == full_message:
-                return True
-        return False
+        return self.config.templates.matches(string, message_key, *args)
+
+
+    def prefilter(self, comment, last_scanned=None):
+        """ Run the checks that need nothing but the comment itself. Returns
+        the log line for a comment that can be dropped as it is, or None if
+        it has to be scanned with its parent. last_scanned is the newest
+        comment scanned in an earlier pass. The comments reaching and passing
+        each stage are counted as prefilter.<stage>[.passed]. """
+        for stage in PREFILTER_STAGES:
+            metrics.count('prefilter.' + stage)
+            if stage == 'processed':
+                if last_scanned and (replies.id_key(comment.name) <=
+                                     replies.id_key(last_scanned)):
+                    return "No points awarded, already scanned"
+            elif stage == 'author':
+                if str(comment.author).lower() == self.config.bot_name:
+                    return "No points awarded, comment by DeltaBot"
+            elif stage == 'token':
+                # One search of the whole body rules out almost every
+                # comment before the line by line check for quotes
+                if (self.config.token_pattern.search(comment.body) is None or
+                        not str_contains_token(comment.body,
+                                               self.config.tokens)):
+                    return "No points awarded, comment does not contain Delta"
+            metrics.count('prefilter.%s.passed' % stage)
+        return None
 
 
     # Functions with side effects are passed in as arguments
@@ -70,8 +104,7 @@ class Messages(object):
 
         if str_contains_token(comment.body, self.config.tokens) or not strict:
             parent_author = str(parent.author.name).lower()
-            me = self.config.account['username'].lower()
-            if parent_author == me:
+            if parent_author == self.config.bot_name:
                 log = "No points awarded, replying to DeltaBot"
 
             elif check_already_replied(comment):
@@ -79,19 +112,19 @@ class Messages(object):
 
             elif strict and check_is_parent_commenter_author(comment, parent):
                 log = "No points awarded, parent is OP"
-                message = self.get_message('broken_rule')
+                message = self.render_message('broken_rule')
 
             elif strict and check_points_already_awarded_to_ancestor(comment, parent):
                 log = "No points awarded, already awarded"
-                message = self.get_message('already_awarded') % parent.author
+                message = self.render_message('already_awarded', parent.author)
 
-            elif strict and self.messages.is_comment_too_short(comment):
-                log = "No points awarded, too short"
-                message = self.get_message('too_little_text') % parent.author
+            elif strict and self.is_comment_too_short(comment):
+                log = TOO_SHORT
+                message = self.render_message('too_little_text', parent.author)
 
             else:
                 awardee = parent.author.name
-                message = self.get_message('confirmation') % (parent.author,
+                message = self.render_message('confirmation', parent.author,
                     self.config.subreddit, parent.author)
         else:
             log = "No points awarded, comment does not contain Delta"
@@ -99,38 +132,47 @@ class Messages(object):
         return (log, message, awardee)
 
 
-def scan_comments(self, fresh_comments):
-        """ Scan a given list of comments for tokens. If a token is found,
-        award points. """
-        logging.info("Scanning new comments")
+    def already_replied(self, comment, test=False):
+        """ Returns true if Deltabot has confirmed a delta in reply to
+        comment. Any other reply of the bot's is deleted, so the comment can
+        be answered again. Looked up in the reply index, not in the comment's
+        replies.
 
-#        fresh_comments = self.subreddit.get_comments(params={'before': self.get_most_recent_comment()},
-#                                                    limit=None)
+        Args:
+            comment: The comment whose replies are checked
+        """
+        reply = self.replies.get(comment.name)
+        if reply is None:
+            if not self.replies.covers(comment.name):
+                # Its entry may have been evicted
+                return self.confirmed_in_replies(comment)
+            return False
+        name, message_key = reply
+        if message_key == 'confirmation':
+            return True
+        reply = self.reddit.get_info(thing_id=name)
+        self.reddit.fence()
+        reply.delete()
+        self.replies.forget(comment.name)
+        return False
 
-        for comment in fresh_comments:
-            self.scan_comment_wrapper(comment)
-            if not self.scanned_comments or comment.name > self.scanned_comments[-1]:
-                self.scanned_comments.append(comment.name)
 
-    def already_replied(self, replies, test=False):
-        """ Returns true if Deltabot has replied in replies
+    def confirmed_in_replies(self, comment):
+        """ Returns true if one of comment's replies is the bot's
+        confirmation. Costs a request for the replies. """
+        for reply in comment.replies:
+            if (str(reply.author).lower() == self.config.bot_name and
+                    self.config.templates.match(reply.body)[0] == 'confirmation'):
+                return True
+        return False
 
-        Args:
-            me(str): Name of the account being used (get from config)
 
-            replies(list): List of the replies to a comment
-        """
-        message = self.get_message('confirmation')
-        for reply in replies:
-            author = str(reply.author).lower()
-            me = self.config.account['username'].lower()
-            if author == me:
-                if str(message)[0:15] in str(reply):
-                    return True
-                else:
-                    reply.delete()
-                    return False
-        return False
+    def reply(self, comment, message):
+        """ Post message in reply to comment and index it. Returns the
+        reply. """
+        reply = comment.reply(message)
+        self.replies.record(reply)
+        return reply
 
     def is_parent_commenter_author(self, comment, parent):
         """ Returns true if the author of the parent comment the submitter """
@@ -139,22 +181,18 @@ def scan_comments(self, fresh_comments):
         return comment_author == post_author
 
 
-    def points_awarded_to_children(self, awardee, comment, confirm_msg=None, me=None):
+    def points_awarded_to_children(self, awardee, comment):
         """ Returns True if the OP awarded a delta to this comment or any of its
         children, by looking for confirmation messages from this bot. """
 
-        if confirm_msg is None:
-            confirm_msg = (self.get_message('confirmation')
-                            % (awardee, self.config.subreddit, awardee))
-        if me is None:
-            me = self.config["account"]["username"]
-
-        # If this is a confirmation message, return True now
-        if comment.author == me and confirm_msg in comment.body:
-            return True
+        # If this is a confirmation message to awardee, return True now
+        if str(comment.author).lower() == self.config.bot_name:
+            message_key, args = self.config.templates.match(comment.body)
+            if message_key == 'confirmation' and args[0] == str(awardee):
+                return True
         # Otherwise, recurse
         for reply in comment.replies:
-            if self.points_awarded_to_children(awardee, reply, confirm_msg, me):
+            if self.points_awarded_to_children(awardee, reply):
                 return True
         return False
 
@@ -169,13 +207,11 @@ def scan_comments(self, fresh_comments):
         return self.points_awarded_to_children(awardee, root)
 
 
-    def messages.is_comment_too_short(self, comment):
+    def is_comment_too_short(self, comment):
         return len(comment.body) < self.minimum_comment_length
 
 
     def is_moderator(self, name):
-        moderators = self.reddit.get_moderators(self.config.subreddit)
-        mod_names = [mod.name for mod in moderators]
-        return name in mod_names
+        return name in self.reddit.get_moderator_names()
 
 
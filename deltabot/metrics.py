@@ -0,0 +1,214 @@
+import os
+import time
+import logging
+import threading
+import functools
+import contextlib
+import collections
+
+
+# How many recent timings are kept per stage to compute quantiles from
+SAMPLE_SIZE = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Metrics(object):
+    """ Timers and counters for the bot's hot paths.
+
+    Totals live for the whole process and are what gets exported; the
+    per-iteration figures are reset by end_iteration() so each pass of the
+    main loop can log its own summary.
+    """
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.totals = collections.defaultdict(float)
+        self.samples = {}
+        # Values that go up and down, like memory use; last one set wins
+        self.gauges = {}
+        self.iteration_counters = collections.Counter()
+        self.iteration_totals = collections.defaultdict(float)
+        self.iteration_started = time.time()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+            self.iteration_counters[name] += n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """ Record one timing of stage name. This also counts the call. """
+        with self.lock:
+            self.counters[name] += 1
+            self.iteration_counters[name] += 1
+            self.totals[name] += seconds
+            self.iteration_totals[name] += seconds
+            if name not in self.samples:
+                self.samples[name] = collections.deque([], self.sample_size)
+            self.samples[name].append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def timed(self, name):
+        """ Decorator that times every call of the function as stage name """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def quantile(self, name, q):
+        """ Returns the q-quantile of the recent timings of stage name, or
+        None if it has never been timed """
+        with self.lock:
+            samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    def _api_calls(self):
+        return sum(n for name, n in self.iteration_counters.items()
+                   if name.startswith('reddit.')
+                   or name.startswith('subreddit.'))
+
+    def api_calls(self):
+        """ Returns how many calls to reddit this iteration has made so far """
+        with self.lock:
+            return self._api_calls()
+
+    def end_iteration(self):
+        """ Returns a one line summary of the iteration that just finished
+        and starts a new one """
+        with self.lock:
+            elapsed = time.time() - self.iteration_started
+            stages = sorted(self.iteration_totals.items(),
+                            key=lambda item: item[1], reverse=True)
+            calls = self._api_calls()
+            summary = "Iteration took %.2fs, %s API calls: %s" % (
+                elapsed, calls,
+                ", ".join("%s %.3fs/%s" % (name, seconds,
+                                           self.iteration_counters[name])
+                          for name, seconds in stages))
+            self.iteration_counters.clear()
+            self.iteration_totals.clear()
+            self.iteration_started = time.time()
+        return summary
+
+    def pass_rates(self, prefix, stages):
+        """ Returns how many of the things reaching each of a pipeline's
+        stages passed it this iteration, e.g. "token 3/500 (0.6%)". Stages
+        are counted as prefix.stage and prefix.stage.passed. """
+        with self.lock:
+            rates = []
+            for stage in stages:
+                name = '%s.%s' % (prefix, stage)
+                seen = self.iteration_counters[name]
+                passed = self.iteration_counters[name + '.passed']
+                rates.append("%s %s/%s (%.1f%%)" % (
+                    stage, passed, seen, 100.0 * passed / seen if seen else 0))
+        return ", ".join(rates)
+
+    def to_prometheus(self):
+        """ Returns the totals in the Prometheus text exposition format """
+        lines = ["# TYPE deltabot_stage_seconds summary"]
+        for name in sorted(self.samples):
+            for q in QUANTILES:
+                lines.append('deltabot_stage_seconds{stage="%s",quantile="%s"} %f'
+                             % (name, q, self.quantile(name, q)))
+            lines.append('deltabot_stage_seconds_sum{stage="%s"} %f'
+                         % (name, self.totals[name]))
+            lines.append('deltabot_stage_seconds_count{stage="%s"} %d'
+                         % (name, self.counters[name]))
+        lines.append("# TYPE deltabot_events_total counter")
+        for name in sorted(self.counters):
+            if name not in self.samples:
+                lines.append('deltabot_events_total{event="%s"} %d'
+                             % (name, self.counters[name]))
+        if self.gauges:
+            lines.append("# TYPE deltabot_gauge gauge")
+        for name in sorted(self.gauges):
+            lines.append('deltabot_gauge{name="%s"} %f'
+                         % (name, self.gauges[name]))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename):
+        """ Write the totals to filename for the node exporter's textfile
+        collector. The file is replaced atomically so it is never read half
+        written. """
+        with open(filename + '.tmp', 'w') as prom_file:
+            prom_file.write(self.to_prometheus())
+        os.rename(filename + '.tmp', filename)
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Serve the totals over HTTP on a background thread """
+        # Only loaded when metrics_port is set
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        except ImportError: # Python 3
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info("Serving metrics on http://%s:%s/" % (host, port))
+        return server
+
+
+class Instrumented(object):
+    """ Wraps a PRAW object so that every method call on it is timed and
+    counted as <prefix>.<method>. Attributes that are not methods are passed
+    through untouched.
+
+    Note that calls returning lazy listings (get_comments, get_unread, ...)
+    are only timed up to the point the generator is created.
+    """
+
+    def __init__(self, wrapped, prefix, metrics=None):
+        self._wrapped = wrapped
+        self._prefix = prefix
+        self._metrics = metrics or registry
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if not callable(attr):
+            return attr
+        stage = "%s.%s" % (self._prefix, name)
+
+        def call(*args, **kwargs):
+            with self._metrics.timer(stage):
+                return attr(*args, **kwargs)
+        return call
+
+
+# The process wide registry everything reports to
+registry = Metrics()
+timer = registry.timer
+timed = registry.timed
+count = registry.count
@@ -0,0 +1,76 @@
+""" Moderator commands sent to the subreddit's mod mail.
+
+Moderators used to command the bot only by messaging its account, and the
+commands waited in the inbox behind everything else. Now the subreddit's mod
+mail is read too. Mod mail has no unread flag of the bot's own, so the newest
+mod mail message handled is kept as a cursor. Each pass reads the first
+mod_mail_limit conversations, most recently active first, and handles the
+messages in them that are newer than the cursor, oldest first. Mod mail from
+before the bot first read it is not run.
+
+A bot that moderates the subreddit gets its mod mail in the inbox as well, so
+a command can turn up both ways. Whichever way it comes, a command is claimed
+by its fullname before it runs, and the names of the last COMMANDS_KEPT
+commands are kept with the cursor, so none runs twice, even across a restart.
+"""
+import threading
+import collections
+
+import snapshot
+from replies import id_key
+
+
+# How many handled commands are remembered
+COMMANDS_KEPT = 200
+
+
+class ModMail(object):
+    """ Kept in filename, or only in memory if there is none """
+
+    def __init__(self, filename=None):
+        self.state = snapshot.Snapshot(filename)
+        # Fullnames of the commands handled, oldest first
+        self.handled = collections.deque(self.state.get('handled') or [],
+                                         COMMANDS_KEPT)
+        self.lock = threading.Lock()
+
+    @property
+    def cursor(self):
+        """ The fullname of the newest mod mail message handled; '' before
+        there was any mod mail, None before it was first read """
+        return self.state.get('cursor')
+
+    def advance(self, name):
+        self.state.set('cursor', name)
+
+    def claim(self, name):
+        """ Returns False if the command in message name has been handled """
+        with self.lock:
+            if name in self.handled:
+                return False
+            self.handled.append(name)
+            self.state.set('handled', list(self.handled))
+            return True
+
+    def release(self, name):
+        """ Let a command that failed be claimed again """
+        with self.lock:
+            if name in self.handled:
+                self.handled.remove(name)
+                self.state.set('handled', list(self.handled))
+
+    def new_messages(self, conversations):
+        """ The messages in conversations that are newer than the cursor,
+        oldest first """
+        messages = []
+        for conversation in conversations:
+            messages.append(conversation)
+            messages.extend(conversation.replies or [])
+        messages.sort(key=lambda message: id_key(message.name))
+        cursor = self.cursor
+        if cursor is None:
+            # Start from here rather than run old commands again
+            self.advance(messages[-1].name if messages else '')
+            return []
+        return [message for message in messages
+                if id_key(message.name) > id_key(cursor)]
@@ -0,0 +1,142 @@
+""" Every regular expression the bot uses, compiled once at import.
+
+The functions below are the only way the rest of the bot should parse
+flair, comment bodies, mod commands and wiki pages, so no pattern is ever
+recompiled (or looked up in re's cache) on a hot path.
+"""
+import re
+
+
+# The first number in a flair, e.g. the 12 in "12∆"
+FLAIR_COUNT = re.compile(r'\d+')
+
+# Quotes and code blocks, where tokens don't count
+SKIPPABLE_LINE = re.compile(r'^    |^ *&gt;')
+
+# "12 deltas" in the header of a user's wiki page
+WIKI_DELTA_COUNT = re.compile(r'([0-9]+) delta[s]?')
+
+# "(3)", the number of deltas earned by a submission's link on a wiki page.
+# Anchored so a number in brackets in the title is left alone.
+WIKI_LINK_COUNT = re.compile(r'\((\d+)\)$')
+
+# A submission's link on a user's wiki page, "* [title](url) (3)"
+WIKI_LINK_LINE = re.compile(r'\* \[.*\]\(.*\) \(\d+\)$')
+
+# One award listed under a link, capturing the comment's URL
+WIKI_AWARD = re.compile(r'    1\. \[Awarded by /u/[^\]]*\]\(([^)]*)\)')
+
+# A user on the delta_tracker page
+TRACKER_USER = re.compile(r'^\* /u/(\S+) -- \[Delta List\]', re.MULTILINE)
+
+# The submission id in the URL of a "[title](url)" link to a comment on a
+# scoreboard page
+SUBMISSION_ID = re.compile(r'\]\([^()\s]*/comments/([\d\w]+)[^()\s]*\)$')
+CONTEXT_SUBMISSION_ID = re.compile(r'/comments/([\d\w]+)/')
+
+COMMENT_ID = (r'(?:http://)?(?:www\.)?reddit\.com/r(?:eddit)?/%s'
+              r'/comments/[\d\w]+(?:/[^/]+)/?([\d\w]+)')
+
+_comment_id_patterns = {}
+_wiki_link_patterns = {}
+# Wiki link patterns are built per submission; keep the recent ones around
+WIKI_LINK_CACHE_SIZE = 256
+
+
+def parse_flair_count(flair_text):
+    """ Returns the first integer in flair_text (an int), or 0 if there is
+    none or there is no flair at all """
+    if not flair_text:
+        return 0
+    match = FLAIR_COUNT.search(flair_text)
+    return int(match.group()) if match else 0
+
+
+def is_skippable_line(line):
+    """ Returns True if line is part of a quote or code block """
+    return SKIPPABLE_LINE.match(line) is not None
+
+
+def comment_id_pattern(subreddit):
+    """ Returns the compiled pattern matching links to comments in subreddit,
+    capturing the comment id """
+    pattern = _comment_id_patterns.get(subreddit)
+    if pattern is None:
+        pattern = _comment_id_patterns[subreddit] = re.compile(
+            COMMENT_ID % re.escape(subreddit))
+    return pattern
+
+
+def extract_comment_ids(text, subreddit):
+    """ Returns the ids (a list of str, without the t1_ prefix) of every
+    comment in subreddit linked in text, each once and in order """
+    seen = set()
+    ids = []
+    for comment_id in comment_id_pattern(subreddit).findall(text):
+        if comment_id not in seen:
+            seen.add(comment_id)
+            ids.append(comment_id)
+    return ids
+
+
+def replace_wiki_delta_count(content, count_text):
+    """ Returns content with every "N deltas" replaced by count_text """
+    return WIKI_DELTA_COUNT.sub(lambda match: count_text, content)
+
+
+def wiki_link_pattern(submission_title, submission_url):
+    """ Returns the compiled pattern matching a correctly formatted link to
+    a submission on a user's wiki page, like "* [title](url) (3)" """
+    key = (submission_title, submission_url)
+    pattern = _wiki_link_patterns.get(key)
+    if pattern is None:
+        if len(_wiki_link_patterns) >= WIKI_LINK_CACHE_SIZE:
+            _wiki_link_patterns.clear()
+        pattern = _wiki_link_patterns[key] = re.compile(
+            r'\* \[%s\]\(%s\) \(\d+\)' % (re.escape(submission_title),
+                                         re.escape(submission_url)))
+    return pattern
+
+
+def parse_wiki_delta_count(content):
+    """ Returns the count in the "N deltas" header of a user's wiki page (an
+    int), or 0 if there is none """
+    match = WIKI_DELTA_COUNT.search(content)
+    return int(match.group(1)) if match else 0
+
+
+def wiki_award_urls(content):
+    """ Returns the comment URL of every award listed on a user's wiki
+    page """
+    return [match.group(1) for match in
+            (WIKI_AWARD.match(line) for line in content.split('\n')) if match]
+
+
+def tracker_users(content):
+    """ Returns every user listed on the delta_tracker page """
+    return TRACKER_USER.findall(content)
+
+
+def submission_id(link):
+    """ Returns the id of the submission a scoreboard link points into, or
+    None if it doesn't look like a comment's permalink """
+    match = SUBMISSION_ID.search(link)
+    return match.group(1) if match else None
+
+
+def context_submission_id(context):
+    """ Returns the id of the submission an inbox item's context link
+    points into, or None """
+    match = CONTEXT_SUBMISSION_ID.search(context)
+    return match.group(1) if match else None
+
+
+def set_wiki_link_count(link, count):
+    """ Returns a wiki link with its "(N)" count set to count """
+    return WIKI_LINK_COUNT.sub(lambda match: "(%s)" % count, link)
+
+
+def increment_wiki_link_count(link):
+    """ Returns a wiki link with its "(N)" count incremented """
+    return WIKI_LINK_COUNT.sub(
+        lambda match: "(%s)" % (int(match.group(1)) + 1), link)
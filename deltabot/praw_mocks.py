@@ -1,6 +1,8 @@
 
+import time
 import random
 import string
+import collections
 
 def reddit_id(length=6):
     """Emulate a reddit id with a random string of letters and digits"""
@@ -13,7 +15,7 @@ def reddit_id(length=6):
 # process_unread function.
 
 class Reddit(object):
-    def __init__(self):
+    def __init__(self, username='', latency=0.0, latencies=None):
         self._sent_message = False
         self._message_recipient = ''
         self._message_subject = ''
@@ -22,20 +24,87 @@ class Reddit(object):
         # verify if get_submission is working correctly.
         self._get_sub_comment = None
         self.info = dict()
+        # Name the bot's own replies are posted under
+        self.username = username
+        # Every call made through this session is counted here, and delayed
+        # by latencies[call] (or latency if it has no entry) seconds to
+        # emulate the network
+        self.calls = collections.Counter()
+        self.latency = latency
+        self.latencies = latencies or {}
+        # Replies get increasing ids, as on reddit, so they sort by age
+        self.replies_posted = 0
+        # Errors the next calls of each kind raise, in order
+        self.failures = collections.defaultdict(list)
+        self.unread = []
+        # Mod mail conversations: Messages with their replies
+        self.mod_mail = []
+        self.moderators = []
+        self.wiki = {}
+        self.subreddit = Subreddit(self)
+
+    def _call(self, name):
+        self.calls[name] += 1
+        delay = self.latencies.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+        if self.failures[name]:
+            raise self.failures[name].pop(0)
 
     def set_info(self, thing_id, value):
         self.info[thing_id] = value
 
     def get_info(self, thing_id):
+        self._call('get_info')
+        if isinstance(thing_id, list):
+            return [self.info[t] for t in thing_id if t in self.info]
         return self.info[thing_id]
 
-    def login(*args, **kwargs):
-        pass
+    def login(self, *args, **kwargs):
+        self._call('login')
+
+    def get_subreddit(self, *args, **kwargs):
+        self._call('get_subreddit')
+        return self.subreddit
+
+    def get_unread(self, *args, **kwargs):
+        self._call('get_unread')
+        return [m for m in self.unread if not m._read]
+
+    def _mark_as_read(self, thing_ids, unread=False):
+        self._call('mark_as_read')
+        for message in self.unread:
+            if message.name in thing_ids:
+                message._read = not unread
+                message._read_at = time.time()
+
+    def get_mod_mail(self, subreddit, limit=None):
+        """ The conversations, the one with the newest message first """
+        self._call('get_mod_mail')
+        def newest(conversation):
+            return max((len(m.id), m.id)
+                       for m in [conversation] + conversation.replies)
+        return sorted(self.mod_mail, key=newest, reverse=True)[:limit]
 
-    def get_subreddit(*args, **kwargs):
-        return Subreddit()
+    def get_redditor(self, name):
+        return Redditor(self, name)
+
+    def get_moderators(self, *args, **kwargs):
+        self._call('get_moderators')
+        return self.moderators
+
+    def get_wiki_page(self, subreddit, page):
+        self._call('get_wiki_page')
+        if page not in self.wiki:
+            raise HTTPException(404)
+        return WikiPage(page, self.wiki[page])
+
+    def edit_wiki_page(self, subreddit, page, content, reason=''):
+        self._call('edit_wiki_page')
+        self.wiki[page] = content
 
     def send_message(self, recipient, subject, text, **kwargs):
+        self._call('send_message')
         self._sent_message = True
         self._message_recipient = recipient
         self._message_subject = subject
@@ -47,9 +116,76 @@ class Reddit(object):
             s.comments.append(self._get_sub_comment)
         return s
 
+class Redditor(object):
+    def __init__(self, reddit_session, name):
+        self.reddit_session = reddit_session
+        self.name = name
+
+    def get_comments(self, sort='new', limit=None):
+        """ The redditor's comments in the session, newest first """
+        self.reddit_session._call('get_redditor_comments')
+        comments = sorted((thing for thing in self.reddit_session.info.values()
+                           if isinstance(thing, Comment)
+                           and str(thing.author) == self.name),
+                          key=lambda comment: comment.name, reverse=True)
+        return comments[:limit] if limit else comments
+
+class Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+class HTTPException(Exception):
+    """ What PRAW raises for an error status, with the response as _raw """
+    def __init__(self, status_code):
+        Exception.__init__(self, "HTTP %s" % status_code)
+        self._raw = Response(status_code)
+
 class Subreddit(object):
-    def __init__(self):
-        pass
+    def __init__(self, reddit_session=None):
+        self.reddit_session = reddit_session
+        # Newest comments are appended last
+        self.comments = []
+        self.flair = {}
+        self.settings = {'description': ''}
+
+    def _call(self, name):
+        if self.reddit_session is not None:
+            self.reddit_session._call(name)
+
+    def get_comments(self, params=None, limit=None):
+        """ Comments newer than params['before'], newest first """
+        self._call('get_comments')
+        before = (params or {}).get('before')
+        fresh = [c for c in self.comments if before is None or c.name > before]
+        fresh.reverse()
+        return fresh[:limit] if limit else fresh
+
+    def get_flair(self, redditor):
+        self._call('get_flair')
+        text, css_class = self.flair.get(str(redditor), (None, None))
+        return {'user': str(redditor), 'flair_text': text,
+                'flair_css_class': css_class}
+
+    def set_flair(self, redditor, text='', css_class=''):
+        self._call('set_flair')
+        self.flair[str(redditor)] = (text, css_class)
+
+    def get_flair_list(self, *args, **kwargs):
+        self._call('get_flair_list')
+        return [self.get_flair(user) for user in self.flair]
+
+    def get_settings(self):
+        self._call('get_settings')
+        return dict(self.settings)
+
+    def update_settings(self, **kwargs):
+        self._call('update_settings')
+        self.settings.update(kwargs)
+
+class WikiPage(object):
+    def __init__(self, page, content_md):
+        self.page = page
+        self.content_md = content_md
 
 class Repliable(object):
     def __init__(self, author=None, body='', reddit_session=None, replies=[]):
@@ -60,34 +196,74 @@ class Repliable(object):
         self.reddit_session = reddit_session
         self._replied_to = False
         self._reply_text = ''
+        self._replied_at = None
+        self._read = False
 
     def reply(self, text):
         self._replied_to = True
         self._reply_text = text
+        self._replied_at = time.time()
+        session = self.reddit_session
+        reply = Comment(author=Author(name=session.username if session else ''),
+                        body=text, reddit_session=session, replies=[])
+        reply.parent_id = self.name
+        reply.submission = getattr(self, 'submission', self)
+        self.replies.append(reply)
+        if session is not None:
+            session.replies_posted += 1
+            reply.id = 'r%07d' % session.replies_posted
+            session._call('reply')
+            session.set_info(reply.name, reply)
+        return reply
+
+    @property
+    def name(self):
+        return self.fullname_prefix + self.id
+
+    def distinguish(self):
+        pass
+
+    def delete(self):
+        self.body = '[deleted]'
+
+    def mark_as_read(self):
+        if self.reddit_session is not None:
+            self.reddit_session._call('mark_as_read')
+        self._read = True
+        self._read_at = time.time()
 
 class Author(object):
     def __init__(self, name=''):
         self.name = name
 
     def __eq__(self, other):
-        return self.name == other.name
+        # Like praw's, never equal to a plain name
+        return isinstance(other, Author) and self.name == other.name
 
     def __ne__(self, other):
-        return self.name != other.name
+        return not self == other
 
     def __str__(self):
         return self.name
 
 class Message(Repliable):
+    fullname_prefix = 't4_'
+
     def __init__(self, *args,  **kwargs):
         Repliable.__init__(self, *args, **kwargs)
         self.was_comment = False
 
 class Submission(Repliable):
+    fullname_prefix = 't3_'
+
     def __init__(self, *args,  **kwargs):
         Repliable.__init__(self, *args, **kwargs)
+        self.title = ''
+        self.permalink = ''
 
 class Comment(Repliable):
+    fullname_prefix = 't1_'
+
     def __init__(self, *args, **kwargs):
         Repliable.__init__(self, *args, **kwargs)
         self.was_comment = True
@@ -95,6 +271,174 @@ class Comment(Repliable):
         self._edited = False
         self._edit_text = ''
         self.submission = Submission()
+        self.parent_id = None
+        self.is_root = False
+        self.created = time.time()
+
     def edit(self, text):
         self._edited = True
-        self._edit_text = text
\ No newline at end of file
+        self._edit_text = text
+        self.body = text
+        return self
+
+class SyntheticSubreddit(object):
+    """ Generates comment traffic for a mock Reddit session.
+
+    Comments are spread over a fixed set of submissions and reply to an
+    earlier comment in the same submission (up to thread_depth deep) or to
+    the submission itself. A delta_rate fraction of them contain a token and
+    are long enough to be awarded. Comment ids increase monotonically, so
+    'before' queries behave like they do on reddit. With a thread_size, a
+    submission with that many comments goes quiet and a new one takes its
+    place, and forget() drops the quiet ones from the session.
+    """
+
+    def __init__(self, reddit_session, tokens, minimum_comment_length,
+                 submissions=20, thread_depth=8, delta_rate=0.01,
+                 reply_rate=0.7, reply_to_latest=False, users=500,
+                 seed=None, start=None, thread_size=None):
+        self.reddit_session = reddit_session
+        self.tokens = tokens
+        self.minimum_comment_length = minimum_comment_length
+        self.thread_depth = thread_depth
+        self.delta_rate = delta_rate
+        self.reply_rate = reply_rate
+        self.reply_to_latest = reply_to_latest
+        self.thread_size = thread_size
+        # Submissions that went quiet, and the ones forget() is to drop
+        self.quiet = []
+        self.forgettable = []
+        self.random = random.Random(seed)
+        self.clock = start if start is not None else time.time()
+        self.users = [Author(name='user%s' % n) for n in range(users)]
+        self._next_id = 0
+        self.threads = {}
+        self.submissions = [self.new_submission() for x in range(submissions)]
+
+    def next_id(self):
+        """ Fixed width base 36 ids, so they sort like reddit's """
+        self._next_id += 1
+        n, digits = self._next_id, ''
+        while n:
+            n, d = divmod(n, 36)
+            digits = (string.digits + string.ascii_lowercase)[d] + digits
+        return digits.rjust(8, '0')
+
+    def new_submission(self):
+        submission = Submission(author=self.random.choice(self.users),
+                                reddit_session=self.reddit_session, replies=[])
+        submission.id = self.next_id()
+        submission.title = 'CMV: synthetic view %s' % submission.id
+        submission.permalink = ('http://www.reddit.com/r/test/comments/%s/x/'
+                                % submission.id)
+        self.threads[submission.id] = []
+        self.reddit_session.set_info(submission.name, submission)
+        return submission
+
+    def comment(self, delta=None):
+        """ Create one comment, register it with the session and return it """
+        if delta is None:
+            delta = self.random.random() < self.delta_rate
+        submission = self.random.choice(self.submissions)
+        if (self.thread_size and
+                len(self.threads[submission.id]) >= self.thread_size):
+            self.quiet.append(submission)
+            index = self.submissions.index(submission)
+            submission = self.submissions[index] = self.new_submission()
+        thread = self.threads[submission.id]
+        candidates = [c for c in thread if c._depth < self.thread_depth]
+        parent = None
+        if candidates and (delta or self.random.random() < self.reply_rate):
+            if self.reply_to_latest:
+                parent = candidates[-1]
+            else:
+                parent = self.random.choice(candidates)
+        # Deltas go to someone other than the commenter and OP
+        author = self.random.choice(self.users)
+        while parent is not None and author == parent.author:
+            author = self.random.choice(self.users)
+        if delta and parent is not None and parent.author != submission.author:
+            body = (self.random.choice(self.tokens) + ' ' +
+                    'x' * self.minimum_comment_length)
+        else:
+            body = 'y' * self.random.randint(10, 400)
+
+        comment = Comment(author=author, body=body,
+                          reddit_session=self.reddit_session, replies=[])
+        comment.id = self.next_id()
+        comment.submission = submission
+        comment.link_id = submission.name
+        comment.permalink = submission.permalink + comment.id
+        self.clock += 1
+        comment.created = comment.created_utc = self.clock
+        if parent is None:
+            comment.parent_id = submission.name
+            comment.is_root = True
+            comment._depth = 1
+            submission.replies.append(comment)
+        else:
+            comment.parent_id = parent.name
+            comment._depth = parent._depth + 1
+            parent.replies.append(comment)
+        thread.append(comment)
+        self.reddit_session.set_info(comment.name, comment)
+        return comment
+
+    def forget(self):
+        """ Drop the submissions that went quiet before the last call from
+        the session, with their comments and the bot's replies to them, so
+        a long soak only holds what the bot could still look at. Ones that
+        went quiet since are kept for the bot's next pass. """
+        session = self.reddit_session
+        gone = set(submission.name for submission in self.forgettable)
+        self.forgettable, self.quiet = self.quiet, []
+        if not gone:
+            return
+        for name, thing in list(session.info.items()):
+            if (name in gone or
+                    getattr(getattr(thing, 'submission', None), 'name',
+                            None) in gone):
+                del session.info[name]
+        session.subreddit.comments = [c for c in session.subreddit.comments
+                                      if c.submission.name not in gone]
+        for name in gone:
+            del self.threads[name.split('_', 1)[1]]
+
+    def inbox_reply(self, bot_message, edited=True):
+        """ A delta the bot turned down for being too short (answering with
+        bot_message % awardee), followed by the awarder replying to the bot.
+        The reply is left unread in the inbox and returned. If edited, the
+        delta has since been made long enough to award. """
+        comment = self.comment(delta=True)
+        while comment.is_root or not any(t in comment.body for t in self.tokens):
+            comment = self.comment(delta=True)
+        parent = self.reddit_session.info[comment.parent_id]
+        if not edited:
+            comment.body = comment.body.split(' ')[0]
+        bots_comment = comment.reply(bot_message % parent.author)
+
+        reply = Comment(author=comment.author, body='I edited my comment',
+                        reddit_session=self.reddit_session, replies=[])
+        reply.id = self.next_id()
+        reply.submission = comment.submission
+        reply.link_id = comment.link_id
+        reply.parent_id = bots_comment.name
+        reply._visible_at = time.time()
+        self.reddit_session.set_info(reply.name, reply)
+        self.reddit_session.unread.append(reply)
+        return reply
+
+    def publish(self, count, interval=None):
+        """ Make count new comments visible in the subreddit listing. If an
+        interval is given the synthetic clock advances by it per comment,
+        e.g. to spread a backlog over hours. """
+        published = []
+        for x in range(count):
+            comment = self.comment()
+            if interval is not None:
+                self.clock += interval - 1
+                comment.created = comment.created_utc = self.clock
+            comment._visible_at = time.time()
+            published.append(comment)
+        self.reddit_session.subreddit.comments.extend(published)
+        return published
@@ -0,0 +1,190 @@
+""" Read-only answers about deltas, without asking reddit.
+
+Users and other moderator tools looked delta counts up in flair or on the
+user/NAME wiki pages, a request to reddit each. The bot's Leaderboard (see
+leaderboard.py) already has what they want: the delta count it last set
+each user's flair to, their all-time totals, their points by month and the
+awards in each submission. award_points adds each award to it as the award
+goes onto its month's scoreboard page, so the answers agree with the flair
+and scoreboards without anyone reading them. A user whose flair the bot
+hasn't set since it started keeping the count has "deltas" null until the
+reconciler (see reconcile.py) reads it. Queries are paths:
+
+    /user/NAME              {"user", "deltas" (as in their flair, or null),
+                             "rank" (on the all-time leaderboard)}
+    /user/NAME/history      {"user", "months": [[month key, points], ...]}
+    /submission/ID          {"submission", "awards": [[user, points], ...]}
+
+Answers are cached by path until the leaderboard changes, so repeating a
+lookup between awards costs a dictionary lookup. The cache holds the last
+CACHE_SIZE answers and is in the memory budget (see memory.py).
+
+With query_port set, the bot answers over HTTP on localhost. Running this
+file with runquery.sh asks from the command line: the bot, if query_port is
+set and it is up, or otherwise leaderboard_filename, read directly.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import collections
+try:
+    from urllib import unquote
+except ImportError: # Python 3
+    from urllib.parse import unquote
+
+import config
+import memory
+import metrics
+import leaderboard
+
+
+# How many answers are cached
+CACHE_SIZE = 1024
+
+
+class Query(object):
+    def __init__(self, source):
+        # Returns the Leaderboard to answer from, or None while this bot
+        # stands by; a takeover replaces it
+        self.source = source
+        # path -> (status, answer), least recently used first
+        self.cache = collections.OrderedDict()
+        # The leaderboard and its version the cache was filled from
+        self.cached_from = None
+        self.lock = threading.Lock()
+
+    def answer(self, path):
+        """ (HTTP status, answer as a dict) for path """
+        board = self.source()
+        if board is None:
+            return 503, {'error': "standing by"}
+        key = (board, board.version)
+        with self.lock:
+            if self.cached_from != key:
+                self.cache.clear()
+                self.cached_from = key
+            response = self.cache.pop(path, None)
+            if response is not None:
+                self.cache[path] = response
+                metrics.count('query.cache_hits')
+                return response
+        # Read at the version in key or a later one; a later one moves the
+        # cache on again before it is read
+        response = self.lookup(board, path)
+        with self.lock:
+            if self.cached_from == key:
+                self.cache[path] = response
+                while len(self.cache) > CACHE_SIZE:
+                    self.cache.popitem(last=False)
+        metrics.count('query.lookups')
+        return response
+
+    def lookup(self, board, path):
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if len(parts) == 2 and parts[0] == 'user':
+            user = parts[1]
+            return 200, {'user': user,
+                         'deltas': board.flair_count(user),
+                         'rank': board.rank(user)}
+        if len(parts) == 3 and parts[0] == 'user' and parts[2] == 'history':
+            user = parts[1]
+            return 200, {'user': user,
+                         'months': [list(item) for item in board.months(user)]}
+        if len(parts) == 2 and parts[0] == 'submission':
+            submission = parts[1].split('_', 1)[-1]
+            return 200, {'submission': submission,
+                         'awards': [list(item) for item in
+                                    board.awards_in(submission)]}
+        return 404, {'error': "unknown query %s" % path}
+
+    def memory_size(self):
+        with self.lock:
+            return memory.estimate(self.cache)
+
+    def evict(self, size):
+        """ Drop the answers used least recently """
+        with self.lock:
+            return memory.evict_first(self.cache, size)
+
+    def serve(self, port, host='127.0.0.1'):
+        """ Answer over HTTP on a background thread """
+        # Only loaded when query_port is set
+        try:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+        except ImportError: # Python 3
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        query = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, answer = query.answer(self.path.split('?', 1)[0])
+                body = json.dumps(answer).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info("Answering queries on http://%s:%s/" % (
+                         host, server.server_port))
+        return server
+
+
+def ask(base_config, path):
+    """ (status, answer) for path, from the bot if it serves queries, or
+    from its leaderboard file """
+    if base_config.query_port:
+        # Only the command line needs requests loaded here
+        import requests
+        try:
+            response = requests.get('http://127.0.0.1:%s/%s' % (
+                                        base_config.query_port,
+                                        path.lstrip('/')), timeout=5)
+            return response.status_code, response.json()
+        except requests.ConnectionError:
+            logging.warning("The bot isn't answering; reading %s" %
+                            base_config.leaderboard_filename)
+    if not base_config.leaderboard_filename:
+        return 503, {'error': "no leaderboard_filename to read"}
+    board = leaderboard.Leaderboard(base_config.leaderboard_filename)
+    return Query(lambda: board).answer(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('kind', choices=('user', 'history', 'submission'))
+    parser.add_argument('name', help="a username, or a submission id")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    base_config = config.Config(os.getcwd() + '/config/config.json')
+    if args.kind == 'history':
+        path = '/user/%s/history' % args.name
+    else:
+        path = '/%s/%s' % (args.kind, args.name)
+    status, answer = ask(base_config, path)
+    print(json.dumps(answer, indent=2, sort_keys=True))
+    if status != 200:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
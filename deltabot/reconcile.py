@@ -0,0 +1,227 @@
+""" Background repair of the three places a user's delta count is kept.
+
+award_points sets the awardee's flair, then adds the comment to the month's
+scoreboard_YYYY_M page, then lists it on their user/<name> wiki page, whose
+header repeats the flair count. Every write of the bot's only ever adds, so
+an award that fails part way leaves the later stores behind, never ahead: the
+count the bot would give a user is the highest of their flair, their wiki
+header and the number of awards listed on their wiki page, and an award on
+the scoreboard but not on the wiki page is one whose wiki update was lost.
+Moderators take deltas away by hand, though, and that leaves the stores
+disagreeing the other way. So mismatches are only reported, and repaired only
+with reconcile_repair set.
+
+Reconciler checks a few users at the end of each iteration, within a budget
+of API calls, rotating through everyone on the delta_tracker page. Users
+whose scoreboard entry has changed since the last iteration go first. A user
+whose flair, wiki page and scoreboard entry hash the same as at their last
+clean check is passed over without being checked again. The flair count read
+is noted in the leaderboard, for users the bot hasn't awarded since it
+started keeping their count.
+"""
+import hashlib
+import logging
+import datetime
+import collections
+
+import utils
+import memory
+import metrics
+import patterns
+import retry
+from reddit import unescape
+
+
+# API calls it takes to check a user: their flair and their wiki page
+CHECK_COST = 2
+# API calls it takes to relist one award on a wiki page: the comment, then
+# update_wiki_tracker's parent, flair, page read and page write
+RELIST_COST = 5
+
+
+def digest(*parts):
+    """ A hash of parts (strings or None), to tell if any of them changed """
+    content = '\0'.join('' if part is None else part for part in parts)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def recount_wiki_page(content, count):
+    """ Returns content with its header saying count deltas and each
+    submission's "(N)" set to the number of awards listed under it """
+    lines = content.split('\n')
+    links = []
+    for index, line in enumerate(lines):
+        if patterns.WIKI_LINK_LINE.match(line):
+            links.append([index, 0])
+        elif links and patterns.WIKI_AWARD.match(line):
+            links[-1][1] += 1
+    for index, awards in links:
+        # Links from older versions of the bot have no awards under them
+        if awards:
+            lines[index] = patterns.set_wiki_link_count(lines[index], awards)
+    return patterns.replace_wiki_delta_count('\n'.join(lines),
+                                             utils.delta_count_text(count))
+
+
+class Reconciler(object):
+    def __init__(self, reddit, config):
+        self.reddit = reddit
+        self.config = config
+        # Users to check next: the ones whose scoreboard entry changed, then
+        # the rotation through delta_tracker
+        self.priority = collections.deque()
+        self.rotation = collections.deque()
+        self.scoreboard_digests = {}
+        # Digest of each user's flair, wiki page and scoreboard entry when
+        # they last checked out
+        self.verified = {}
+
+    def memory_size(self):
+        return memory.estimate(self.verified)
+
+    def evict(self, size):
+        """ Forget users' last clean checks; they are checked again """
+        return memory.evict_first(self.verified, size)
+
+    def refill(self):
+        """ Start another pass over everyone on the delta_tracker page """
+        try:
+            page = self.reddit.get_wiki_page(self.config.subreddit,
+                                             'delta_tracker')
+            self.rotation.extend(utils.unique(
+                patterns.tracker_users(page.content_md)))
+        except Exception as e:
+            logging.warning("Could not read delta_tracker: %s" % e)
+
+    @metrics.timed('reconcile')
+    def run(self, budget):
+        """ Check and repair as many users as budget API calls allow.
+        Returns a list describing each repair made. """
+        start = metrics.registry.api_calls()
+        remaining = lambda: budget - (metrics.registry.api_calls() - start)
+
+        scoreboard = self.reddit.get_this_months_scoreboard(
+                         datetime.datetime.utcnow())
+        digests = {}
+        for user, entry in scoreboard.items():
+            digests[user] = digest(str(entry['score']), *entry['links'])
+            if digests[user] != self.scoreboard_digests.get(user):
+                self.priority.append(user)
+        self.scoreboard_digests = digests
+
+        repairs = []
+        checked = 0
+        refilled = False
+        while remaining() >= CHECK_COST:
+            if not self.priority and not self.rotation:
+                # At most one new pass per run, in case everyone is done
+                if refilled:
+                    break
+                self.refill()
+                refilled = True
+            queue = self.priority or self.rotation
+            if not queue:
+                break
+            repairs += self.check(queue.popleft(), scoreboard, remaining)
+            checked += 1
+        metrics.count('reconcile.users', checked)
+        metrics.count('reconcile.repairs', len(repairs))
+        for repair in repairs:
+            logging.warning("Reconciled %s" % repair)
+        return repairs
+
+    def check(self, user, scoreboard, remaining):
+        """ Compare a user's flair, wiki page and entry on this month's
+        scoreboard, and with reconcile_repair set, repair what has fallen
+        behind. Awards are only relisted while remaining() says the budget
+        allows. """
+        entry = scoreboard.get(user)
+        with self.reddit.award_lock:
+            # Read where no award can set it meanwhile, so the count
+            # /user/NAME answers with (see query.py) is never set back
+            flair = self.reddit.subreddit.get_flair(user)
+            self.reddit.leaderboard.set_flair(
+                user, patterns.parse_flair_count(flair['flair_text']))
+        try:
+            page = self.reddit.get_wiki_page(self.config.subreddit,
+                                             'user/' + user)
+            content = unescape(page.content_md)
+        except Exception as e:
+            # Only a missing page is missing; after any other failure the
+            # user is left for a later run
+            if not retry.is_missing(e):
+                logging.warning("Could not read the wiki page of %s: %s" % (
+                                    user, e))
+                return []
+            content = None
+        links = entry['links'] if entry else []
+        state = digest(flair['flair_text'], content,
+                       str(entry['score'] if entry else ''), *links)
+        if self.verified.get(user) == state:
+            return []
+
+        flair_count = patterns.parse_flair_count(flair['flair_text'])
+        count = flair_count
+        listed = set()
+        if content is not None:
+            urls = patterns.wiki_award_urls(content)
+            listed = set(utils.comment_id(url) for url in urls)
+            count = max(count, patterns.parse_wiki_delta_count(content),
+                        len(urls))
+        unlisted = [utils.comment_id(link.rsplit('(', 1)[-1].rstrip(')'))
+                    for link in links]
+        unlisted = [comment_id for comment_id in unlisted
+                    if comment_id not in listed]
+
+        if not self.config.reconcile_repair:
+            self.report(user, flair_count, count, content, unlisted)
+            self.verified[user] = state
+            return []
+
+        repairs = []
+        with self.reddit.award_lock:
+            if flair_count < count:
+                self.reddit.set_point_flair(user, count,
+                                            flair['flair_css_class'] or '')
+                repairs.append("%s: flair %s -> %s" % (user, flair_count,
+                                                       count))
+            if content is not None:
+                new_content = recount_wiki_page(content, count)
+                if new_content != content:
+                    self.reddit.edit_wiki_page(self.config.subreddit,
+                                               'user/' + user, new_content,
+                                               "Reconciled delta count.")
+                    repairs.append("%s: wiki page recounted" % user)
+            for comment_id in unlisted:
+                if remaining() < RELIST_COST:
+                    break
+                # The award made it onto the scoreboard but its wiki update
+                # was lost; the flair already counts it
+                try:
+                    comment = self.reddit.get_info(thing_id='t1_' + comment_id)
+                    self.reddit.update_wiki_tracker(comment)
+                except Exception as e:
+                    logging.warning("Could not relist %s for %s: %s" % (
+                                        comment_id, user, e))
+                    continue
+                repairs.append("%s: %s relisted on wiki" % (user, comment_id))
+
+        if not repairs and not unlisted:
+            self.verified[user] = state
+        return repairs
+
+    def report(self, user, flair_count, count, content, unlisted):
+        """ Log what check would repair """
+        mismatches = []
+        if flair_count < count:
+            mismatches.append("flair %s, wiki page %s" % (flair_count, count))
+        elif (content is not None and
+                recount_wiki_page(content, count) != content):
+            mismatches.append("wiki page miscounted")
+        if unlisted:
+            mismatches.append("%s on the scoreboard but not on the wiki page"
+                              % ', '.join(unlisted))
+        if mismatches:
+            metrics.count('reconcile.mismatches')
+            logging.warning("Mismatch for %s: %s" % (user,
+                                                     '; '.join(mismatches)))
@@ -2,32 +2,33 @@ import re
 import os
 import sys
 import time
-import praw
 import logging
 import calendar
 import datetime
+import threading
 import traceback
 import collections
-from . import utils
-
-
-def str_contains_token(text, tokens):
-    """ Returns true if a given string contains one of the given tokens, as long
-    as the token is not inside a quote or code block """
-    lines = text.split('\n')
-    in_quote = False
-    for line in lines:
-        if not line: # Empty string
-            in_quote = False
-        if in_quote:
-            continue
-        if not skippable_line(line):
-            for token in tokens:
-                if token in line:
-                    return True
-        else:
-            in_quote = True
-    return False
+
+import utils
+import retry
+import capture
+import journal
+import modmail
+import snapshot
+import leaderboard
+import patterns
+import metrics
+from config import derived
+
+try:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+except ImportError: # Python 3
+    from html import unescape
+
+
+# How many things reddit will look up in one info call
+INFO_BATCH_SIZE = 100
 
 
 def markdown_to_scoreboard(text):
@@ -57,120 +58,397 @@ def scoreboard_to_markdown(scoreboard):
     return text
 
 
+class DeferredLogin(object):
+    """ Wraps a session so that it logs in just before the first call made
+    through it, rather than when the bot starts. A failed login is tried
+    again on the next call. """
+
+    def __init__(self, session, username, password):
+        self._session = session
+        self._credentials = (username, password)
+        self._lock = threading.Lock()
+
+    def login(self):
+        with self._lock:
+            if self._credentials is not None:
+                self._session.login(*self._credentials)
+                self._credentials = None
+
+    def __getattr__(self, name):
+        attr = getattr(self._session, name)
+        if not callable(attr) or self._credentials is None:
+            return attr
+
+        def call(*args, **kwargs):
+            self.login()
+            return attr(*args, **kwargs)
+        return call
+
+
 class Reddit(object):
     def __init__(self, config, test=False, test_reddit=None,
                  test_recent=None):
         self.config = config
+        # Shared by every wrapper, so the breakers see all calls
+        self.retry_policy = retry.Policy.from_config(config)
+        # The live session's transport.ConditionalAdapter
+        self.adapter = None
+        # Nothing is sent to reddit until the first call that needs it; the
+        # login goes out then
         if test:
-            self.reddit = test_reddit
+            self.reddit = DeferredLogin(self.wrap(test_reddit, 'reddit'),
+                                        self.config.test_account['username'],
+                                        self.config.test_account['password'])
             self.most_recent_comment_id = test_recent
-            self.reddit.login(*[self.config.test_account['username'],
-                                self.config.test_account['password']])
 
         else:
-            self.reddit = praw.Reddit(self.config.subreddit + ' bot',
-                                      site_name=config.site_name)
+            # Only a live bot needs PRAW and requests loaded
+            import praw
+            import transport
+            session = praw.Reddit(self.config.subreddit + ' bot',
+                                  site_name=config.site_name)
+            self.adapter = transport.tune(session, config)
+            if self.config.capture_filename:
+                session = capture.Recorder(
+                              session,
+                              capture.open_capture(self.config.capture_filename))
+            self.reddit = DeferredLogin(self.wrap(session, 'reddit'),
+                                        config.username, config.password)
             self.most_recent_comment_id = utils.read_saved_id(self.config.last_comment_filename)
-            self.reddit.login(config.username, config.password)
-        self.subreddit = self.reddit.get_subreddit(self.config.subreddit)
+        self.snapshot = snapshot.Snapshot(self.config.snapshot_filename)
         self.changes_made = False # Ewwww
-
-
+        # Awards read-modify-write flair and wiki pages, so only one runs at
+        # a time even when the inbox is handled on several threads
+        self.award_lock = threading.RLock()
+        # Called before every award is journaled or applied and before
+        # every write to reddit; see lease.py
+        self.fence = lambda: None
+        # With a lease these are shared with a standby, and only opened by
+        # the bot holding it
+        self.journal = journal.Journal()
+        self.leaderboard = leaderboard.Leaderboard()
+        self.mod_mail = modmail.ModMail()
+        if not self.config.lease_filename:
+            self.open_shared_state()
+
+    def open_shared_state(self):
+        """ Open the award journal, leaderboard and mod mail files """
+        self.journal.close()
+        self.journal = journal.Journal(self.config.journal_filename)
+        self.leaderboard = leaderboard.Leaderboard(
+                               self.config.leaderboard_filename)
+        self.mod_mail = modmail.ModMail(self.config.mod_mail_filename)
+
+    def close_shared_state(self):
+        """ Leave the journal, leaderboard and mod mail files to another
+        bot """
+        self.journal.close()
+        self.journal = journal.Journal()
+        self.leaderboard = leaderboard.Leaderboard()
+        self.mod_mail = modmail.ModMail()
+
+    def wrap(self, thing, prefix):
+        """ Time and count every call to thing, and retry the ones that fail
+        for a passing reason. Every attempt counts as an API call. """
+        return retry.Retrying(metrics.Instrumented(thing, prefix),
+                              self.retry_policy)
+
+    @derived
+    def subreddit(self):
+        """ The subreddit, wrapped like the session """
+        return self.wrap(self.reddit.get_subreddit(self.config.subreddit),
+                         'subreddit')
+
+    def get_bot_comments(self):
+        """ The bot's own comments, newest first, as a lazy listing """
+        redditor = self.wrap(self.reddit.get_redditor(
+                                 self.config.account['username']), 'redditor')
+        return redditor.get_comments(sort='new', limit=None)
+
+    def get_mod_mail(self):
+        """ The first mod_mail_limit conversations in the subreddit's mod
+        mail, most recently active first """
+        return self.reddit.get_mod_mail(self.config.subreddit,
+                                        limit=self.config.mod_mail_limit)
+
+    def get_moderator_names(self):
+        """ The names of the subreddit's moderators, fetched again once they
+        are moderators_max_age seconds old. They are kept in the snapshot, so
+        a restart doesn't have to fetch them. """
+        names = self.snapshot.get('moderators', self.config.moderators_max_age)
+        if names is None:
+            names = [moderator.name for moderator in
+                     self.reddit.get_moderators(self.config.subreddit)]
+            self.snapshot.set('moderators', names)
+        return names
+
+    def __getattr__(self, name):
+        # Anything not wrapped here (get_info, get_unread, ...) goes straight
+        # to the PRAW session
+        if name == 'reddit':
+            raise AttributeError(name)
+        return getattr(self.reddit, name)
+
+
+    def get_info_batch(self, thing_ids):
+        """ Look up all of thing_ids in as few calls as possible. Returns a
+        dict from fullname to thing; things that don't exist are left out. """
+        things = {}
+        thing_ids = list(thing_ids)
+        for start in range(0, len(thing_ids), INFO_BATCH_SIZE):
+            batch = thing_ids[start:start + INFO_BATCH_SIZE]
+            for thing in self.reddit.get_info(thing_id=batch) or []:
+                if thing is not None:
+                    things[thing.name] = thing
+        return things
+
+
+    def mark_as_read(self, items):
+        """ Mark all of items read with a single call """
+        if items:
+            self.fence()
+            self.reddit._mark_as_read([item.name for item in items])
+
+
+    def send_message(self, *args, **kwargs):
+        """ The session's send_message, as long as this bot leads """
+        self.fence()
+        return self.reddit.send_message(*args, **kwargs)
+
+
+    def edit_wiki_page(self, *args, **kwargs):
+        """ The session's edit_wiki_page, as long as this bot leads """
+        self.fence()
+        return self.reddit.edit_wiki_page(*args, **kwargs)
+
+
+    @metrics.timed('award_points')
     def award_points(self, awardee, comment):
         """ Awards a point. """
         logging.info("Awarding point to %s" % awardee)
-        self.adjust_point_flair(awardee)
-        self.update_monthly_scoreboard(awardee, comment)
-        self.update_wiki_tracker(comment)
+        with self.award_lock:
+            self.fence()
+            self.apply_awards(self.journal.begin([(awardee, comment)]))
+
+
+    def award_points_batch(self, awards):
+        """ Awards a point for every (awardee, comment) in awards. Flair is
+        set once per awardee and each monthly scoreboard written once. """
+        if awards:
+            self.finish_awards(self.begin_awards(awards))
+
+
+    def begin_awards(self, awards):
+        """ Journal every (awardee, comment) in awards without applying them
+        yet. Returns them as journal.Awards for finish_awards; if anything
+        fails first, resume_awards finishes them. """
+        with self.award_lock:
+            self.fence()
+            return self.journal.begin(awards)
+
+
+    def withdraw_awards(self, awards):
+        """ Drop awards from begin_awards that are not to be applied after
+        all """
+        with self.award_lock:
+            for award in awards:
+                self.journal.abandon(award)
+
+
+    @metrics.timed('award_points_batch')
+    def finish_awards(self, awards):
+        """ Apply awards from begin_awards, flair once per awardee and each
+        monthly scoreboard written once """
+        if not awards:
+            return
+        logging.info("Awarding %s points" % len(awards))
+        with self.award_lock:
+            self.fence()
+            self.apply_awards(awards)
+
+
+    def apply_awards(self, awards):
+        """ Run the steps of awards (journal.Awards) that are not done yet,
+        marking each in the journal as it completes """
+        self.fence()
+        groups = collections.OrderedDict()
+        for award in awards:
+            if 'flair' not in award.done:
+                groups.setdefault((award.awardee, award.flair_start),
+                                  []).append(award)
+        for (awardee, flair_start), group in groups.items():
+            self.adjust_point_flair(awardee, len(group), group)
+            self.journal.done(group, 'flair')
+
+        todo = [award for award in awards if 'scoreboard' not in award.done]
+        if todo:
+            self.update_monthly_scoreboards([(award.awardee, award.comment)
+                                             for award in todo])
+            self.journal.done(todo, 'scoreboard')
+
+        for award in awards:
+            if 'wiki' not in award.done:
+                self.update_wiki_tracker(award.comment)
+                self.journal.done([award], 'wiki')
+
+
+    def resume_awards(self):
+        """ Finish the awards an error, or a crash before a restart, left
+        half applied """
+        awards = list(self.journal.pending.values())
+        if not awards:
+            return
+        logging.info("Resuming %s unfinished awards" % len(awards))
+        comments = self.get_info_batch([award.comment_name for award in awards
+                                        if award.comment is None])
+        resumable = []
+        for award in awards:
+            if award.comment is None:
+                award.comment = comments.get(award.comment_name)
+            if award.comment is None:
+                logging.warning("Giving up on the award of %s to %s, the "
+                                "comment is gone" % (award.comment_name,
+                                                     award.awardee))
+                self.journal.abandon(award)
+            else:
+                resumable.append(award)
+        with self.award_lock:
+            self.apply_awards(resumable)
 
 
     def send_first_time_message(self, recipient_name):
         first_time_message = self.config.private_message % (
                                  self.config.subreddit, recipient_name)
-        self.reddit.send_message(recipient_name,
-                                 "Congratulations on your first delta!",
-                                 first_time_message)
+        self.send_message(recipient_name,
+                          "Congratulations on your first delta!",
+                          first_time_message)
 
 
-    def adjust_point_flair(self, redditor, num_points=1):
-        """ Recalculate a user's score and update flair. """
+    @metrics.timed('award_points.flair')
+    def adjust_point_flair(self, redditor, num_points=1, awards=()):
+        """ Recalculate a user's score and update flair. With awards (the
+        journal.Awards the points are for), the flair read is journaled
+        before the new flair is set, and left alone if it shows the points
+        were added before a crash. """
         self.changes_made = True
 
         flair = self.subreddit.get_flair(redditor)
+        if awards and awards[0].flair_start is not None:
+            if (patterns.parse_flair_count(flair['flair_text']) ==
+                    awards[0].flair_start + num_points):
+                return
         if flair['flair_text'] == None:
             points = 0
             css_class = ''
             self.send_first_time_message(redditor)
         elif flair:
-            points = utils.get_first_int(flair['flair_text'])
+            points = patterns.parse_flair_count(flair['flair_text'])
             css_class = flair['flair_css_class']
         else:
             points = 0
             css_class = ''
             self.send_first_time_message(redditor)
 
-        points += num_points
+        if awards:
+            self.journal.start_flair(awards, points)
+        self.set_point_flair(redditor, points + num_points, css_class)
+
+
+    def set_point_flair(self, redditor, points, css_class=''):
+        """ Set a user's flair to points, keeping the rest of css_class """
         if self.config.flair['css_class'] not in css_class:
             css_class += ' ' + self.config.flair['css_class']
 
+        self.fence()
         self.subreddit.set_flair(redditor,
                                  self.config.flair['point_text'] % points,
                                  css_class)
+        self.leaderboard.set_flair(str(redditor), points)
 
 
     def update_monthly_scoreboard(self, redditor, comment, num_points=1):
-        logging.info("Updating monthly scoreboard")
-        date = datetime.datetime.utcfromtimestamp(comment.created)
-        scoreboard = self.get_this_months_scoreboard(date)
-        page_title = "scoreboard_%s_%s" % (date.year, date.month)
-        if redditor in scoreboard:
-            entry = scoreboard[redditor]
-        else:
-            entry = scoreboard[redditor] = {"links": [], "score": 0}
+        self.update_monthly_scoreboards([(redditor, comment)], num_points)
 
-        entry["links"].append("[%s](%s)" % (comment.submission.title,
-                                            comment.permalink))
-        entry["score"] += num_points
-
-        self.reddit.edit_wiki_page(self.config.subreddit, page_title,
-                                   scoreboard_to_markdown(scoreboard),
-                                   "Updating monthly scoreboard")
+    @metrics.timed('award_points.scoreboard')
+    def update_monthly_scoreboards(self, awards, num_points=1):
+        """ Add every (redditor, comment) in awards to the scoreboard of the
+        month it was made in, reading and writing each page once """
+        logging.info("Updating monthly scoreboard")
+        months = collections.OrderedDict()
+        for redditor, comment in awards:
+            date = datetime.datetime.utcfromtimestamp(comment.created)
+            months.setdefault((date.year, date.month), []).append(
+                (redditor, comment))
+
+        for (year, month), month_awards in months.items():
+            scoreboard = self.get_this_months_scoreboard(
+                             datetime.date(year, month, 1))
+            page_title = "scoreboard_%s_%s" % (year, month)
+            key = leaderboard.month_key(year, month)
+            self.leaderboard.start_month(key, scoreboard)
+            for redditor, comment in month_awards:
+                if redditor in scoreboard:
+                    entry = scoreboard[redditor]
+                else:
+                    entry = scoreboard[redditor] = {"links": [], "score": 0}
+
+                link = "[%s](%s)" % (comment.submission.title,
+                                     comment.permalink)
+                self.leaderboard.add(key, str(redditor), link, num_points)
+                if link in entry["links"]:
+                    # Already added before an interruption, see journal.py
+                    continue
+                entry["links"].append(link)
+                entry["score"] += num_points
+
+            self.edit_wiki_page(self.config.subreddit, page_title,
+                                scoreboard_to_markdown(scoreboard),
+                                "Updating monthly scoreboard")
+        self.leaderboard.save()
 
     def get_this_months_scoreboard(self, date):
+        """ The scoreboard of date's month; empty only if its page doesn't
+        exist yet. Any other failure to read it is raised, so the page isn't
+        written over, or the leaderboard started, from an empty one. """
         page_title = "scoreboard_%s_%s" % (date.year, date.month)
         try:
             scoreboard_page = self.reddit.get_wiki_page(self.config.subreddit,
                                                         page_title)
             page_text = scoreboard_page.content_md
-        except:
+        except Exception as e:
+            if not retry.is_missing(e):
+                raise
             page_text = ""
         return markdown_to_scoreboard(page_text)
 
 
+    def top_scores(self, top, size=10):
+        """ [{'user': ..., 'flair_text': ...}] for leaderboard.top()'s
+        [(user, points)], padded out to at least size """
+        score_list = [{'user': user,
+                       'flair_text': self.config.flair['point_text'] % points}
+                      for user, points in top]
+        while len(score_list) < size:
+            score_list.append({'user': 'none', 'flair_text': 'no score'})
+        return score_list
+
+
     def get_top_ten_scores_this_month(self):
-        """ Get a list of the top 10 scores this month """
+        """ Get a list of the top 10 scores this month. The scoreboard page
+        is only read if the leaderboard doesn't have the month yet. """
         date = datetime.datetime.utcnow()
-        scoreboard = self.get_this_months_scoreboard(date)
-        score_list = []
-        for user, value in scoreboard.iteritems():
-            score_list.append({
-                'user': user,
-                'flair_text': self.config.flair['point_text'] % value['score']
-            })
-        score_list = sorted(score_list, key=utils.flair_sorter)
-        score_list.reverse()
-        while len(score_list) < 10:
-            score_list.append({'user': 'none', 'flair_text': 'no score'})
-        return score_list[0:10]
+        month = leaderboard.month_key(date.year, date.month)
+        if not self.leaderboard.knows(month):
+            self.leaderboard.start_month(month,
+                                         self.get_this_months_scoreboard(date))
+        return self.top_scores(self.leaderboard.top(month))
 
 
-    def update_scoreboard(self):
-        """ Update the top 10 list with highest scores. """
-        logging.info("Updating scoreboard")
-        now = datetime.datetime.utcnow()
-        top_scores = self.get_top_ten_scores_this_month()
+    def score_table(self, heading, top_scores):
+        """ The lines of a markdown table of top_scores, as the sidebar
+        shows them """
         score_table = [
-            "\n\n# Top Ten Viewchangers (%s)" % calendar.month_name[now.month],
+            "\n\n# %s" % heading,
             self.config.scoreboard['table_head'],
             self.config.scoreboard['table_leader_entry'] % (
                 top_scores[0]['user'], top_scores[0]['flair_text'],
@@ -178,12 +456,23 @@ class Reddit(object):
             )
         ]
 
-        for i in range(1, 10):
+        for i in range(1, len(top_scores)):
             table_entry = self.config.scoreboard['table_entry'] % (
                 i+1, top_scores[i]['user'], top_scores[i]['flair_text'],
                 self.config.subreddit, top_scores[i]['user']
                 )
             score_table.append(table_entry)
+        return score_table
+
+
+    @metrics.timed('update_scoreboard')
+    def update_scoreboard(self):
+        """ Update the top 10 list with highest scores. """
+        logging.info("Updating scoreboard")
+        now = datetime.datetime.utcnow()
+        score_table = self.score_table(
+            "Top Ten Viewchangers (%s)" % calendar.month_name[now.month],
+            self.get_top_ten_scores_this_month())
 
         settings = self.subreddit.get_settings()
         old_desc = settings['description']
@@ -196,13 +485,68 @@ class Reddit(object):
         for section in split_desc:
             if section != split_desc[0]:
                 new_desc = new_desc + "_____" + section.replace("&amp;", "&")
+        self.fence()
         self.subreddit.update_settings(description=new_desc)
         self.changes_made = False
 
 
 
+    @metrics.timed('roll_over_months')
+    def roll_over_months(self):
+        """ Once a month has been over for rollover_grace seconds, write the
+        leaderboard pages of its year and of all time, and freeze it. The
+        pages are written before the month is frozen, so if that fails they
+        are written again on the next pass. """
+        now = datetime.datetime.utcnow() - datetime.timedelta(
+                  seconds=self.config.rollover_grace or 0)
+        if not self.leaderboard.backfilled:
+            self.backfill_leaderboard(now)
+        due = self.leaderboard.due(now.year, now.month)
+        if not due:
+            return
+        size = self.config.leaderboard_size or 100
+        years = utils.unique(leaderboard.parse_month(month)[0]
+                             for month in due)
+        for year in years:
+            self.write_leaderboard_page(
+                "leaderboard_%s" % year, "Top Viewchangers of %s" % year,
+                self.top_scores(self.leaderboard.top(year, size), 1))
+        self.write_leaderboard_page(
+            "leaderboard_all_time", "Top Viewchangers of All Time",
+            self.top_scores(self.leaderboard.top(leaderboard.ALL_TIME, size), 1))
+        for month in due:
+            logging.info("Rolling over the scoreboard of %s" % month)
+            self.leaderboard.close_month(month)
+
+
+    def backfill_leaderboard(self, now):
+        """ Start the leaderboard with every month from leaderboard_start
+        (as "YEAR_MONTH") up to now that it doesn't know, reading each
+        scoreboard page once """
+        if self.config.leaderboard_start:
+            year, month = leaderboard.parse_month(self.config.leaderboard_start)
+            while (year, month) <= (now.year, now.month):
+                key = leaderboard.month_key(year, month)
+                if not self.leaderboard.knows(key):
+                    self.leaderboard.start_month(
+                        key, self.get_this_months_scoreboard(
+                                 datetime.date(year, month, 1)))
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        self.leaderboard.backfilled = True
+        self.leaderboard.save()
+
+
+    def write_leaderboard_page(self, page_title, heading, top_scores):
+        self.edit_wiki_page(self.config.subreddit, page_title,
+                            "".join(self.score_table(heading,
+                                                     top_scores)),
+                            "Updating leaderboard")
+
+
     def get_top_ten_scores(self):
         """ Get a list of the top 10 scores. """
+        if self.leaderboard.all_time:
+            return self.top_scores(self.leaderboard.top(leaderboard.ALL_TIME))
         flair_list = [f for f in self.subreddit.get_flair_list(limit=None)]
         flair_list = sorted(flair_list, key=utils.flair_sorter)
         flair_list.reverse()
@@ -211,6 +555,7 @@ class Reddit(object):
         return flair_list[0:10]
 
 
+    @metrics.timed('award_points.wiki')
     def update_wiki_tracker(self, comment):
         logging.info("Updating wiki")
         """ Update wiki page of person earning the delta
@@ -223,15 +568,9 @@ class Reddit(object):
         submission_title = comment.submission.title
         parent = self.reddit.get_info(thing_id=comment.parent_id)
         parent_author = parent.author.name
-        author_flair = str(self.subreddit.get_flair(parent_author))
-        author_flair = re.search("(flair_text': u')(\d*)", author_flair)
-        flair_count = "0 deltas"
-        if author_flair:
-            flair_count = author_flair.group(2)
-            if flair_count == "1":
-                flair_count = "1 delta"
-            else:
-                flair_count = flair_count + " deltas"
+        author_flair = self.subreddit.get_flair(parent_author)
+        flair_count = patterns.parse_flair_count(author_flair['flair_text'])
+        flair_count = utils.delta_count_text(flair_count)
         awarder_name = comment.author.name
         today = datetime.date.today()
 
@@ -242,20 +581,32 @@ class Reddit(object):
 
             # get old wiki page content as markdown string, and unescaped any
             # previously escaped HTML characters
-            old_content = HTMLParser().unescape(user_wiki_page.content_md)
+            old_content = unescape(user_wiki_page.content_md)
+        except Exception as e:
+            # Only a missing page is started afresh. Anything else, such as
+            # a 503 after the retries or an open breaker, must not replace
+            # an existing page with a new one; the journal tries again.
+            if not retry.is_missing(e):
+                raise
+            user_wiki_page = None
+
+        if user_wiki_page is not None:
+            if (utils.comment_id(comment_url) in
+                    [utils.comment_id(url)
+                     for url in patterns.wiki_award_urls(old_content)]):
+                # Already listed before an interruption, see journal.py.
+                # If that came between starting the page and listing the
+                # user on delta_tracker, list them now.
+                self.add_to_delta_tracker(parent_author)
+                return
 
             # Alter how many deltas is in the first line
-            try:
-                old_content = re.sub("([0-9]+) delta[s]?", flair_count,
-                                     old_content)
-            except:
-                print ("The 'has received' line in the wiki has failed to update.")
-            # compile regex to search for current link formatting
+            old_content = patterns.replace_wiki_delta_count(old_content,
+                                                            flair_count)
+            # regex to search for current link formatting
             # only matches links that are correctly formatted, so will not be
             # broken by malformed or links made by previous versions of DeltaBot
-            regex = re.compile("\\* \\[%s\\]\\(%s\\) \\(\d+\\)" % (
-                re.escape(submission_title), re.escape(submission_url)
-                ))
+            regex = patterns.wiki_link_pattern(submission_title, submission_url)
             # search old page content for link
             old_link = regex.search(old_content)
 
@@ -264,12 +615,8 @@ class Reddit(object):
 
             # old link exists, only increase number of deltas for post
             if old_link:
-                # use re.sub to increment number of deltas in link
-                new_link = re.sub(
-                    "\((\d+)\)",
-                    lambda match: "(" + str(int(match.group(1)) + 1) + ")",
-                                  old_link.group(0)
-                    )
+                # increment number of deltas in link
+                new_link = patterns.increment_wiki_link_count(old_link.group(0))
 
                 # insert link to new delta
                 new_link += "\n    1. [Awarded by /u/%s](%s) on %s/%s/%s" % (
@@ -277,8 +624,8 @@ class Reddit(object):
                     today.month, today.day, today.year
                     )
 
-                #use re.sub to replace old link with new link
-                new_content = re.sub(regex, new_link, old_content)
+                # replace old link with new link
+                new_content = regex.sub(lambda match: new_link, old_content)
 
             # no old link, create old link with initial count of 1
             else:
@@ -295,17 +642,18 @@ class Reddit(object):
               today.day,
               today.year)
 
-                # get previous content as markdown string and append new content
-                new_content = user_wiki_page.content_md + add_link
+                # append new content to the previous content, with its header
+                # already updated
+                new_content = old_content + add_link
 
             # overwrite old content with new content
-            self.reddit.edit_wiki_page(self.config.subreddit,
-                                       user_wiki_page.page,
-                                       new_content,
-                                       "Updated delta links.")
+            self.edit_wiki_page(self.config.subreddit,
+                                user_wiki_page.page,
+                                new_content,
+                                "Updated delta links.")
 
         # if page doesn't exist, create page with initial content
-        except:
+        else:
 
             # create header for new wiki page
             initial_text = "/u/%s has received 1 delta for the following comments:" % parent_author
@@ -324,33 +672,38 @@ class Reddit(object):
             full_update = initial_text + add_link
 
             # write new content to wiki page
-            self.reddit.edit_wiki_page(self.config.subreddit,
-                                       "user/" + parent_author,
-                                       full_update,
-                                       "Created user's delta links page.")
+            self.edit_wiki_page(self.config.subreddit,
+                                "user/" + parent_author,
+                                full_update,
+                                "Created user's delta links page.")
+
+            self.add_to_delta_tracker(parent_author)
 
-            """Add new awardee to Delta Tracker wiki page"""
 
-            # get delta tracker wiki page
-            delta_tracker_page = self.reddit.get_wiki_page(
-                                                          self.config.subreddit,
-                                                          "delta_tracker")
+    def add_to_delta_tracker(self, user):
+        """ Add new awardee to Delta Tracker wiki page, unless they are
+        already on it """
 
-            # retrieve delta tracker page content as markdown string
-            delta_tracker_page_body = delta_tracker_page.content_md
+        # get delta tracker wiki page
+        delta_tracker_page = self.reddit.get_wiki_page(self.config.subreddit,
+                                                       "delta_tracker")
 
-            # create link to user's wiki page as markdown list item
-            new_link = "\n\n* /u/%s -- [Delta List](/r/%s/wiki/%s)" % (
-                                                          parent_author,
-                                                          self.config.subreddit,
-                                                          parent_author)
+        # retrieve delta tracker page content as markdown string
+        delta_tracker_page_body = delta_tracker_page.content_md
+        if user in patterns.tracker_users(delta_tracker_page_body):
+            return
 
-            # append new link to old content
-            new_content = delta_tracker_page_body + new_link
+        # create link to user's wiki page as markdown list item
+        new_link = "\n\n* /u/%s -- [Delta List](/r/%s/wiki/%s)" % (
+                                                      user,
+                                                      self.config.subreddit,
+                                                      user)
 
-            # overwrite old page content with new page content
-            self.reddit.edit_wiki_page(self.config.subreddit,
-                                       "delta_tracker",
-                                       new_content,
-                                       "Updated tracker page.")
+        # append new link to old content
+        new_content = delta_tracker_page_body + new_link
 
+        # overwrite old page content with new page content
+        self.edit_wiki_page(self.config.subreddit,
+                            "delta_tracker",
+                            new_content,
+                            "Updated tracker page.")
@@ -0,0 +1,173 @@
+""" Replay of the traffic captured from reddit (see capture.py).
+
+ReplayReddit feeds a capture file back through Reddit(test=True,
+test_reddit=...) at any speed, so production traffic can be profiled
+offline. It is built on the mock session in praw_mocks, like the rest of
+bench.py, and is never loaded by the bot itself.
+"""
+import json
+import time
+import collections
+
+from praw_mocks import Reddit, Subreddit, Comment, Submission, Message, \
+                       Author
+
+
+class ReplaySubreddit(Subreddit):
+    def get_comments(self, params=None, limit=None):
+        self._call('get_comments')
+        return self.reddit_session._next_batch('get_comments')
+
+
+class ReplayReddit(Reddit):
+    """ A mock Reddit session that serves a capture file.
+
+    Listings (new comments and the inbox) are handed out in the order they
+    were recorded, waiting until time t / speed has passed since the replay
+    started; a speed of 0 replays as fast as the bot can go. Things only
+    become visible in reply trees once the replay has reached the point they
+    were first seen, so the bot's own recorded replies don't short-circuit
+    its rule checks. Wiki pages, flair and the sidebar start out as first
+    recorded and then follow the bot's own writes.
+    """
+
+    def __init__(self, filename, speed=1.0, username=''):
+        Reddit.__init__(self, username=username)
+        self.subreddit = ReplaySubreddit(self)
+        self.subreddit.settings = {}
+        self.speed = speed
+        self.batches = collections.defaultdict(collections.deque)
+        # (t, name, body) in the order they happen. body is None the first
+        # time a thing is seen.
+        self.events = collections.deque()
+        self.clock = 0.0
+        self.started = None
+        self.finished = False
+        self.load(filename)
+
+    def load(self, filename):
+        events = []
+        with open(filename) as capture_file:
+            for line in capture_file:
+                record = json.loads(line)
+                self.load_record(record, events)
+        events.sort(key=lambda event: event[0])
+        self.events.extend(events)
+        self.subreddit.settings.setdefault('description', '')
+
+    def load_record(self, record, events):
+        call, result, t = record['call'], record['result'], record['t']
+        if call in ('get_comments', 'get_unread'):
+            things = [self.load_thing(r, t, events) for r in result]
+            self.batches[call].append((t, [thing.name for thing in things]))
+        elif call == 'get_info':
+            for r in result if isinstance(result, list) else [result]:
+                if r:
+                    self.load_thing(r, t, events)
+        elif call == 'get_wiki_page':
+            self.wiki.setdefault(result['page'], result['content_md'])
+        elif call == 'get_flair':
+            self.subreddit.flair.setdefault(
+                result['user'],
+                (result['flair_text'], result['flair_css_class']))
+        elif call == 'get_flair_list':
+            for flair in result:
+                self.subreddit.flair.setdefault(
+                    flair['user'], (flair['flair_text'],
+                                    flair['flair_css_class']))
+        elif call == 'get_moderators':
+            if not self.moderators:
+                self.moderators = [Author(name=name) for name in result]
+        elif call == 'get_settings':
+            self.subreddit.settings.setdefault('description',
+                                               result['description'])
+
+    def submission(self, name, title='', author=None):
+        if name not in self.info:
+            submission = Submission(author=Author(name=author or ''),
+                                    reddit_session=self, replies=[])
+            submission.id = name[3:]
+            submission.title = title
+            submission.permalink = ('http://www.reddit.com/comments/%s/'
+                                    % submission.id)
+            self.info[name] = submission
+        return self.info[name]
+
+    def load_thing(self, record, t, events):
+        name = record['name']
+        if name in self.info:
+            if self.info[name].body != record.get('body', self.info[name].body):
+                events.append((t, name, record['body']))
+            return self.info[name]
+        author = Author(name=record['author']) if record['author'] else None
+        if name.startswith('t1_'):
+            thing = Comment(author=author, body=record['body'],
+                            reddit_session=self, replies=[])
+            thing.parent_id = record['parent_id']
+            thing.is_root = thing.parent_id.startswith('t3_')
+            thing.created = thing.created_utc = record['created']
+            thing.was_comment = record['was_comment']
+            # Only missing if neither the comment nor its context said
+            link_id = record['link_id'] or (thing.parent_id if thing.is_root
+                                            else 't3_')
+            thing.submission = self.submission(link_id,
+                                               record['link_title'],
+                                               record['link_author'])
+        elif name.startswith('t3_'):
+            thing = self.submission(name, record['title'], record['author'])
+            thing.permalink = record['permalink']
+            return thing
+        else:
+            thing = Message(author=author, body=record['body'],
+                            reddit_session=self, replies=[])
+            thing.subject = record['subject']
+        thing.id = name[3:]
+        if name.startswith('t1_'):
+            thing.permalink = thing.submission.permalink + thing.id
+        self.info[name] = thing
+        events.append((t, name, None))
+        return thing
+
+    def advance(self, t):
+        """ Move the replay clock to t, applying everything seen up to then """
+        if self.started is None:
+            self.started = time.time()
+        if self.speed:
+            delay = t / self.speed - (time.time() - self.started)
+            if delay > 0:
+                time.sleep(delay)
+        self.clock = max(self.clock, t)
+        while self.events and self.events[0][0] <= self.clock:
+            t, name, body = self.events.popleft()
+            thing = self.info[name]
+            if body is not None:
+                thing.body = body
+                continue
+            parent = self.info.get(getattr(thing, 'parent_id', None))
+            if parent is not None and thing not in parent.replies:
+                parent.replies.append(thing)
+
+    def _next_batch(self, call):
+        if not self.batches[call]:
+            if not any(self.batches.values()):
+                self.finished = True
+            return []
+        t, names = self.batches[call].popleft()
+        self.advance(t)
+        things = [self.info[name] for name in names]
+        for thing in things:
+            thing._visible_at = time.time()
+        return things
+
+    def get_unread(self, *args, **kwargs):
+        self._call('get_unread')
+        return [thing for thing in self._next_batch('get_unread')
+                if not thing._read]
+
+    def get_info(self, thing_id):
+        self._call('get_info')
+        if isinstance(thing_id, list) or ',' in thing_id:
+            if not isinstance(thing_id, list):
+                thing_id = thing_id.split(',')
+            return [self.info.get(name) for name in thing_id]
+        return self.info.get(thing_id)
@@ -0,0 +1,187 @@
+""" An index of the bot's own comments, by what they reply to.
+
+Telling whether the bot has already answered a comment used to mean reading
+the comment's replies, which PRAW fetches with a request of its own for
+every comment taken from a listing. Instead every comment the bot posts is
+indexed by the fullname of its parent, with the kind of message it is (the
+message key it matches, see templates.py), so the check is a dictionary
+lookup.
+
+The bot records its replies as it posts them, and each iteration reads its
+account's newest comments down to the newest one already indexed, which
+picks up anything posted another way. The first listing read only reaches
+so far back (reddit lists a thousand comments at most), so the index only
+vouches for comments newer than the oldest one of the bot's it has read;
+older ones are checked by reading their replies. The index is kept in a
+file of JSON lines, compacted when it is loaded. Under the memory budget
+(see memory.py) the entries of the oldest replies are dropped from memory,
+and comments old enough to have had one are checked the same way.
+"""
+import os
+import json
+import logging
+import threading
+
+import memory
+
+
+def id_key(fullname):
+    """ Sorts fullnames by age: reddit's ids are base 36 and grow longer """
+    id = fullname.split('_', 1)[-1]
+    return (len(id), id)
+
+
+class ReplyIndex(object):
+    """ Kept in config.reply_index_filename, or only in memory if that is
+    not set """
+
+    def __init__(self, config):
+        self.config = config
+        self.filename = config.reply_index_filename
+        # parent fullname -> (bot comment fullname, message key or None)
+        self.replies = {}
+        # The newest of the bot's comments read from its listing, and the
+        # oldest ('' if the first listing was empty): every reply of the
+        # bot's newer than that is indexed
+        self.newest = None
+        self.oldest = None
+        # id_key() of the newest reply evicted to stay in the memory budget
+        self.horizon = None
+        self.lock = threading.Lock()
+        self.file = None
+        if self.filename:
+            self.load()
+
+    def load(self):
+        if os.path.exists(self.filename):
+            with open(self.filename) as index_file:
+                for line in index_file:
+                    try:
+                        self.replay(json.loads(line))
+                    except ValueError:
+                        logging.warning("Skipping a broken reply index line")
+        if self.newest and self.oldest is None and self.replies:
+            # Indexed before the oldest comment read was kept; the oldest
+            # reply left in the index is no older than it
+            self.oldest = min((name for name, key in self.replies.values()),
+                              key=id_key)
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as index_file:
+            for parent, (name, key) in self.replies.items():
+                index_file.write(json.dumps({'parent': parent, 'reply': name,
+                                             'key': key}) + '\n')
+            if self.newest:
+                index_file.write(json.dumps({'newest': self.newest}) + '\n')
+            if self.oldest is not None:
+                index_file.write(json.dumps({'oldest': self.oldest}) + '\n')
+        os.rename(temp_filename, self.filename)
+        self.file = open(self.filename, 'a')
+
+    def replay(self, record):
+        if 'newest' in record:
+            self.newest = record['newest']
+        elif 'oldest' in record:
+            self.oldest = record['oldest']
+        elif record['reply'] is None:
+            self.replies.pop(record['parent'], None)
+        else:
+            self.replies[record['parent']] = (record['reply'], record['key'])
+
+    def write(self, record):
+        # Not synced: anything lost is read back from the listing
+        if self.file is not None:
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+    def get(self, parent):
+        """ (fullname, message key) of the bot's reply to parent, or None """
+        return self.replies.get(parent)
+
+    def confirmed(self, parent):
+        """ Returns True if the bot's indexed reply to parent is a
+        confirmation """
+        reply = self.replies.get(parent)
+        return reply is not None and reply[1] == 'confirmation'
+
+    def add(self, parent, name, key):
+        with self.lock:
+            old = self.replies.get(parent)
+            # A confirmation is what matters; another reply to the same
+            # comment doesn't hide it
+            if old == (name, key) or (old is not None and
+                                      old[1] == 'confirmation' and
+                                      key != 'confirmation'):
+                return
+            self.replies[parent] = (name, key)
+            self.write({'parent': parent, 'reply': name, 'key': key})
+
+    def record(self, reply):
+        """ Index a comment the bot has posted, or edited """
+        key, args = self.config.templates.match(reply.body)
+        self.add(reply.parent_id, reply.name, key)
+
+    def forget(self, parent):
+        """ Drop the bot's reply to parent, once it is deleted """
+        with self.lock:
+            if self.replies.pop(parent, None) is not None:
+                self.write({'parent': parent, 'reply': None, 'key': None})
+
+    def refresh(self, listing):
+        """ Index the bot's comments in listing (newest first) down to the
+        newest one indexed before. Returns how many comments they
+        answer. """
+        newest = oldest = None
+        seen = set()
+        for comment in listing:
+            if self.newest and id_key(comment.name) <= id_key(self.newest):
+                break
+            newest = newest or comment.name
+            oldest = comment.name
+            # Only the newest reply to each comment counts
+            if comment.parent_id not in seen:
+                seen.add(comment.parent_id)
+                self.record(comment)
+        with self.lock:
+            if newest:
+                self.newest = newest
+                self.write({'newest': newest})
+            if self.oldest is None:
+                # The first listing read, as far back as it goes
+                self.oldest = oldest or ''
+                self.write({'oldest': self.oldest})
+        return len(seen)
+
+    def covers(self, parent):
+        """ Returns False if a reply of the bot's to parent could be missing
+        from the index, because it came before the oldest comment the index
+        has read or it has been evicted, so its absence says nothing """
+        if self.oldest is None or id_key(parent) <= id_key(self.oldest):
+            return False
+        return self.horizon is None or id_key(parent) > self.horizon
+
+    def memory_size(self):
+        with self.lock:
+            return memory.estimate(self.replies)
+
+    def evict(self, size):
+        """ Drop the entries of the oldest replies, about size bytes of
+        them. They stay in the file. A reply is newer than what it replies
+        to, so a comment newer than the newest reply dropped still has its
+        reply, if any, indexed. """
+        with self.lock:
+            per_entry = memory.entry_size(self.replies)
+            if not per_entry:
+                return 0
+            count = min(len(self.replies), -(-size // per_entry))
+            oldest = sorted(self.replies.items(),
+                            key=lambda item: id_key(item[1][0]))[:count]
+            for parent, reply in oldest:
+                del self.replies[parent]
+            newest = id_key(oldest[-1][1][0])
+            self.horizon = max(self.horizon or newest, newest)
+            return count * per_entry
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,228 @@
+""" Retries with backoff, and circuit breakers, for calls to reddit.
+
+Retrying wraps a PRAW object the way metrics.Instrumented does. A call that
+fails with a transient error (a dropped connection, a timeout, a 429 or a 5xx
+from reddit) is tried again after a jittered, exponentially growing delay.
+Anything else, a 403, a 404 or a missing wiki page, is raised straight away.
+
+Every kind of endpoint (wiki, flair, comments, ...) has a circuit breaker. It
+opens after a run of transient failures, and while it is open calls to that
+kind of endpoint fail at once with CircuitOpen instead of waiting out their
+retries, so one part of reddit being down doesn't hold up the rest of the
+iteration. After breaker_reset seconds one call is let through to try it
+again.
+
+Calls that post something (send_message) are only retried when reddit said
+it was rate limited, as any other error could come after the message went
+out.
+"""
+import time
+import random
+import socket
+import logging
+import threading
+
+import metrics
+
+
+# HTTP statuses worth trying again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Calls that are not safe to repeat after reddit may have acted on them
+NOT_IDEMPOTENT = ('send_message', 'submit', 'reply')
+
+
+class CircuitOpen(IOError):
+    """ Raised instead of calling an endpoint whose breaker is open """
+
+
+def status_of(error):
+    """ The HTTP status an error came with, if any. requests' HTTPError has
+    the response as .response, PRAW's HTTPException as ._raw. """
+    response = getattr(error, 'response', None)
+    if response is None:
+        response = getattr(error, '_raw', None)
+    return getattr(response, 'status_code', None)
+
+
+def is_transient(error):
+    """ Returns True if the call that raised error may well work if it is
+    tried again """
+    if isinstance(error, CircuitOpen):
+        return False
+    status = status_of(error)
+    if status is not None:
+        return status in RETRY_STATUSES
+    # PRAW's RateLimitExceeded says how long to wait
+    if getattr(error, 'sleep_time', None) is not None:
+        return True
+    # requests' ConnectionError and Timeout are IOErrors too
+    return isinstance(error, (socket.error, IOError))
+
+
+def is_missing(error):
+    """ Returns True if error says the thing asked for doesn't exist, as
+    PRAW's NotFound does """
+    return status_of(error) == 404
+
+
+def is_rate_limit(error):
+    return (status_of(error) == 429 or
+            getattr(error, 'sleep_time', None) is not None)
+
+
+def endpoint_of(name):
+    """ The kind of endpoint a PRAW method calls, which shares a breaker """
+    if 'wiki' in name:
+        return 'wiki'
+    if 'flair' in name:
+        return 'flair'
+    if name in ('get_info', 'get_comments', 'get_submission'):
+        return 'comments'
+    if 'message' in name or name in ('get_unread', '_mark_as_read'):
+        return 'inbox'
+    return 'other'
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold, reset_time, clock=time.time):
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """ Returns True if a call may go ahead. Once reset_time has passed
+        since the breaker opened, one call at a time is let through. """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at < self.reset_time:
+                return False
+            # Half open: hold off everyone else until this call reports back
+            self.opened_at = self.clock()
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        """ Count a transient failure. Returns True if the breaker opened. """
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                opened = self.opened_at is None
+                self.opened_at = self.clock()
+                return opened
+            return False
+
+
+class Policy(object):
+    """ How hard to retry, and the breakers all Retrying wrappers of one
+    session share """
+
+    def __init__(self, attempts=4, delay=1.0, max_delay=30.0,
+                 breaker_threshold=5, breaker_reset=60.0, sleep=time.sleep,
+                 clock=time.time):
+        self.attempts = max(1, attempts)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.sleep = sleep
+        self.clock = clock
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """ The policy set by the retry_* and breaker_* config keys """
+        kwargs = {}
+        for key, name in (('retry_attempts', 'attempts'),
+                          ('retry_delay', 'delay'),
+                          ('retry_max_delay', 'max_delay'),
+                          ('breaker_threshold', 'breaker_threshold'),
+                          ('breaker_reset', 'breaker_reset')):
+            if config[key] is not None:
+                kwargs[name] = config[key]
+        return cls(**kwargs)
+
+    def breaker(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_reset, self.clock)
+            return self.breakers[endpoint]
+
+    def backoff(self, attempt, error=None):
+        """ Seconds to wait before retry number attempt (from 1): anywhere up
+        to delay * 2 ** (attempt - 1), capped at max_delay, so that callers
+        that failed together don't all come back together. A rate limit
+        that says how long to wait is waited out. """
+        wait = getattr(error, 'sleep_time', None)
+        if wait is not None:
+            return min(wait, self.max_delay)
+        return random.uniform(0, min(self.max_delay,
+                                     self.delay * 2 ** (attempt - 1)))
+
+    def call(self, name, function, *args, **kwargs):
+        """ Call function, the PRAW method called name, retrying transient
+        failures """
+        breaker = self.breaker(endpoint_of(name))
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                metrics.count('retry.rejected')
+                raise CircuitOpen("%s calls are failing, not calling %s" % (
+                                      endpoint_of(name), name))
+            attempt += 1
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if not is_transient(e):
+                    # The endpoint answered; the request was the problem
+                    breaker.succeeded()
+                    raise
+                if breaker.failed():
+                    logging.warning("Circuit breaker for %s calls opened" %
+                                    endpoint_of(name))
+                    metrics.count('retry.opened')
+                if (attempt >= self.attempts or
+                        (name in NOT_IDEMPOTENT and not is_rate_limit(e))):
+                    raise
+                wait = self.backoff(attempt, e)
+                logging.warning("%s failed (%s), retrying in %.1fs" % (
+                                    name, e, wait))
+                metrics.count('retry.retries')
+                self.sleep(wait)
+                continue
+            breaker.succeeded()
+            return result
+
+
+class Retrying(object):
+    """ Wraps a PRAW object so that every method call on it goes through
+    policy.call. Attributes that are not methods are passed through
+    untouched.
+
+    Lazy listings (get_comments, get_unread, ...) are only retried up to the
+    point the generator is created; a failure while reading one is raised to
+    the caller.
+    """
+
+    def __init__(self, wrapped, policy):
+        self._wrapped = wrapped
+        self._policy = policy
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._policy.call(name, attr, *args, **kwargs)
+        return call
@@ -0,0 +1,50 @@
+""" Values worth keeping between runs, so a restarted bot starts warm.
+
+The snapshot is a small JSON file of values with the time each was stored.
+Readers say how old a value may be, and fetch it again (and store it) when
+it is older or missing. The file is rewritten through a temporary file on
+every change, so a crash leaves either the old or the new snapshot.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+
+class Snapshot(object):
+    """ With no filename, values are only kept in memory """
+
+    def __init__(self, filename=None, clock=time.time):
+        self.filename = filename
+        self.clock = clock
+        # key -> [stored at, value]
+        self.values = {}
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            try:
+                with open(filename) as snapshot_file:
+                    self.values = json.load(snapshot_file)
+            except ValueError as e:
+                logging.warning("Ignoring %s: %s" % (filename, e))
+
+    def get(self, key, max_age=None):
+        """ The value stored as key, or None if there is none or it is more
+        than max_age seconds old """
+        with self.lock:
+            if key not in self.values:
+                return None
+            stored_at, value = self.values[key]
+        if max_age is not None and self.clock() - stored_at > max_age:
+            return None
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = [self.clock(), value]
+            if not self.filename:
+                return
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as snapshot_file:
+                json.dump(self.values, snapshot_file)
+            os.rename(temp_filename, self.filename)
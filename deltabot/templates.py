@@ -0,0 +1,122 @@
+""" Message templates, split up once so they are cheap to render and match.
+
+The bot's messages are %-format strings with %s slots (and %% for a
+literal %). Each one is split into its constant parts when the config is
+loaded, and append_to_all_messages (which has no slots) is unescaped once
+rather than formatted on every render. Every template of every kind is
+folded into one compiled pattern, so telling which message a comment is,
+and what was filled into it, is a single match. Checking a comment against
+one kind of message with known arguments looks at its constant start, then
+compares the rest of the message, filled in, without the suffix.
+
+Only the message itself is matched, not append_to_all_messages after it, so
+the bot still knows its comments after the suffix is edited.
+"""
+import re
+from random import choice
+
+
+SLOT = re.compile(r'(%s|%%)')
+
+
+class Template(object):
+    def __init__(self, text, suffix=''):
+        # The message itself is formatted on each render; the suffix has no
+        # slots, so it is unescaped once and just added on
+        self.body = text
+        self.suffix = suffix.replace('%%', '%')
+        self.text = text + suffix
+        # Constant parts of the message, with the slots falling between them
+        pieces = SLOT.split(self.body)
+        self.parts = ['']
+        for piece in pieces:
+            if piece == '%s':
+                self.parts.append('')
+            elif piece == '%%':
+                self.parts[-1] += '%'
+            else:
+                self.parts[-1] += piece
+        self.slots = len(self.parts) - 1
+        # The message from its first slot on, still to be formatted, and
+        # the constant start before it
+        first = pieces.index('%s') if self.slots else len(pieces)
+        self.tail = ''.join(pieces[first:])
+        self.head = self.parts[0]
+        # A message ending in a slot ends where the suffix, or the text,
+        # does; arguments are names and links, without spaces
+        self.open_ended = self.slots > 0 and not self.parts[-1]
+
+    def render(self, *args):
+        return self.body % args + self.suffix
+
+    def pattern(self):
+        """ Regex source matching the start of a rendering of this template,
+        up to the suffix, with a group per slot """
+        source = '(.*?)'.join(re.escape(part) for part in self.parts)
+        if self.open_ended:
+            source += '(?=\\s|\\Z)'
+        return source
+
+
+class Templates(object):
+    """ Every message template in the config, by message key """
+
+    def __init__(self, messages):
+        suffix = messages['append_to_all_messages']
+        self.templates = {}
+        for key in messages:
+            if key != 'append_to_all_messages':
+                self.templates[key] = [Template(text, suffix)
+                                       for text in messages[key]]
+        # Whatever follows a message is taken for the suffix, so a message
+        # that starts another is tried after it
+        ordered = sorted(((key, template)
+                          for key, templates in self.templates.items()
+                          for template in templates),
+                         key=lambda item: (-sum(len(part) for part in
+                                                item[1].parts), item[0]))
+        # (key, first group, number of slots) for each named alternative
+        self.alternatives = {}
+        alternatives = []
+        group = 0
+        for key, template in ordered:
+            name = 't%s' % len(alternatives)
+            alternatives.append('(?P<%s>%s)' % (name, template.pattern()))
+            self.alternatives[name] = (key, group + 2, template.slots)
+            group += 1 + template.slots
+        self.matcher = re.compile('(?:%s)' % '|'.join(alternatives), re.DOTALL)
+
+    def render(self, key, *args):
+        """ One of the templates for key, picked at random, filled in """
+        template = choice(self.templates[key])
+        return template.body % args + template.suffix
+
+    def match(self, text):
+        """ Returns (key, args) for the message text is a rendering of, with
+        any suffix, or (None, None) if it is not one of the bot's
+        messages """
+        match = self.matcher.match(text)
+        if match is None:
+            return None, None
+        key, first, slots = self.alternatives[match.lastgroup]
+        return key, match.groups()[first - 1:first - 1 + slots]
+
+    def matches(self, text, key, *args):
+        """ Returns True if text is a rendering of a key message with args,
+        with any suffix. Texts that start differently are turned down before
+        anything is formatted, and then only the message from its first slot
+        on is: a lone argument is just added to the constant after it. """
+        for template in self.templates[key]:
+            if not text.startswith(template.head):
+                continue
+            if template.slots == 1:
+                rest = '%s' % args + template.parts[1]
+            else:
+                rest = template.tail % args
+            start = len(template.head)
+            if text.startswith(rest, start):
+                end = start + len(rest)
+                if (not template.open_ended or end == len(text) or
+                        text[end].isspace()):
+                    return True
+        return False
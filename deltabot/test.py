@@ -25,15 +25,48 @@
 
 import unittest
 import logging
+import json
+import time
 import os
-import random
-import string
+import sys
+import tempfile
+import subprocess
+import calendar
+import threading
+import datetime
+import collections
 
+import requests
+
+import audit
+import bench
+import query
+import analytics
 import config
+import journal
+import lease
+import memory
+import leaderboard
+import retry
+import replies
+import transport
+import replay
+import capture
+import templates
+import patterns
+import utils
+import metrics
 import deltabot
 from praw_mocks import *
 
 testConfig   = config.Config(os.getcwd() + '/config/config.json')
+# Awards are journaled, and snapshots, the reply index, the leaderboard and
+# the mod mail cursor kept, in memory only, and no history or metrics are
+# written, apart from where a test says otherwise
+testConfig.load(dict(testConfig.attrs, journal_filename=None,
+                     snapshot_filename=None, reply_index_filename=None,
+                     leaderboard_filename=None, mod_mail_filename=None,
+                     history_filename=None, metrics_filename=None))
 logging.getLogger('requests').setLevel(logging.WARNING)
 
 def test_suite():
@@ -45,6 +78,9 @@ class DeltaBotTestCase(unittest.TestCase):
     def setUp(self):
         self.bot = deltabot.DeltaBot(testConfig, test=True, test_reddit=Reddit())
 
+    def tearDown(self):
+        self.bot.close()
+
 class TestScanComment(DeltaBotTestCase):
     def test_correctly_awards_delta(self):
         """2 - If a comment contains a Delta Symbol, DeltaBot should award 1 point to the author of the comment's parent"""
@@ -199,6 +235,89 @@ class TestAlreadyReplied(DeltaBotTestCase):
         result = self.bot.already_replied(comment, test=True)
         self.assertTrue(result, "already_replied returns False when DeltaBot is one of many replies")
 
+    def bot_reply(self, comment, message_key, *args):
+        session = self.bot.reddit.reddit
+        session.username = testConfig.account['username']
+        comment.reddit_session = session
+        session.set_info(comment.name, comment)
+        return comment.reply(self.bot.messages.render_message(message_key,
+                                                              *args))
+
+    def test_indexed_confirmation(self):
+        comment = Comment(replies=[])
+        self.bot.messages.replies.record(
+            self.bot_reply(comment, 'confirmation', 'a', 'b', 'a'))
+        self.assertTrue(self.bot.already_replied(comment, test=True))
+
+    def test_listing_read_in_id_order(self):
+        index = self.bot.messages.replies
+        first = self.bot_reply(Comment(replies=[]), 'too_little_text', 'a')
+        first.id = 'zzzzz'
+        index.refresh([first])
+        comment = Comment(replies=[])
+        reply = self.bot_reply(comment, 'confirmation', 'a', 'b', 'a')
+        # A longer id is newer, though it sorts first as a string
+        reply.id = '100000'
+        self.assertEqual(index.refresh([reply, first]), 1)
+        self.assertEqual(index.newest, reply.name)
+        self.assertTrue(index.confirmed(comment.name))
+
+    def test_older_than_index_reads_replies(self):
+        old = Comment(replies=[])
+        old.id = '000001'
+        self.bot_reply(old, 'confirmation', 'a', 'b', 'a')
+        # The first listing read didn't reach back to old's confirmation
+        newer = Comment(replies=[])
+        newer.id = '000002'
+        self.bot.messages.replies.refresh([self.bot_reply(
+            newer, 'too_little_text', 'a')])
+        self.assertFalse(self.bot.messages.replies.covers(old.name))
+        self.assertTrue(self.bot.already_replied(old, test=True))
+
+    def test_confirmation_found_by_name_in_any_case(self):
+        old = Comment(replies=[])
+        old.id = '000001'
+        reply = self.bot_reply(old, 'confirmation', 'a', 'b', 'a')
+        # reddit answers with the account's own capitalisation
+        reply.author = Author(name=testConfig.account['username'].swapcase())
+        self.assertTrue(self.bot.already_replied(old, test=True))
+        self.assertTrue(self.bot.messages.points_awarded_to_children('a', old))
+
+    def test_reply_found_in_listing(self):
+        comment = Comment(replies=[])
+        self.bot_reply(comment, 'confirmation', 'a', 'b', 'a')
+        self.bot.refresh_replies()
+        self.assertTrue(self.bot.already_replied(comment, test=True))
+        # Replies aren't read
+        replies, comment.replies = comment.replies, None
+        self.assertTrue(self.bot.already_replied(comment, test=True))
+
+        comment.replies = replies
+        self.bot_reply(comment, 'too_little_text', 'a')
+        self.bot.refresh_replies()
+        self.assertTrue(self.bot.already_replied(comment, test=True))
+
+    def test_other_reply_is_deleted(self):
+        comment = Comment(replies=[])
+        reply = self.bot_reply(comment, 'too_little_text', 'a')
+        self.bot.messages.replies.record(reply)
+        self.assertFalse(self.bot.already_replied(comment, test=True))
+        self.assertEqual(reply.body, '[deleted]')
+        self.assertIsNone(self.bot.messages.replies.get(comment.name))
+
+    def test_index_is_kept_in_file(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'replies.jsonl')
+        test_config = config.Config(dict(testConfig.attrs,
+                                         reply_index_filename=filename))
+        index = replies.ReplyIndex(test_config)
+        index.add('t1_a', 't1_b', 'confirmation')
+        index.add('t1_c', 't1_d', 'too_little_text')
+        index.forget('t1_c')
+        index.close()
+        index = replies.ReplyIndex(test_config)
+        self.assertEqual(index.replies, {'t1_a': ('t1_b', 'confirmation')})
+        index.close()
+
 class TestIsParentCommenterAuthor(DeltaBotTestCase):
     def test_with_OP_parent(self):
         comment = Comment()
@@ -242,6 +361,1552 @@ class TestIsCommentTooShort(DeltaBotTestCase):
         result = self.bot.messages.is_comment_too_short(long_comment)
         self.assertFalse(result, "messages.is_comment_too_short() returns True with long comment")
 
+class TestScanInbox(DeltaBotTestCase):
+    def test_threads_keep_order_and_mark_read_once(self):
+        session = self.bot.reddit.reddit
+        replies = []
+        for x in range(12):
+            reply = Comment(replies=[], reddit_session=session)
+            reply.link_id = 't3_thread%s' % (x % 3)
+            session.unread.append(reply)
+            replies.append(reply)
+
+        handled = []
+        self.bot.scan_comment_reply = handled.append
+        self.bot.scan_inbox()
+
+        for thread in range(3):
+            self.assertEqual([r for r in handled if r.link_id == 't3_thread%s' % thread],
+                             replies[thread::3])
+        self.assertEqual(session.calls['mark_as_read'], 1)
+        self.assertTrue(all(reply._read for reply in replies))
+
+    def test_failure_leaves_rest_of_thread_unread(self):
+        session = self.bot.reddit.reddit
+        replies = []
+        for x in range(4):
+            reply = Comment(replies=[], reddit_session=session)
+            reply.link_id = 't3_thread%s' % (x % 2)
+            session.unread.append(reply)
+            replies.append(reply)
+
+        def scan_comment_reply(reply):
+            if reply is replies[0]:
+                raise IOError("reddit is down")
+        self.bot.scan_comment_reply = scan_comment_reply
+        logging.disable(logging.ERROR)
+        try:
+            self.bot.scan_inbox()
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual([reply._read for reply in replies],
+                         [False, True, False, True])
+
+    def test_gives_up_on_item_that_keeps_failing(self):
+        session = self.bot.reddit.reddit
+        replies = []
+        for x in range(4):
+            reply = Comment(replies=[], reddit_session=session)
+            reply.link_id = 't3_thread%s' % (x % 2)
+            session.unread.append(reply)
+            replies.append(reply)
+
+        handled = []
+        def scan_comment_reply(reply):
+            if reply is replies[0]:
+                raise HTTPException(403)
+            if reply is replies[1]:
+                raise IOError("reddit is down")
+            handled.append(reply)
+        self.bot.scan_comment_reply = scan_comment_reply
+        logging.disable(logging.ERROR)
+        try:
+            # A 403 won't go away, so the thread goes on at once
+            self.bot.scan_inbox()
+            self.assertEqual([reply._read for reply in replies],
+                             [True, False, True, False])
+            self.assertEqual(handled, [replies[2]])
+            # A passing failure is only tried inbox_attempts times
+            for attempt in range(1, testConfig.inbox_attempts or 5):
+                self.assertFalse(replies[1]._read)
+                self.bot.scan_inbox()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(all(reply._read for reply in replies))
+        self.assertEqual(handled, [replies[2], replies[3]])
+        self.assertEqual(self.bot.inbox_attempts, {})
+
+class TestModMail(DeltaBotTestCase):
+    def message(self, id, subject, author='mod', replies=None):
+        message = Message(author=Author(name=author), replies=replies or [],
+                          reddit_session=self.bot.reddit.reddit)
+        message.id = id
+        message.subject = subject
+        return message
+
+    def record_commands(self, bot):
+        handled = []
+        bot.reddit.snapshot.set('moderators', ['mod'])
+        bot.run_command = lambda message: handled.append(message.name)
+        return handled
+
+    def test_new_commands_run_once_oldest_first(self):
+        session = self.bot.reddit.reddit
+        handled = self.record_commands(self.bot)
+        old = self.message('m00001', 'reset')
+        session.mod_mail.append(old)
+        # Mod mail from before the bot read it isn't run
+        self.bot.scan_mod_mail()
+        self.assertEqual(handled, [])
+
+        add = self.message('m00002', 'add')
+        session.mod_mail.append(add)
+        session.mod_mail.append(self.message('m00003', 'stop', 'someone'))
+        old.replies.append(self.message('m00004', 'rescan'))
+        old.replies.append(self.message('m00005', 'Add complete',
+                                        testConfig.account['username']))
+        self.bot.scan_mod_mail()
+        self.bot.scan_mod_mail()
+        self.assertEqual(handled, ['t4_m00002', 't4_m00004'])
+        self.assertEqual(self.bot.reddit.mod_mail.cursor, 't4_m00005')
+
+        # A bot that moderates gets the same message in its inbox
+        session.unread.append(add)
+        self.bot.scan_inbox()
+        self.assertEqual(handled, ['t4_m00002', 't4_m00004'])
+        self.assertTrue(add._read)
+
+    def test_failed_command_is_run_again(self):
+        session = self.bot.reddit.reddit
+        handled = self.record_commands(self.bot)
+        self.bot.scan_mod_mail()
+        session.mod_mail.append(self.message('m00001', 'add'))
+        session.mod_mail.append(self.message('m00002', 'rescan'))
+        record = self.bot.run_command
+
+        def run_command(message):
+            if message.subject == 'add' and not handled:
+                handled.append(None)
+                raise ValueError("reddit is down")
+            record(message)
+        self.bot.run_command = run_command
+        self.assertRaises(ValueError, self.bot.scan_mod_mail)
+        self.bot.scan_mod_mail()
+        self.assertEqual(handled, [None, 't4_m00001', 't4_m00002'])
+
+    def test_claims_are_kept_across_restarts(self):
+        workdir = tempfile.mkdtemp()
+        filename = os.path.join(workdir, 'mod_mail.json')
+        session = Reddit()
+        test_config = config.Config(dict(testConfig.attrs,
+                                         mod_mail_filename=filename))
+        first = deltabot.DeltaBot(test_config, test=True, test_reddit=session)
+        handled = self.record_commands(first)
+        first.scan_mod_mail()
+        add = self.message('m00001', 'add')
+        session.unread.append(add)
+        session.mod_mail.append(add)
+        first.scan_inbox()
+        first.close()
+
+        second = deltabot.DeltaBot(test_config, test=True, test_reddit=session)
+        second.reddit.snapshot.set('moderators', ['mod'])
+        second.run_command = first.run_command
+        second.scan_mod_mail()
+        second.close()
+        self.assertEqual(handled, ['t4_m00001'])
+        self.assertEqual(second.reddit.mod_mail.cursor, 't4_m00001')
+
+    def test_commands_run_during_a_long_scan(self):
+        session = Reddit()
+        bot = deltabot.DeltaBot(config.Config(dict(testConfig.attrs,
+                                                   command_poll_interval=1e-6)),
+                                test=True, test_reddit=session)
+        self.addCleanup(bot.close)
+        handled = self.record_commands(bot)
+        bot.scan_mod_mail()
+        for x in range(20):
+            comment = Comment(replies=[])
+            comment.id = 'c%05d' % x
+            session.subreddit.comments.append(comment)
+
+        scanned = []
+        def scan_comment_wrapper(comment, **kwargs):
+            scanned.append(comment.name)
+            if len(scanned) == 5:
+                session.mod_mail.append(self.message('m00001', 'stop'))
+            if handled and len(handled) == 1 and handled[-1] != len(scanned):
+                handled.append(len(scanned))
+        bot.scan_comment_wrapper = scan_comment_wrapper
+        bot.scan_comments()
+
+        self.assertEqual(len(scanned), 20)
+        self.assertEqual(handled[0], 't4_m00001')
+        # Run soon after it was sent, not once the scan was over
+        self.assertLess(handled[1], 10)
+
+class TestPrefilter(DeltaBotTestCase):
+    def comment(self, body, author='someone'):
+        comment = Comment(author=Author(name=author), body=body, replies=[])
+        comment.id = 'c%s' % len(self.bot.reddit.reddit.info)
+        comment.parent_id = 't1_parent'
+        self.bot.reddit.reddit.set_info(comment.name, comment)
+        return comment
+
+    def test_drops_comments_without_api_calls(self):
+        session = self.bot.reddit.reddit
+        long_text = "a" * self.bot.minimum_comment_length
+        dropped = [self.comment("no token here " + long_text),
+                   self.comment("    " + testConfig.tokens[0] + " in code"),
+                   self.comment(testConfig.tokens[0] + long_text,
+                                author=testConfig.account['username'])]
+        old = self.comment(testConfig.tokens[0] + long_text)
+        old.id = 'c0'
+        for comment in dropped + [old]:
+            self.bot.scan_comment_wrapper(comment, last_scanned='t1_c5')
+        self.assertEqual(session.calls['get_info'], 0)
+        self.assertFalse(any(c._replied_to for c in dropped + [old]))
+
+        new = self.comment(testConfig.tokens[0] + long_text)
+        new.id = 'c9'
+        self.assertEqual(self.bot.messages.prefilter(new, 't1_c5'), None)
+        # Ids grow a digit, and the longer one is newer
+        new.id = '100'
+        self.assertEqual(self.bot.messages.prefilter(new, 't1_zz'), None)
+        old.id = 'zz'
+        self.assertEqual(self.bot.messages.prefilter(old, 't1_100'),
+                         "No points awarded, already scanned")
+
+    def test_pass_rates(self):
+        registry = metrics.Metrics()
+        for stage, seen, passed in (('token', 200, 3), ('author', 3, 3)):
+            registry.count('prefilter.' + stage, seen)
+            registry.count('prefilter.%s.passed' % stage, passed)
+        self.assertEqual(registry.pass_rates('prefilter', ('author', 'token')),
+                         "author 3/3 (100.0%), token 3/200 (1.5%)")
+
+class TestCommandAdd(DeltaBotTestCase):
+    def test_bulk_add_batches_lookups_and_awards(self):
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = ''
+        traffic = SyntheticSubreddit(session, testConfig.tokens,
+                                     self.bot.minimum_comment_length,
+                                     delta_rate=1.0, seed=5)
+        deltas = [c for c in traffic.publish(40) if not c.is_root
+                  and any(token in c.body for token in testConfig.tokens)][:3]
+        links = ["http://www.reddit.com/r/%s/comments/%s/x/%s" % (
+                     testConfig.subreddit, c.submission.id, c.id)
+                 for c in deltas]
+        body = "\n".join(links + links[:1] +
+                         ["http://www.reddit.com/r/%s/comments/abc/x/gone"
+                          % testConfig.subreddit])
+        session.calls.clear()
+
+        report = self.bot.command_add(body, strict=False)
+
+        self.assertEqual(len(report), 4)
+        self.assertIn("comment not found", report[-1])
+        # One lookup for the comments and one for their parents, apart from
+        # the parent lookups the wiki tracker makes per award
+        self.assertEqual(session.calls['get_info'], 2 + len(deltas))
+        awardees = set()
+        for comment in deltas:
+            self.assertTrue(comment._replied_to)
+            awardees.add(str(session.get_info(comment.parent_id).author))
+        self.assertEqual(sorted(session.subreddit.flair), sorted(awardees))
+        scoreboards = [page for page in session.wiki if page.startswith('scoreboard_')]
+        self.assertEqual(len(scoreboards), 1)
+        # One scoreboard write, one user page write per delta and one tracker
+        # write per new user
+        self.assertEqual(session.calls['edit_wiki_page'],
+                         1 + len(deltas) + len(awardees))
+
+    def test_failed_reply_keeps_earlier_awards(self):
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = ''
+        traffic = SyntheticSubreddit(session, testConfig.tokens,
+                                     self.bot.minimum_comment_length,
+                                     delta_rate=1.0, seed=5)
+        deltas = [c for c in traffic.publish(40) if not c.is_root
+                  and any(token in c.body for token in testConfig.tokens)][:3]
+        awardees = [str(session.get_info(c.parent_id).author) for c in deltas]
+        body = "\n".join("http://www.reddit.com/r/%s/comments/%s/x/%s" % (
+                             testConfig.subreddit, c.submission.id, c.id)
+                         for c in deltas)
+
+        def forbidden(text):
+            raise HTTPException(403)
+        deltas[-1].reply = forbidden
+        self.assertRaises(HTTPException, self.bot.command_add, body, False)
+        self.assertEqual([c._replied_to for c in deltas], [True, True, False])
+        for awardee in awardees[:-1]:
+            self.assertIn(awardee, session.subreddit.flair)
+        self.assertEqual(self.bot.reddit.journal.pending, {})
+
+        del deltas[-1].reply
+        self.bot.command_add(body, strict=True)
+        counts = collections.Counter(awardees)
+        for awardee in awardees:
+            self.assertEqual(session.subreddit.flair[awardee][0],
+                             testConfig.flair['point_text'] % counts[awardee])
+
+class TestReconcile(DeltaBotTestCase):
+    def setUp(self):
+        self.bot = deltabot.DeltaBot(
+            config.Config(dict(testConfig.attrs, reconcile_repair=True)),
+            test=True, test_reddit=Reddit())
+
+    def award(self, awardee):
+        session = self.bot.reddit.reddit
+        parent = Comment(author=Author(name=awardee), reddit_session=session,
+                         replies=[])
+        parent.submission.title = 'CMV: a view'
+        parent.submission.permalink = 'http://www.reddit.com/comments/s1/'
+        comment = Comment(author=Author(name='op'), reddit_session=session,
+                          replies=[])
+        comment.parent_id = parent.name
+        comment.submission = parent.submission
+        for thing in (parent, comment):
+            session.set_info(thing.name, thing)
+        self.bot.reddit.award_points(awardee, comment)
+
+    def test_relists_lost_wiki_update(self):
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = ''
+        self.award('alice')
+        def lost(comment):
+            raise IOError("reddit is down")
+        self.bot.reddit.update_wiki_tracker = lost
+        self.assertRaises(IOError, self.award, 'alice')
+        del self.bot.reddit.update_wiki_tracker
+        self.assertIn("1 delta ", session.wiki['user/alice'])
+
+        logging.disable(logging.WARNING)
+        try:
+            repairs = self.bot.reconciler.run(50)
+            self.assertEqual([repair.split(':')[0] for repair in repairs],
+                             ['alice', 'alice'])
+            self.assertIn("relisted on wiki", repairs[-1])
+            self.assertEqual(self.bot.reconciler.run(50), [])
+        finally:
+            logging.disable(logging.NOTSET)
+        content = session.wiki['user/alice']
+        self.assertIn("2 deltas", content)
+        self.assertIn(") (2)", content)
+        self.assertEqual(len(patterns.wiki_award_urls(content)), 2)
+        self.assertEqual(session.subreddit.flair['alice'][0],
+                         testConfig.flair['point_text'] % 2)
+
+    def test_brings_flair_and_counts_up(self):
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = "\n\n* /u/carol -- [Delta List](x)"
+        session.wiki['user/carol'] = (
+            "/u/carol has received 1 delta for the following comments:\n\n"
+            "* [CMV](http://x/) (1)\n"
+            "    1. [Awarded by /u/a](http://x/c1?context=2) on 1/1/2014\n"
+            "    1. [Awarded by /u/b](http://x/c2?context=2) on 1/2/2014")
+        session.subreddit.flair['carol'] = (testConfig.flair['point_text'] % 1,
+                                            'points')
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.bot.reconciler.run(1), [])
+            self.assertEqual(session.calls['get_flair'], 0)
+            self.assertEqual(len(self.bot.reconciler.run(10)), 2)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(session.subreddit.flair['carol'][0],
+                         testConfig.flair['point_text'] % 2)
+        self.assertIn("received 2 deltas", session.wiki['user/carol'])
+        self.assertIn("* [CMV](http://x/) (2)", session.wiki['user/carol'])
+
+    def test_wiki_read_failure_skips_user(self):
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = ''
+        self.award('erin')
+        read = session.get_wiki_page
+
+        def failing(subreddit, page):
+            # Fails once, as if the breaker had just opened
+            if page.startswith('user/'):
+                del session.get_wiki_page
+                raise retry.CircuitOpen("wiki calls are failing")
+            return read(subreddit, page)
+        session.get_wiki_page = failing
+        flair = dict(session.subreddit.flair)
+        writes = session.calls['edit_wiki_page']
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.bot.reconciler.run(50), [])
+            self.assertEqual(session.subreddit.flair, flair)
+            self.assertEqual(self.bot.reconciler.run(50), [])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertIn('erin', self.bot.reconciler.verified)
+        self.assertEqual(session.calls['edit_wiki_page'], writes)
+
+    def test_only_reports_without_repair(self):
+        self.bot.close()
+        DeltaBotTestCase.setUp(self)
+        self.assertFalse(testConfig.reconcile_repair)
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = "\n\n* /u/dave -- [Delta List](x)"
+        # A moderator took one of dave's two deltas away from his flair
+        page = session.wiki['user/dave'] = (
+            "/u/dave has received 2 deltas for the following comments:\n\n"
+            "* [CMV](http://x/) (2)\n"
+            "    1. [Awarded by /u/a](http://x/c1?context=2) on 1/1/2014\n"
+            "    1. [Awarded by /u/b](http://x/c2?context=2) on 1/2/2014")
+        session.subreddit.flair['dave'] = (testConfig.flair['point_text'] % 1,
+                                           'points')
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(self.bot.reconciler.run(10), [])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(session.subreddit.flair['dave'][0],
+                         testConfig.flair['point_text'] % 1)
+        self.assertEqual(session.wiki['user/dave'], page)
+        self.assertEqual(session.calls['edit_wiki_page'], 0)
+
+class TestEditWatch(DeltaBotTestCase):
+    def setUp(self):
+        DeltaBotTestCase.setUp(self)
+        self.now = [1000.0]
+        self.bot.edits.clock = lambda: self.now[0]
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = ''
+        traffic = SyntheticSubreddit(session, testConfig.tokens,
+                                     self.bot.minimum_comment_length, seed=3)
+        traffic.publish(20)
+        self.comment = traffic.comment(delta=True)
+        while not self.comment.body.startswith(tuple(testConfig.tokens)):
+            self.comment = traffic.comment(delta=True)
+        # Too short
+        self.comment.body = self.comment.body.split()[0]
+        self.awardee = session.get_info(self.comment.parent_id).author.name
+        self.bot.scan_comment_wrapper(self.comment)
+
+    def test_short_delta_is_watched(self):
+        self.assertIn(self.comment.name, self.bot.edits.watched)
+        session = self.bot.reddit.reddit
+        session.calls.clear()
+        self.bot.rescan_edits()
+        # Unchanged, so only the one lookup
+        self.assertEqual(session.calls['get_info'], 1)
+        self.assertNotIn(self.awardee, session.subreddit.flair)
+        # Not due again until edit_rescan_interval has passed
+        self.bot.rescan_edits()
+        self.assertEqual(session.calls['get_info'], 1)
+
+    def test_edited_delta_is_awarded(self):
+        session = self.bot.reddit.reddit
+        self.bot.rescan_edits()
+        self.comment.body += " because " + "a" * self.bot.minimum_comment_length
+        self.bot.rescan_edits()
+        self.assertNotIn(self.awardee, session.subreddit.flair)
+
+        self.now[0] += testConfig.edit_rescan_interval
+        self.bot.rescan_edits()
+        self.assertEqual(session.subreddit.flair[self.awardee][0],
+                         testConfig.flair['point_text'] % 1)
+        reply = session.get_info(
+            self.bot.messages.replies.get(self.comment.name)[0])
+        self.assertTrue(self.bot.messages.string_matches_message(
+            reply.body, 'confirmation', self.awardee, testConfig.subreddit,
+            self.awardee))
+        self.assertNotIn(self.comment.name, self.bot.edits.watched)
+        self.assertEqual(self.bot.messages.replies.get(self.comment.name)[1],
+                         'confirmation')
+
+    def test_failed_confirmation_awards_once(self):
+        session = self.bot.reddit.reddit
+        reply = session.get_info(
+            self.bot.messages.replies.get(self.comment.name)[0])
+        self.comment.body += " because " + "a" * self.bot.minimum_comment_length
+
+        def forbidden(text):
+            raise HTTPException(403)
+        reply.edit = forbidden
+        self.assertRaises(HTTPException, self.bot.rescan_edits)
+        self.assertNotIn(self.awardee, session.subreddit.flair)
+        self.assertEqual(self.bot.reddit.journal.pending, {})
+
+        del reply.edit
+        self.now[0] += testConfig.edit_rescan_interval
+        self.bot.rescan_edits()
+        self.assertEqual(session.subreddit.flair[self.awardee][0],
+                         testConfig.flair['point_text'] % 1)
+
+    def test_watch_expires(self):
+        self.now[0] += testConfig.edit_watch_window + 1
+        self.comment.body += " because " + "a" * self.bot.minimum_comment_length
+        self.bot.rescan_edits()
+        self.assertEqual(self.bot.edits.watched, {})
+        self.assertNotIn(self.awardee, self.bot.reddit.reddit.subreddit.flair)
+
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        workdir = tempfile.mkdtemp()
+        self.filename = os.path.join(workdir, 'history.jsonl')
+        self.session = Reddit()
+        self.session.wiki['delta_tracker'] = ''
+        self.bot = deltabot.DeltaBot(config.Config(dict(testConfig.attrs,
+                                         history_filename=self.filename,
+                                         edit_rescan_interval=0)),
+                                     test=True, test_reddit=self.session)
+        self.addCleanup(self.bot.close)
+        traffic = SyntheticSubreddit(self.session, testConfig.tokens,
+                                     self.bot.minimum_comment_length, seed=3)
+        traffic.publish(20)
+        self.comment = traffic.comment(delta=True)
+        while not self.comment.body.startswith(tuple(testConfig.tokens)):
+            self.comment = traffic.comment(delta=True)
+        # Turned down as too short, then edited and awarded
+        body = self.comment.body
+        self.comment.body = body.split()[0]
+        self.bot.scan_comment_wrapper(self.comment)
+        self.bot.rescan_edits()
+        self.comment.body = body + " because " + "a" * 100
+        self.bot.rescan_edits()
+
+    def test_decisions_are_recorded(self):
+        with open(self.filename) as history_file:
+            records = [json.loads(line) for line in history_file]
+        self.assertEqual([record['rule'] for record in records],
+                         ['too_little_text', 'confirmation'])
+        parent = self.session.get_info(self.comment.parent_id)
+        self.assertEqual(records[1]['by'], str(self.comment.author))
+        self.assertEqual(records[1]['to'], str(parent.author))
+        self.assertEqual(records[1]['wait'],
+                         int(self.comment.created) - int(parent.created))
+
+    def test_stats_page(self):
+        if not analytics.has_numpy():
+            self.assertIn("NumPy", self.bot.command_stats())
+            return
+        stats = analytics.report(analytics.load(self.filename))
+        self.assertEqual((stats['deltas'], stats['rejected']), (1, 1))
+        self.assertEqual(stats['top_awarders'], [(str(self.comment.author), 1)])
+        self.assertEqual(stats['rejections'][0], ('too_little_text', 1, 1.0))
+        self.assertEqual(len(stats['per_day']), 1)
+
+        self.assertIn(testConfig.stats_page, self.bot.command_stats())
+        page = self.session.wiki[testConfig.stats_page]
+        self.assertIn("| 1 | /u/%s | 1 |" % self.comment.author, page)
+        self.assertIn("| too_little_text | 1 | 100.0% |", page)
+
+    def test_report_groups_by_day_and_awarder(self):
+        if not analytics.has_numpy():
+            return
+        day = analytics.DAY
+        records = [{'t': 10 * day + n, 'by': by, 'to': 'x', 'rule': rule,
+                    'wait': wait}
+                   for n, (by, rule, wait) in enumerate([
+                       ('b', 'confirmation', 60), ('a', 'confirmation', None),
+                       ('b', 'broken_rule', 5), ('a', 'already_awarded', 5),
+                       ('a', 'already_awarded', 5), ('b', 'confirmation', 180)])]
+        records.append({'t': 12 * day, 'by': 'c', 'to': 'x',
+                        'rule': 'confirmation', 'wait': 600})
+        stats = analytics.report(analytics.Columns(records))
+        self.assertEqual(stats['per_day'], [('1970-01-11', 3), ('1970-01-13', 1)])
+        self.assertEqual(stats['top_awarders'], [('b', 2), ('a', 1), ('c', 1)])
+        self.assertEqual(stats['median_wait'], 180.0)
+        self.assertEqual([rejection[:2] for rejection in stats['rejections']],
+                         [('already_awarded', 2), ('broken_rule', 1),
+                          ('too_little_text', 0)])
+        since = analytics.report(analytics.Columns(records), since=11 * day)
+        self.assertEqual((since['deltas'], since['rejected']), (1, 0))
+
+class TestLeaderboard(DeltaBotTestCase):
+    def deltas(self, start, n):
+        """ n deltas to different comments, made from start on """
+        session = self.bot.reddit.reddit
+        traffic = SyntheticSubreddit(session, testConfig.tokens,
+                                     self.bot.minimum_comment_length,
+                                     delta_rate=1.0, seed=7,
+                                     start=calendar.timegm(start.timetuple()))
+        traffic.publish(40)
+        deltas = [c for c in session.info.values()
+                  if isinstance(c, Comment) and not c.is_root and
+                  any(token in c.body for token in testConfig.tokens)]
+        return [(session.get_info(c.parent_id).author.name, c)
+                for c in sorted(deltas, key=lambda c: c.name)[:n]]
+
+    def test_totals_follow_awards(self):
+        now = datetime.datetime.utcnow()
+        month = leaderboard.month_key(now.year, now.month)
+        awards = self.deltas(now.replace(day=1), 6)
+        self.bot.reddit.update_monthly_scoreboards(awards)
+        # Counted once when an interrupted award is added again
+        self.bot.reddit.update_monthly_scoreboards(awards[:2])
+
+        board = self.bot.reddit.leaderboard
+        self.assertEqual(sum(points for user, points in board.top(month)),
+                         len(awards))
+        self.assertEqual(board.top(now.year), board.top(month))
+        self.assertEqual(board.top(leaderboard.ALL_TIME), board.top(month))
+
+        session = self.bot.reddit.reddit
+        session.calls.clear()
+        top = self.bot.reddit.get_top_ten_scores_this_month()
+        self.assertEqual(session.calls['get_wiki_page'], 0)
+        self.assertEqual(len(top), 10)
+        user, points = board.top(month)[0]
+        self.assertEqual(top[0], {'user': user, 'flair_text':
+                                  testConfig.flair['point_text'] % points})
+
+    def test_month_is_started_from_its_page(self):
+        now = datetime.datetime.utcnow()
+        session = self.bot.reddit.reddit
+        session.wiki['scoreboard_%s_%s' % (now.year, now.month)] = (
+            "## alice 2\n* [a](http://x/1)\n* [b](http://x/2)\n\n")
+        top = self.bot.reddit.get_top_ten_scores_this_month()
+        self.assertEqual(top[0]['user'], 'alice')
+        self.assertEqual(session.calls['get_wiki_page'], 1)
+        self.bot.reddit.get_top_ten_scores_this_month()
+        self.assertEqual(session.calls['get_wiki_page'], 1)
+
+    def test_failed_read_starts_nothing(self):
+        now = datetime.datetime.utcnow()
+        month = leaderboard.month_key(now.year, now.month)
+        session = self.bot.reddit.reddit
+        page = 'scoreboard_%s_%s' % (now.year, now.month)
+        session.wiki[page] = "## bob 1\n* [a](http://x/1)\n\n"
+        awards = self.deltas(now, 1)
+        session.failures['get_wiki_page'].append(HTTPException(403))
+        self.assertRaises(HTTPException,
+                          self.bot.reddit.update_monthly_scoreboards, awards)
+        self.assertEqual(session.wiki[page], "## bob 1\n* [a](http://x/1)\n\n")
+        self.assertFalse(self.bot.reddit.leaderboard.knows(month))
+
+        self.bot.reddit.update_monthly_scoreboards(awards)
+        self.assertIn("## bob 1", session.wiki[page])
+        self.assertEqual(self.bot.reddit.leaderboard.scores(month)['bob'], 1)
+
+    def test_rollover_freezes_month_once(self):
+        session = self.bot.reddit.reddit
+        awards = self.deltas(datetime.datetime(2014, 3, 10), 4)
+        self.bot.reddit.update_monthly_scoreboards(awards)
+        board = self.bot.reddit.leaderboard
+        year_top = board.top(2014)
+        self.assertEqual(board.due(2014, 4), ['2014_3'])
+
+        self.bot.reddit.roll_over_months()
+        self.assertEqual(board.due(2014, 4), [])
+        self.assertIn('2014_3', board.closed)
+        self.assertEqual(board.top(2014), year_top)
+        self.assertEqual(board.top(leaderboard.ALL_TIME), year_top)
+        user, points = year_top[0]
+        for page in ('leaderboard_2014', 'leaderboard_all_time'):
+            self.assertIn("/u/%s" % user, session.wiki[page])
+        writes = session.calls['edit_wiki_page']
+        self.bot.reddit.roll_over_months()
+        self.assertEqual(session.calls['edit_wiki_page'], writes)
+
+    def test_kept_in_file_and_backfilled(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'leaderboard.json')
+        test_config = config.Config(dict(testConfig.attrs,
+                                         leaderboard_filename=filename,
+                                         leaderboard_start='2013_11'))
+        session = Reddit()
+        session.wiki['scoreboard_2013_12'] = "## bob 1\n* [a](http://x/1)\n\n"
+        session.wiki['scoreboard_2014_1'] = "## bob 2\n* [b](http://x/2)\n* [c](http://x/3)\n\n"
+        bot = deltabot.DeltaBot(test_config, test=True, test_reddit=session)
+        try:
+            bot.reddit.roll_over_months()
+        finally:
+            bot.close()
+        board = leaderboard.Leaderboard(filename)
+        self.assertTrue(board.backfilled)
+        self.assertEqual(board.scores(2013), {'bob': 1})
+        self.assertEqual(board.scores(2014)['bob'], 2)
+        self.assertEqual(board.top(leaderboard.ALL_TIME)[0], ('bob', 3))
+        self.assertIn('2014_1', board.closed)
+        self.assertIn("/u/bob", session.wiki['leaderboard_all_time'])
+
+class TestQuery(DeltaBotTestCase):
+    def award(self, count, seed):
+        session = self.bot.reddit.reddit
+        session.wiki['delta_tracker'] = ''
+        traffic = SyntheticSubreddit(session, testConfig.tokens,
+                                     self.bot.minimum_comment_length,
+                                     submissions=1, delta_rate=1.0, seed=seed)
+        deltas = [c for c in traffic.publish(40) if not c.is_root
+                  and any(token in c.body for token in testConfig.tokens)]
+        awards = [(session.get_info(c.parent_id).author.name, c)
+                  for c in deltas[:count]]
+        self.bot.reddit.award_points_batch(awards)
+        return awards
+
+    def test_answers_agree_with_awards(self):
+        awards = self.award(4, seed=5)
+        session = self.bot.reddit.reddit
+        counts = collections.Counter(awardee for awardee, comment in awards)
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        month = leaderboard.month_key(*time.gmtime(awards[0][1].created)[:2])
+        calls = sum(session.calls.values())
+        for place, (user, count) in enumerate(ranked, 1):
+            self.assertEqual(self.bot.query.answer('/user/%s' % user),
+                             (200, {'user': user, 'deltas': count,
+                                    'rank': place}))
+            self.assertEqual(
+                session.subreddit.flair[user][0],
+                testConfig.flair['point_text'] % count)
+            self.assertEqual(self.bot.query.answer('/user/%s/history' % user),
+                             (200, {'user': user, 'months': [[month, count]]}))
+        submission = awards[0][1].submission.id
+        status, answer = self.bot.query.answer('/submission/t3_' + submission)
+        self.assertEqual(answer['awards'], [list(item) for item in ranked])
+        self.assertEqual(self.bot.query.answer('/user/nobody'),
+                         (200, {'user': 'nobody', 'deltas': None,
+                                'rank': None}))
+        self.assertEqual(self.bot.query.answer('/flair/x')[0], 404)
+        # Without asking reddit
+        self.assertEqual(sum(session.calls.values()), calls)
+        self.assertNotIn('nobody', self.bot.reddit.leaderboard.flair)
+
+        hits = metrics.registry.counters['query.cache_hits']
+        user = ranked[0][0]
+        self.bot.query.answer('/user/%s' % user)
+        self.assertEqual(metrics.registry.counters['query.cache_hits'],
+                         hits + 1)
+        # An award moves the cached answers on
+        comment = awards[-1][1]
+        more = Comment(author=comment.author, replies=[])
+        more.id = 'zz' + comment.id
+        more.parent_id = comment.parent_id
+        more.created = comment.created
+        more.submission = comment.submission
+        more.permalink = comment.submission.permalink + more.id
+        self.bot.reddit.award_points(user, more)
+        self.assertEqual(self.bot.query.answer('/user/%s' % user)[1]['deltas'],
+                         ranked[0][1] + 1)
+
+    def test_deltas_from_before_the_leaderboard(self):
+        session = self.bot.reddit.reddit
+        awards = self.award(1, seed=5)
+        user, comment = awards[0]
+        session.subreddit.flair[user] = (
+            testConfig.flair['point_text'] % 5, '')
+        self.bot.reddit.leaderboard.flair.clear()
+        self.assertIsNone(
+            self.bot.query.answer('/user/%s' % user)[1]['deltas'])
+        # The reconciler reads it
+        self.bot.reconciler.check(user, {}, lambda: 0)
+        self.assertEqual(self.bot.query.answer('/user/%s' % user)[1]['deltas'],
+                         5)
+        more = Comment(author=comment.author, replies=[])
+        more.id = 'zz' + comment.id
+        more.parent_id = comment.parent_id
+        more.created = comment.created
+        more.submission = comment.submission
+        more.permalink = comment.submission.permalink + more.id
+        self.bot.reddit.award_points(user, more)
+        self.assertEqual(self.bot.query.answer('/user/%s' % user)[1],
+                         {'user': user, 'deltas': 6, 'rank': 1})
+        self.assertEqual(self.bot.reddit.leaderboard.all_time[user], 2)
+
+    def test_history_outlives_the_month(self):
+        board = leaderboard.Leaderboard()
+        link = ("[CMV](http://www.reddit.com/r/test/comments/sub1/x/%s)")
+        board.start_month('2015_1', {'alice': {'score': 2, 'links': [
+                                         link % 'c1', link % 'c2']}})
+        board.add('2015_2', 'alice', link % 'c3')
+        board.start_month('2015_2', {})
+        board.add('2015_2', 'bob', link % 'c4')
+        board.close_month('2015_1')
+        self.assertEqual(board.months('alice'), [('2015_1', 2), ('2015_2', 1)])
+        self.assertEqual(board.awards_in('sub1'), [('alice', 3), ('bob', 1)])
+        self.assertEqual((board.rank('alice'), board.rank('bob', '2015_2')),
+                         (1, 1))
+
+    def test_served_and_read_from_file(self):
+        self.award(2, seed=7)
+        user = self.bot.reddit.leaderboard.top(leaderboard.ALL_TIME, 1)[0][0]
+        expected = self.bot.query.answer('/user/%s' % user)[1]
+
+        server = self.bot.query.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        response = requests.get('http://127.0.0.1:%s/user/%s' % (
+                                    server.server_port, user))
+        self.assertEqual(response.json(), expected)
+
+        filename = os.path.join(tempfile.mkdtemp(), 'leaderboard.json')
+        self.bot.reddit.leaderboard.filename = filename
+        self.bot.reddit.leaderboard.save()
+        file_config = config.Config(dict(testConfig.attrs, query_port=None,
+                                         leaderboard_filename=filename))
+        self.assertEqual(query.ask(file_config, '/user/%s' % user),
+                         (200, expected))
+
+class TestMemory(DeltaBotTestCase):
+    def test_budget_evicts_largest_cache(self):
+        index = self.bot.messages.replies
+        # The bot's listing was empty when the index started
+        index.refresh([])
+        for n in range(2000):
+            index.add('t1_%06d' % (2 * n), 't1_%06d' % (2 * n + 1),
+                      'confirmation')
+        self.bot.reconciler.verified['someone'] = 'digest'
+        sizes = self.bot.budget.sizes()
+        self.assertGreater(sizes['replies'], sizes['reconcile'])
+
+        self.bot.budget.limit = sum(sizes.values()) // 2
+        logging.disable(logging.WARNING)
+        try:
+            self.assertGreater(self.bot.budget.enforce(), 0)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertLessEqual(sum(self.bot.budget.sizes().values()),
+                             self.bot.budget.limit)
+        self.assertIn('someone', self.bot.reconciler.verified)
+        # The oldest replies went
+        self.assertIsNone(index.get('t1_000000'))
+        self.assertIsNotNone(index.get('t1_003998'))
+        self.assertFalse(index.covers('t1_000000'))
+        self.assertTrue(index.covers('t1_999999'))
+
+    def test_evicted_reply_is_read_from_replies(self):
+        session = self.bot.reddit.reddit
+        session.username = testConfig.account['username']
+        comment = Comment(replies=[], reddit_session=session)
+        comment.id = 'a0000000'
+        session.set_info(comment.name, comment)
+        self.bot.messages.reply(comment, self.bot.messages.render_message(
+            'confirmation', 'a', 'b', 'a'))
+        comment.replies = [session.get_info(
+            self.bot.messages.replies.get(comment.name)[0])]
+        self.bot.messages.replies.evict(1)
+        self.assertIsNone(self.bot.messages.replies.get(comment.name))
+        self.assertTrue(self.bot.already_replied(comment, test=True))
+
+    def test_watchdog_reports_growth(self):
+        registry = metrics.registry
+        watchdog = memory.Watchdog(config.Config(dict(
+            testConfig.attrs, memory_trace_frames=1)), self.bot.budget)
+        if watchdog.tracemalloc is None:
+            return
+        try:
+            watchdog.check()
+            hoard = [str(n) * 10 for n in range(10000)]
+            growth = watchdog.growth()
+            self.assertGreaterEqual(sum(stat.size_diff for stat in growth),
+                                    sys.getsizeof(hoard))
+            self.assertGreater(registry.gauges['memory.traced_bytes'], 0)
+            self.assertIn('memory.cache_bytes.replies', registry.gauges)
+        finally:
+            watchdog.tracemalloc.stop()
+
+    def test_soak_stays_in_budget(self):
+        soak_config = config.Config(dict(testConfig.attrs,
+                                         memory_budget=16 / 1024.0))
+        logging.disable(logging.WARNING)
+        try:
+            reports = list(bench.runsoak(soak_config, 6000, per_iteration=500,
+                                         thread_size=100, reports=3))
+        finally:
+            logging.disable(logging.NOTSET)
+        done, rss, caches, evicted = reports[-1]
+        self.assertEqual(done, 6000)
+        self.assertGreater(evicted, 0)
+        self.assertLessEqual(caches, 16 * 1024)
+
+class TestLease(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.now = 1000.0
+
+    def lease(self, holder):
+        return lease.Lease(os.path.join(self.dir, 'lease.db'), holder, 30,
+                           clock=lambda: self.now)
+
+    def test_one_holder_at_a_time(self):
+        a, b = self.lease('a'), self.lease('b')
+        try:
+            self.assertEqual(a.acquire(), 1)
+            self.assertIsNone(b.acquire())
+            self.now += 20
+            a.fence()
+            self.now += 20
+            self.assertIsNone(b.acquire())
+            self.now += 31
+            logging.disable(logging.WARNING)
+            try:
+                self.assertEqual(b.acquire(), 2)
+                self.assertRaises(lease.LeaseLost, a.fence)
+                self.assertIsNone(a.acquire())
+                b.release()
+                self.assertEqual(a.acquire(), 3)
+            finally:
+                logging.disable(logging.NOTSET)
+        finally:
+            a.close()
+            b.close()
+
+    def test_standby_takes_over(self):
+        shared = dict(testConfig.attrs, lease_duration=30,
+                      lease_filename=os.path.join(self.dir, 'lease.db'),
+                      journal_filename=os.path.join(self.dir, 'awards.journal'),
+                      leaderboard_filename=os.path.join(self.dir, 'leaderboard.json'),
+                      last_comment_filename=os.path.join(self.dir, 'prev_id.txt'))
+        session = Reddit()
+        session.wiki['delta_tracker'] = ''
+        traffic = SyntheticSubreddit(session, testConfig.tokens,
+                                     testConfig.minimum_comment_length,
+                                     delta_rate=0.2, seed=11)
+        traffic.publish(100)
+        a, b = [deltabot.DeltaBot(config.Config(dict(shared, lease_holder=name)),
+                                  test=True, test_reddit=session)
+                for name in ('a', 'b')]
+        logging.disable(logging.WARNING)
+        try:
+            for bot in (a, b):
+                bot.lease.clock = lambda: self.now
+            a.iterate()
+            self.assertTrue(a.leader)
+            self.assertTrue(session.subreddit.flair)
+            flair = dict(session.subreddit.flair)
+            writes = session.calls['edit_wiki_page']
+
+            traffic.publish(100)
+            self.assertTrue(b.iterate())
+            self.assertFalse(b.leader)
+            self.assertIsNone(b.reddit.journal.filename)
+            self.assertEqual(session.subreddit.flair, flair)
+            self.assertEqual(session.calls['edit_wiki_page'], writes)
+
+            # a stalls past its lease
+            self.now += 31
+            b.iterate()
+            self.assertTrue(b.leader)
+            self.assertEqual(b.reddit.journal.filename,
+                             shared['journal_filename'])
+            self.assertGreater(session.calls['edit_wiki_page'], writes)
+            self.assertRaises(lease.LeaseLost, a.reddit.award_points,
+                              'someone', Comment())
+            # Nor does it write anything else
+            comment = Comment(replies=[], reddit_session=session)
+            writes = (session.replies_posted, session.calls['send_message'],
+                      session.calls['edit_wiki_page'])
+            self.assertRaises(lease.LeaseLost, a.respond, comment, comment,
+                              '', 'x')
+            self.assertRaises(lease.LeaseLost, a.reddit.send_message,
+                              'someone', 'subject', 'body')
+            self.assertRaises(lease.LeaseLost, a.reddit.edit_wiki_page,
+                              testConfig.subreddit, 'page', 'text', 'reason')
+            self.assertEqual((session.replies_posted,
+                              session.calls['send_message'],
+                              session.calls['edit_wiki_page']), writes)
+            a.iterate()
+            self.assertFalse(a.leader)
+            self.assertEqual(utils.read_saved_id(shared['last_comment_filename']),
+                             b.messages.scanned_comments[-1])
+        finally:
+            logging.disable(logging.NOTSET)
+            a.close()
+            b.close()
+
+class TestJournal(DeltaBotTestCase):
+    def setUp(self):
+        self.filename = os.path.join(tempfile.mkdtemp(), 'awards.journal')
+        self.bot = deltabot.DeltaBot(
+            config.Config(dict(testConfig.attrs,
+                               journal_filename=self.filename)),
+            test=True, test_reddit=Reddit())
+        self.bot.reddit.reddit.wiki['delta_tracker'] = ''
+
+    def comment(self, awardee):
+        session = self.bot.reddit.reddit
+        parent = Comment(author=Author(name=awardee), reddit_session=session,
+                         replies=[])
+        comment = Comment(author=Author(name='op'), reddit_session=session,
+                          replies=[])
+        comment.parent_id = parent.name
+        comment.submission = parent.submission
+        for thing in (parent, comment):
+            session.set_info(thing.name, thing)
+        return comment
+
+    def fail_scoreboard(self, awards):
+        raise IOError("reddit is down")
+
+    def assertAwarded(self, awardee, count):
+        session = self.bot.reddit.reddit
+        self.assertEqual(session.subreddit.flair[awardee][0],
+                         testConfig.flair['point_text'] % count)
+        self.assertEqual(len(patterns.wiki_award_urls(
+                             session.wiki['user/' + awardee])), count)
+        scoreboard = self.bot.reddit.get_this_months_scoreboard(
+                         datetime.datetime.utcnow())
+        self.assertEqual(scoreboard[awardee]['score'], count)
+        self.assertEqual(len(scoreboard[awardee]['links']), count)
+
+    def test_resumes_failed_award(self):
+        comments = [self.comment('alice'), self.comment('alice')]
+        self.bot.reddit.update_monthly_scoreboards = self.fail_scoreboard
+        self.assertRaises(IOError, self.bot.reddit.award_points_batch,
+                          [('alice', comment) for comment in comments])
+        del self.bot.reddit.update_monthly_scoreboards
+        self.assertEqual(len(self.bot.reddit.journal.pending), 2)
+
+        logging.disable(logging.WARNING)
+        try:
+            self.bot.reddit.resume_awards()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.bot.reddit.journal.pending, {})
+        self.assertEqual(os.path.getsize(self.filename), 0)
+        self.assertAwarded('alice', 2)
+
+    def test_resumes_after_restart(self):
+        comment = self.comment('bob')
+        self.bot.reddit.update_monthly_scoreboards = self.fail_scoreboard
+        self.assertRaises(IOError, self.bot.reddit.award_points, 'bob',
+                          comment)
+        del self.bot.reddit.update_monthly_scoreboards
+        # The wiki page was written too, but the crash came before it was
+        # marked done
+        self.bot.reddit.update_wiki_tracker(comment)
+        self.bot.reddit.journal.close()
+
+        logging.disable(logging.WARNING)
+        try:
+            self.bot.reddit.journal = journal.Journal(self.filename)
+            award, = self.bot.reddit.journal.pending.values()
+            self.assertEqual(award.done, set(['flair']))
+            self.assertEqual(award.flair_start, 0)
+            self.assertIsNone(award.comment)
+            self.bot.iterate()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.bot.reddit.journal.pending, {})
+        self.assertAwarded('bob', 1)
+
+    def test_confirmed_delta_is_journaled(self):
+        comment = self.comment('erin')
+        comment.body = (testConfig.tokens[0] + ' ' +
+                        'x' * self.bot.minimum_comment_length)
+        self.bot.reddit.reddit.get_info(comment.parent_id).is_root = True
+
+        def crash(*args):
+            raise IOError("disk full")
+        self.bot.history.record = crash
+        self.assertRaises(IOError, self.bot.scan_comment_wrapper, comment)
+        self.assertTrue(self.bot.already_replied(comment))
+        self.assertEqual(len(self.bot.reddit.journal.pending), 1)
+
+        del self.bot.history.record
+        logging.disable(logging.WARNING)
+        try:
+            self.bot.reddit.resume_awards()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertAwarded('erin', 1)
+
+    def test_tracker_listed_on_retry(self):
+        session = self.bot.reddit.reddit
+        write = session.edit_wiki_page
+
+        def unavailable(subreddit, page, *args):
+            if page == 'delta_tracker':
+                raise HTTPException(403)
+            return write(subreddit, page, *args)
+        session.edit_wiki_page = unavailable
+        self.assertRaises(HTTPException, self.bot.reddit.award_points,
+                          'fay', self.comment('fay'))
+        self.assertIn('user/fay', session.wiki)
+        self.assertNotIn('/u/fay', session.wiki['delta_tracker'])
+
+        del session.edit_wiki_page
+        logging.disable(logging.WARNING)
+        try:
+            self.bot.reddit.resume_awards()
+            self.bot.reddit.award_points('fay', self.comment('fay'))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertAwarded('fay', 2)
+        self.assertEqual(session.wiki['delta_tracker'].count('/u/fay'), 1)
+
+    def test_wiki_read_failure_keeps_page(self):
+        session = self.bot.reddit.reddit
+        self.bot.reddit.award_points('dave', self.comment('dave'))
+        read = session.get_wiki_page
+
+        def forbidden(subreddit, page):
+            if page.startswith('user/'):
+                raise HTTPException(403)
+            return read(subreddit, page)
+        session.get_wiki_page = forbidden
+        self.assertRaises(HTTPException, self.bot.reddit.award_points,
+                          'dave', self.comment('dave'))
+        self.assertEqual(len(patterns.wiki_award_urls(
+                             session.wiki['user/dave'])), 1)
+        self.assertEqual(session.wiki['delta_tracker'].count('/u/dave'), 1)
+
+        del session.get_wiki_page
+        logging.disable(logging.WARNING)
+        try:
+            self.bot.reddit.resume_awards()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertAwarded('dave', 2)
+        self.assertEqual(session.wiki['delta_tracker'].count('/u/dave'), 1)
+
+    def test_flair_set_before_crash(self):
+        comment = self.comment('carol')
+        award, = self.bot.reddit.journal.begin([('carol', comment)])
+        self.bot.reddit.adjust_point_flair('carol', 1, [award])
+        self.assertEqual(award.flair_start, 0)
+        # Resuming the step finds the flair already counts the award
+        self.bot.reddit.adjust_point_flair('carol', 1, [award])
+        self.assertEqual(self.bot.reddit.reddit.subreddit.flair['carol'][0],
+                         testConfig.flair['point_text'] % 1)
+
+class TestRetry(DeltaBotTestCase):
+    def setUp(self):
+        self.bot = deltabot.DeltaBot(
+            config.Config(dict(testConfig.attrs, journal_filename=None,
+                               last_comment_filename=os.path.join(
+                                   tempfile.mkdtemp(), 'prev_id.txt'))),
+            test=True, test_reddit=Reddit())
+        self.now = 1000.0
+        self.waits = []
+        policy = self.bot.reddit.retry_policy
+        policy.sleep = self.waits.append
+        policy.clock = lambda: self.now
+        self.session = self.bot.reddit.reddit
+        self.session.wiki['delta_tracker'] = ''
+
+    def call(self, *args):
+        logging.disable(logging.WARNING)
+        try:
+            return self.bot.reddit.get_wiki_page(*args)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_retries_transient_errors(self):
+        self.session.failures['get_wiki_page'] += [HTTPException(503),
+                                                   IOError("reset")]
+        self.assertEqual(self.call(testConfig.subreddit, 'delta_tracker')
+                         .content_md, '')
+        self.assertEqual(self.session.calls['get_wiki_page'], 3)
+        self.assertEqual(len(self.waits), 2)
+        self.assertTrue(0 <= self.waits[1] <= 2 *
+                        self.bot.reddit.retry_policy.delay)
+
+    def test_fatal_errors_are_not_retried(self):
+        self.session.failures['get_wiki_page'].append(HTTPException(403))
+        self.assertRaises(HTTPException, self.call, testConfig.subreddit,
+                          'delta_tracker')
+        self.assertRaises(HTTPException, self.call, testConfig.subreddit,
+                          'gone')
+        self.assertEqual(self.session.calls['get_wiki_page'], 2)
+        self.assertEqual(self.waits, [])
+
+        self.session.failures['send_message'].append(HTTPException(503))
+        logging.disable(logging.WARNING)
+        try:
+            self.assertRaises(HTTPException, self.bot.reddit.send_message,
+                              'someone', 'subject', 'text')
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.session.calls['send_message'], 1)
+
+    def test_breaker_opens_per_endpoint(self):
+        self.bot.reddit.retry_policy.breaker_threshold = 3
+        self.session.failures['get_wiki_page'] += [HTTPException(503)] * 3
+        self.assertRaises(retry.CircuitOpen, self.call, testConfig.subreddit,
+                          'delta_tracker')
+        self.assertEqual(self.session.calls['get_wiki_page'], 3)
+        self.assertRaises(retry.CircuitOpen, self.call, testConfig.subreddit,
+                          'delta_tracker')
+        self.assertEqual(self.session.calls['get_wiki_page'], 3)
+        # Flair calls go on as normal
+        self.bot.reddit.subreddit.get_flair('someone')
+
+        self.now += self.bot.reddit.retry_policy.breaker_reset
+        self.call(testConfig.subreddit, 'delta_tracker')
+        self.call(testConfig.subreddit, 'delta_tracker')
+        self.assertEqual(self.session.calls['get_wiki_page'], 5)
+
+    def test_iteration_goes_on_after_failure(self):
+        traffic = SyntheticSubreddit(self.session, testConfig.tokens,
+                                     self.bot.minimum_comment_length,
+                                     delta_rate=1.0, seed=5)
+        published = traffic.publish(20)
+        self.session.failures['get_unread'] += [HTTPException(503)] * 4
+        logging.disable(logging.ERROR)
+        try:
+            self.assertFalse(self.bot.iterate())
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.session.calls['get_unread'], 4)
+        self.assertTrue(any(c._replied_to for c in published))
+        self.assertEqual(self.bot.messages.scanned_comments[-1],
+                         max(c.name for c in published))
+
+class TestTransport(unittest.TestCase):
+    def test_conditional_get(self):
+        server = bench.WikiServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        session = requests.Session()
+        session.mount('http://', transport.ConditionalAdapter())
+        url = 'http://127.0.0.1:%s/r/sub/wiki/page.json' % server.server_port
+        try:
+            server.pages['page'] = 'x' * 1000
+            self.assertEqual(session.get(url).text, 'x' * 1000)
+            sent = server.sent
+            response = session.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.text, 'x' * 1000)
+            self.assertEqual(server.sent, sent)
+
+            server.pages['page'] = 'y'
+            self.assertEqual(session.get(url).text, 'y')
+            self.assertEqual(server.connections, 1)
+        finally:
+            session.close()
+            server.shutdown()
+            server.server_close()
+
+class TestStartup(unittest.TestCase):
+    def test_heavy_modules_are_not_imported(self):
+        # Run in a fresh interpreter, as this one has imported everything
+        code = ("import sys, deltabot, config, reddit\n"
+                "print(' '.join(name for name in ('praw', 'requests', "
+                "'http.server', 'multiprocessing', 'numpy') "
+                "if name in sys.modules))")
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(
+                                             os.path.abspath(__file__)))
+        self.assertEqual(output.decode('utf-8').strip(), '')
+
+    def test_login_waits_for_first_call(self):
+        session = Reddit()
+        bot = deltabot.DeltaBot(testConfig, test=True, test_reddit=session)
+        try:
+            self.assertEqual(sum(session.calls.values()), 0)
+            bot.scan_inbox()
+            self.assertEqual(session.calls['login'], 1)
+            bot.scan_inbox()
+            self.assertEqual(session.calls['login'], 1)
+        finally:
+            bot.close()
+
+    def test_moderators_come_from_snapshot(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        test_config = config.Config(dict(testConfig.attrs,
+                                         journal_filename=None,
+                                         snapshot_filename=filename))
+        for moderators in (['mod'], []):
+            session = Reddit()
+            session.moderators = [Author(name=name) for name in moderators]
+            bot = deltabot.DeltaBot(test_config, test=True,
+                                    test_reddit=session)
+            try:
+                self.assertTrue(bot.messages.is_moderator('mod'))
+                self.assertFalse(bot.messages.is_moderator('someone'))
+            finally:
+                bot.close()
+        # Only the first bot had to ask
+        self.assertEqual(session.calls['get_moderators'], 0)
+
+class TestConfig(unittest.TestCase):
+    def test_derived_values(self):
+        c = config.Config(dict(testConfig.attrs, tokens=["d", "delta"],
+                               minimum_comment_length=10))
+        self.assertEqual(c.minimum_length, 15)
+        self.assertEqual(c.bot_name, testConfig.account['username'].lower())
+        self.assertTrue(c.token_pattern.search("a delta here"))
+        self.assertEqual(c.rendered_messages['broken_rule'],
+                         [m + c.messages['append_to_all_messages']
+                          for m in c.messages['broken_rule']])
+        self.assertIsNone(c.not_a_setting)
+
+    def test_validation(self):
+        attrs = dict(testConfig.attrs)
+        del attrs['tokens']
+        self.assertRaises(config.ConfigError, config.Config, attrs)
+        self.assertRaises(config.ConfigError, config.Config,
+                          dict(testConfig.attrs, tokens=[]))
+
+    def test_reload(self):
+        filename = os.path.join(tempfile.mkdtemp(), 'config.json')
+        with open(filename, 'w') as config_file:
+            json.dump(testConfig.attrs, config_file)
+        c = config.Config(filename)
+        length = c.minimum_length
+
+        with open(filename, 'w') as config_file:
+            json.dump(dict(testConfig.attrs, minimum_comment_length=1),
+                      config_file)
+        os.utime(filename, (0, 0))
+        self.assertTrue(c.reload())
+        self.assertEqual(c.minimum_comment_length, 1)
+        self.assertNotEqual(c.minimum_length, length)
+
+        # A broken file leaves the working settings in place
+        with open(filename, 'w') as config_file:
+            config_file.write("{")
+        os.utime(filename, (1, 1))
+        logging.disable(logging.ERROR)
+        try:
+            self.assertFalse(c.reload())
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(c.minimum_comment_length, 1)
+
+class TestTemplates(unittest.TestCase):
+    def setUp(self):
+        self.templates = templates.Templates({
+            'append_to_all_messages': " -- 100%% bot",
+            'confirmation': ["Awarded to /u/%s in /r/%s. [History](%s)",
+                             "Thanks, /u/%s got a delta in /r/%s (%s)"],
+            'broken_rule': ["You can't do that"],
+        })
+
+    def test_render_matches_format(self):
+        for template in self.templates.templates['confirmation']:
+            self.assertEqual(template.render('a', 'b', 'c'),
+                             template.text % ('a', 'b', 'c'))
+        self.assertEqual(self.templates.render('broken_rule'),
+                         "You can't do that -- 100% bot")
+
+    def test_match(self):
+        for template in self.templates.templates['confirmation']:
+            text = template.render('someone', 'cmv', 'link')
+            self.assertEqual(self.templates.match(text),
+                             ('confirmation', ('someone', 'cmv', 'link')))
+            self.assertTrue(self.templates.matches(text, 'confirmation',
+                                                   'someone', 'cmv', 'link'))
+            self.assertFalse(self.templates.matches(text, 'confirmation',
+                                                    'other', 'cmv', 'link'))
+        self.assertEqual(self.templates.match("You can't do that -- 100% bot"),
+                         ('broken_rule', ()))
+        self.assertEqual(self.templates.match("You can't"), (None, None))
+
+    def test_match_after_suffix_change(self):
+        text = self.templates.render('confirmation', 'someone', 'cmv', 'link')
+        edited = templates.Templates({
+            'append_to_all_messages': "\n\n^(a new footer)",
+            'confirmation': ["Awarded to /u/%s in /r/%s. [History](%s)",
+                             "Thanks, /u/%s got a delta in /r/%s (%s)"],
+            'too_little_text': ["Not yet, /u/%s"],
+        })
+        self.assertEqual(edited.match(text)[0], 'confirmation')
+        self.assertTrue(edited.matches(text, 'confirmation', 'someone', 'cmv',
+                                       'link'))
+        # A message ending in an argument ends at the footer
+        short = "Not yet, /u/someone -- 100% bot"
+        self.assertEqual(edited.match(short), ('too_little_text', ('someone',)))
+        self.assertTrue(edited.matches(short, 'too_little_text', 'someone'))
+        self.assertFalse(edited.matches(short, 'too_little_text', 'some'))
+        self.assertFalse(edited.matches("Not yet, /u/someone2",
+                                        'too_little_text', 'someone'))
+
+class TestPatterns(unittest.TestCase):
+    def test_parse_flair_count(self):
+        self.assertEqual(patterns.parse_flair_count(u"12\u2206"), 12)
+        self.assertEqual(patterns.parse_flair_count("no score"), 0)
+        self.assertEqual(patterns.parse_flair_count(None), 0)
+
+    def test_extract_comment_ids(self):
+        body = ("http://www.reddit.com/r/cmv/comments/1a/title/c1\n"
+                "reddit.com/r/cmv/comments/1a/title/c2/\n"
+                "http://www.reddit.com/r/cmv/comments/1a/title/c1\n"
+                "http://www.reddit.com/r/other/comments/1a/title/c3")
+        self.assertEqual(patterns.extract_comment_ids(body, 'cmv'), ['c1', 'c2'])
+
+    def test_wiki_link_count(self):
+        content = "* [CMV: a (2014) view](http://x/y) (2)\n    1. [Awarded]"
+        link = patterns.wiki_link_pattern("CMV: a (2014) view", "http://x/y")
+        old_link = link.search(content).group(0)
+        self.assertEqual(patterns.increment_wiki_link_count(old_link),
+                         "* [CMV: a (2014) view](http://x/y) (3)")
+
+class TestMetrics(unittest.TestCase):
+    def test_timer_records_stage(self):
+        registry = metrics.Metrics()
+        for x in range(10):
+            registry.observe('scan_comment', x)
+        self.assertEqual(registry.counters['scan_comment'], 10)
+        self.assertEqual(registry.quantile('scan_comment', 0.5), 5)
+        self.assertEqual(registry.quantile('scan_comment', 0.99), 9)
+
+    def test_instrumented_counts_calls(self):
+        registry = metrics.Metrics()
+        session = metrics.Instrumented(Reddit(), 'reddit', registry)
+        session.set_info('t1_abc', 'comment')
+        self.assertEqual(session.get_info(thing_id='t1_abc'), 'comment')
+        self.assertEqual(registry.counters['reddit.get_info'], 1)
+        self.assertIn('2 API calls', registry.end_iteration())
+        self.assertEqual(registry.iteration_counters['reddit.get_info'], 0)
+
+    def test_prometheus_export(self):
+        registry = metrics.Metrics()
+        registry.observe('award_points', 0.25)
+        registry.count('deltas_awarded')
+        text = registry.to_prometheus()
+        self.assertIn('deltabot_stage_seconds_count{stage="award_points"} 1', text)
+        self.assertIn('deltabot_events_total{event="deltas_awarded"} 1', text)
+        registry.gauge('memory.rss_bytes', 2048)
+        self.assertIn('deltabot_gauge{name="memory.rss_bytes"} 2048',
+                      registry.to_prometheus())
+
+class TestSyntheticSubreddit(unittest.TestCase):
+    def test_before_returns_newer_comments(self):
+        session = Reddit(latencies={'get_comments': 0.001})
+        traffic = SyntheticSubreddit(session, testConfig.tokens, 10, seed=1)
+        old = traffic.publish(5)
+        new = traffic.publish(3)
+        fresh = session.subreddit.get_comments(params={'before': old[-1].name})
+        self.assertEqual([c.name for c in fresh], [c.name for c in reversed(new)])
+        self.assertEqual(session.calls['get_comments'], 1)
+
+    def test_quiet_threads_are_forgotten(self):
+        session = Reddit()
+        traffic = SyntheticSubreddit(session, testConfig.tokens, 10,
+                                     submissions=2, seed=4, thread_size=20)
+        first = traffic.publish(100)
+        traffic.forget()
+        self.assertIn(first[0].name, session.info)
+        traffic.publish(100)
+        traffic.forget()
+        self.assertNotIn(first[0].name, session.info)
+        self.assertLess(len(session.subreddit.comments), 200)
+        for comment in session.subreddit.comments:
+            session.get_info(comment.parent_id)
+
+    def test_deltas_reply_to_other_users(self):
+        session = Reddit()
+        traffic = SyntheticSubreddit(session, testConfig.tokens, 10,
+                                     delta_rate=1.0, seed=2)
+        for comment in traffic.publish(50):
+            if comment.is_root:
+                continue
+            parent = session.get_info(comment.parent_id)
+            self.assertNotEqual(comment.author, parent.author)
+
+class TestReplay(unittest.TestCase):
+    def test_replays_captured_listings(self):
+        session = Reddit()
+        traffic = SyntheticSubreddit(session, testConfig.tokens, 10, seed=4)
+        published = traffic.publish(20)
+        capture_filename = os.path.join(tempfile.mkdtemp(), 'capture.jsonl')
+        with capture.open_capture(capture_filename) as capture_file:
+            recorder = capture.Recorder(session, capture_file)
+            recorder.get_subreddit('test').get_comments(params={'before': None})
+            recorder.get_info(thing_id=published[0].name)
+
+        replayed = replay.ReplayReddit(capture_filename, speed=0)
+        fresh = replayed.subreddit.get_comments()
+        self.assertEqual([c.name for c in fresh],
+                         [c.name for c in reversed(published)])
+        self.assertEqual([c.body for c in fresh],
+                         [c.body for c in reversed(published)])
+        self.assertEqual(replayed.subreddit.get_comments(), [])
+        self.assertTrue(replayed.finished)
+
+        # Replies only show up once the replay has reached them
+        for comment in fresh:
+            if not comment.is_root:
+                parent = replayed.get_info(comment.parent_id)
+                self.assertIn(comment, parent.replies)
+
+    def test_captures_inbox_comment_replies(self):
+        # Comment replies in the inbox have no link_id, only their context
+        session = Reddit()
+        reply = Comment(author=Author(name='someone'), body='thanks',
+                        reddit_session=session, replies=[])
+        reply.parent_id = 't1_abc'
+        reply.created_utc = 1400000000
+        reply.context = '/r/test/comments/s1x/a_view/%s?context=3' % reply.id
+        self.assertFalse(hasattr(reply, 'link_id'))
+        session.unread = [reply]
+        capture_filename = os.path.join(tempfile.mkdtemp(), 'capture.jsonl')
+        with capture.open_capture(capture_filename) as capture_file:
+            capture.Recorder(session, capture_file).get_unread()
+
+        replayed = replay.ReplayReddit(capture_filename, speed=0)
+        unread, = replayed.get_unread()
+        self.assertEqual(unread.name, reply.name)
+        self.assertEqual(unread.submission.name, 't3_s1x')
+
+    def test_records_from_threads_stay_whole(self):
+        session = Reddit()
+        published = SyntheticSubreddit(session, testConfig.tokens, 10,
+                                       seed=4).publish(5)
+
+        class SlowFile(object):
+            """ Lets other threads run in the middle of a write """
+            def __init__(self):
+                self.chunks = []
+
+            def write(self, text):
+                for char in text:
+                    self.chunks.append(char)
+                    time.sleep(0)
+
+            def flush(self):
+                pass
+        capture_file = SlowFile()
+        recorder = capture.Recorder(session, capture_file)
+        subreddit = recorder.get_subreddit('test')
+
+        def read():
+            for comment in published:
+                recorder.get_info(thing_id=comment.name)
+                subreddit.get_flair(str(comment.author))
+        threads = [threading.Thread(target=read) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        records = [json.loads(line)
+                   for line in ''.join(capture_file.chunks).splitlines()]
+        self.assertEqual(len(records), 4 * 2 * len(published))
+
+class TestAudit(unittest.TestCase):
+    def test_ledger_follows_rules(self):
+        delta = testConfig.tokens[0] + " " + "a" * testConfig.minimum_length
+        bot = testConfig.account['username']
+        records = [
+            {'id': 's1', 'title': 'CMV', 'author': 'op', 'created_utc': 0},
+            {'id': 'c1', 'author': 'alice', 'body': 'reply', 'created_utc': 1,
+             'parent_id': 't3_s1', 'link_id': 't3_s1'},
+            {'id': 'c2', 'author': 'op', 'body': delta, 'created_utc': 2,
+             'parent_id': 't1_c1', 'link_id': 't3_s1'},
+            # A second delta to alice under the same comment
+            {'id': 'c3', 'author': 'bob', 'body': delta, 'created_utc': 3,
+             'parent_id': 't1_c1', 'link_id': 't3_s1'},
+            # A delta to OP
+            {'id': 'c4', 'author': 'carol', 'body': delta, 'created_utc': 4,
+             'parent_id': 't3_s1', 'link_id': 't3_s1'},
+            # What the bot said at the time doesn't count
+            {'id': 'c5', 'author': bot, 'created_utc': 5, 'parent_id': 't1_c4',
+             'link_id': 't3_s1', 'body': testConfig.templates.render(
+                 'confirmation', 'carol', testConfig.subreddit, 'carol')},
+        ]
+        dump = os.path.join(tempfile.mkdtemp(), 'dump.jsonl')
+        with open(dump, 'w') as dump_file:
+            for record in records:
+                dump_file.write(json.dumps(record) + '\n')
+
+        ledger, totals = audit.audit(dump, testConfig, processes=2)
+        self.assertEqual(ledger, {'alice': [['t1_c2', 't3_s1', 2.0]]})
+        self.assertEqual(totals['comments'], 5)
+        self.assertEqual(totals['rejected'], {
+            "No points awarded, already awarded": 1,
+            "No points awarded, parent is OP": 1})
+
+        rows = audit.diff(ledger, {'alice': 0, 'dave': 2}, {'alice': 1})
+        self.assertEqual([(row['user'], row['ledger'], row['flair'])
+                          for row in rows], [('alice', 1, 0), ('dave', 0, 2)])
+
 if __name__ == '__main__':
     unittest.main()
 
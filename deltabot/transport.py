@@ -0,0 +1,129 @@
+""" HTTP tuning for the PRAW session.
+
+PRAW sends every request through the requests Session of its handler, which
+keeps connections alive but only pools ten of them per host and fetches every
+page in full. tune() mounts a ConditionalAdapter on it instead:
+
+- the connection pool is sized for the inbox and command threads, so they
+  don't open and drop connections to each other's requests;
+- GETs of wiki pages are sent with the ETag and Last-Modified of the copy
+  fetched before, and a 304 is answered from that copy, so the scoreboard,
+  delta_tracker and user pages only come down when they have changed.
+
+Responses are gzipped as requests asks for it by default. Bytes received and
+304s are counted as http.bytes and http.not_modified.
+"""
+import re
+import threading
+import collections
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+import memory
+import metrics
+
+
+# URLs whose GETs are made conditional
+CONDITIONAL_URL = re.compile(r'/wiki/')
+# Pages kept to answer 304s with
+CACHE_SIZE = 1024
+
+
+class ConditionalAdapter(HTTPAdapter):
+    def __init__(self, pool_size=10, cache_size=CACHE_SIZE,
+                 conditional_url=CONDITIONAL_URL):
+        HTTPAdapter.__init__(self, pool_connections=pool_size,
+                             pool_maxsize=pool_size)
+        self.cache_size = cache_size
+        self.conditional_url = conditional_url
+        # url -> (validators, headers, content, encoding), oldest first
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        cached = None
+        if (request.method == 'GET' and
+                self.conditional_url.search(request.url)):
+            with self.lock:
+                cached = self.cache.get(request.url)
+            if cached is not None:
+                request.headers.update(cached[0])
+
+        response = HTTPAdapter.send(self, request, **kwargs)
+        metrics.count('http.bytes', int(response.headers.get(
+            'Content-Length', len(response.content))))
+
+        if response.status_code == 304 and cached is not None:
+            metrics.count('http.not_modified')
+            return self.from_cache(response, cached)
+        if (response.status_code == 200 and request.method == 'GET' and
+                self.conditional_url.search(request.url)):
+            self.store(request.url, response)
+        return response
+
+    def memory_size(self):
+        with self.lock:
+            return sum(len(url) + len(cached[2]) + memory.SLOT_SIZE
+                       for url, cached in self.cache.items())
+
+    def evict(self, size):
+        """ Drop the pages fetched longest ago """
+        freed = 0
+        with self.lock:
+            while self.cache and freed < size:
+                url, cached = self.cache.popitem(last=False)
+                freed += len(url) + len(cached[2]) + memory.SLOT_SIZE
+        return freed
+
+    def store(self, url, response):
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['If-Modified-Since'] = response.headers['Last-Modified']
+        with self.lock:
+            if not validators:
+                self.cache.pop(url, None)
+                return
+            # Reinserted, so the most recently fetched pages are kept
+            self.cache.pop(url, None)
+            self.cache[url] = (validators, dict(response.headers),
+                               response.content, response.encoding)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def from_cache(self, not_modified, cached):
+        """ A 200 response with the cached page, for a 304 """
+        validators, headers, content, encoding = cached
+        response = Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(headers)
+        # The 304 may come with fresher validators and cookies
+        response.headers.update(not_modified.headers)
+        response.headers['Content-Length'] = str(len(content))
+        response.headers.pop('Content-Encoding', None)
+        response._content = content
+        response.encoding = encoding
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.connection = not_modified.connection
+        response.cookies = not_modified.cookies
+        response.elapsed = not_modified.elapsed
+        return response
+
+
+def pool_size(config):
+    """ Connections to keep open: one per thread that can make requests """
+    return max(10, (config.inbox_threads or 1) + (config.command_threads or 1))
+
+
+def tune(session, config):
+    """ Mount a ConditionalAdapter on the session a praw.Reddit sends its
+    requests with """
+    adapter = ConditionalAdapter(pool_size(config))
+    session.handler.http.mount('https://', adapter)
+    session.handler.http.mount('http://', adapter)
+    return adapter
@@ -1,7 +1,11 @@
+import logging
+
+import patterns
+
+
 def get_first_int(string):
     """ Returns the first integer in the string"""
-    match = re.search('(\d+)', string)
-    return int(match.group()) if match else 0
+    return patterns.parse_flair_count(string)
 
 
 def flair_sorter(dic):
@@ -13,9 +17,46 @@ def flair_sorter(dic):
         return 0
 
 
+def delta_count_text(count):
+    """ "1 delta" or "N deltas", as on the header of a user's wiki page """
+    return "1 delta" if count == 1 else "%s deltas" % count
+
+
+def comment_id(url):
+    """ Returns the id of the comment a permalink (with or without a query)
+    points to """
+    return url.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+
+
 def skippable_line(line):
     """ Returns true if the given line is a quote or code """
-    return re.search('(^    |^ *&gt;)', line) != None
+    return patterns.is_skippable_line(line)
+
+
+def unique(items):
+    """ Returns items without duplicates, in the order they were first seen """
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+def thread_key(item):
+    """ Returns the fullname of the submission an inbox item belongs to, or
+    'messages' for private messages, which must all be handled in order """
+    if not item.was_comment:
+        return 'messages'
+    link_id = getattr(item, 'link_id', None)
+    if link_id:
+        return link_id
+    context = getattr(item, 'context', None)
+    if context:
+        # /r/<subreddit>/comments/<submission id>/<title>/<comment id>/
+        return 't3_' + context.split('/')[4]
+    return item.parent_id
 
 
 def write_saved_id(filename, the_id):